@@ -63,6 +63,16 @@ myPulsePal.sendCustomWaveform(1, pulseWidth, voltages)
 myPulsePal.programOutputChannelParam('customTrainID', 2, 1)  # Program output channel 2 to use custom train 1
 myPulsePal.programOutputChannelParam('phase1Duration', 2, pulseWidth)  # Set correct pulse width for the waveform on ch2
 
+# Programming a step waveform compactly (runs of equal samples are sent as single pulses, with a longer phase1Duration)
+stepVoltages = [0]*100 + [5]*800 + [0]*100  # 1,000 samples, sent as 10 pulses
+upload = myPulsePal.sendCustomWaveform(1, pulseWidth, stepVoltages, compact=True)
+myPulsePal.programOutputChannelParam('phase1Duration', 2, upload.phase1Duration)  # Required to play the compacted waveform
+
+# Batching commands in a transaction (sent in a single USB write, with acknowledgements collected at the end)
+with myPulsePal.transaction():
+    myPulsePal.programOutputChannelParam('phase1Duration', 3, 0.002)  # Program ch3 to use 2ms pulses
+    myPulsePal.programOutputChannelParam('interPulseInterval', 3, 0.01)  # Program ch3 to use a 10ms inter-pulse interval
+
 # Soft-triggering output channels
 
 myPulsePal.triggerOutputChannels(1, 1, 0, 1)  # Soft-trigger channels 1, 2 and 4
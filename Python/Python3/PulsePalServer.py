@@ -0,0 +1,29 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# This module is pulsepal.PulsePalServer. It is kept here so that scripts importing PulsePalServer from this folder,
+# or running it (python PulsePalServer.py), keep working.
+
+import sys
+import pulsepal.PulsePalServer
+
+if __name__ == '__main__':
+    sys.exit(pulsepal.PulsePalServer.main())
+sys.modules[__name__] = pulsepal.PulsePalServer
@@ -0,0 +1,606 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# ArCOM (Arduino Communication) wraps PySerial and numpy to streamline communication
+# of numpy arrays to and from equivalent types on an Arduino-programmable microcontroller.
+# A matching class for Arduino is provided in the ArCOM repository: https://github.com/sanworks/ArCOM
+# ArCom reads and writes through a transport (see Transport below): a USB serial port by default,
+# or a TCP socket, an in-memory pipe, or any object implementing the Transport interface.
+# PySerial and the socket modules are imported by the transports that use them, when they are first created.
+
+import numpy as np
+import threading
+import time
+
+# Datatypes supported by ArCOM, and the equivalent little-endian numpy datatype
+_DATATYPES = {'uint8': np.dtype('<u1'), 'int8': np.dtype('<i1'), 'char': np.dtype('S1'),
+              'uint16': np.dtype('<u2'), 'int16': np.dtype('<i2'), 'uint32': np.dtype('<u4'), 'int32': np.dtype('<i4'),
+              'single': np.dtype('<f4'), 'double': np.dtype('<f8')}
+
+
+class ArCom(object):
+    def __init__(self, serial_port_name, baud_rate):
+        """  Initializes the ArCOM object and opens the USB serial port
+             Args:
+                 serial_port_name (string) The name of the USB serial port as known to the OS
+                                           Examples = 'COM3' (Windows), '/dev/ttyACM0' (Linux)
+                                           Also accepted:
+                                           'tcp://host:port' A TCP connection (see TCPTransport)
+                                           A Transport object (e.g. MemoryTransport, or a tuned SerialTransport)
+                                           An open serial-like object with PySerial's read/write/inWaiting/close
+                                           methods (e.g. an emulated device)
+                 baud_rate (uint32) The speed of the target USB serial device (bits/second)
+             Returns:
+                 none
+        """
+        self._typeNames = tuple(_DATATYPES)
+        self._typeBytes = tuple(datatype.itemsize for datatype in _DATATYPES.values())
+        self.transport = open_transport(serial_port_name, baud_rate)
+
+    @property
+    def serialObject(self):
+        """  The PySerial object (or serial-like object) of a SerialTransport. None for other transports """
+        return getattr(self.transport, 'serialObject', None)
+
+    def close(self):
+        """  Closes the USB serial port
+             Args:
+                 none
+             Returns:
+                 none
+         """
+        self.transport.close()
+
+    def bytes_available(self):
+        """  Returns the number of bytes available to read from the USB serial buffer
+             Args:
+                 none
+             Returns:
+                 nBytes (int) the number of bytes available to read
+         """
+        return self.transport.bytes_available()
+
+    def write(self, *arg):
+        """  Write bytes to the USB serial buffer
+             Args:
+                 Arguments containing a message to write. The message format is:
+                 # First value:
+                     Arg 1. A single value or list of values to write
+                     Arg 2. The datatype of the data in Arg 1 (must be supported, see self._typeNames)
+                 # Additional values (optional) given as pairs of arguments
+                     Arg N. An additional value or list of values to write
+                     Arg N+1. The datatype of arg N
+             Returns:
+                 none
+         """
+        message_parts = []
+        for data, datatype in zip(arg[0::2], arg[1::2]):
+            npdatatype = _datatype(datatype)
+            if type(data).__module__ == np.__name__:
+                npdata = data.astype(npdatatype, copy=False)
+            else:
+                npdata = np.array(data, dtype=npdatatype)
+            message_parts.append(npdata.tobytes())
+        self.transport.write(b''.join(message_parts))
+
+    def read(self, *arg, timeout=None):
+        """  Read bytes from the USB serial buffer
+             Args:
+                 Arguments containing a message to read. The message format is:
+                 # First value:
+                     Arg 1. The number of values to read
+                     Arg 2. The datatype of the data in Arg 1 (must be supported, see self._typeNames)
+                 # Additional values (optional) given as pairs of arguments
+                     Arg N. An additional value number of values to read
+                     Arg N+1. The datatype of arg N
+                     Note: If additional args are given, the data will be returned as a list
+                           with each requested value in the next sequential list position
+                 timeout (float, keyword only) Seconds to wait for the data. If None, the transport's timeout is used
+             Returns:
+                 The data requested, returned as a numpy ndarray
+                (or a list of ndarrays if multiple values were requested)
+         """
+        counts = arg[0::2]
+        datatypes = [_datatype(datatype) for datatype in arg[1::2]]
+        n_bytes2read = sum(num_values*datatype.itemsize for num_values, datatype in zip(counts, datatypes))
+        message_bytes = self._read_exact(n_bytes2read, timeout)
+        outputs = []
+        pos = 0
+        for num_values, datatype in zip(counts, datatypes):
+            outputs.append(np.frombuffer(message_bytes, datatype, num_values, pos))
+            pos += num_values*datatype.itemsize
+        if len(outputs) == 1:
+            outputs = outputs[0]
+        return outputs
+
+    def write_bytes(self, message_bytes):
+        """  Writes an encoded message to the USB serial buffer
+             Args:
+                 message_bytes (bytes-like) The encoded message
+             Returns:
+                 none
+         """
+        self.transport.write(message_bytes)
+
+    def write_frame(self, frame, **values):
+        """  Encodes a message with a compiled frame, and writes it to the USB serial buffer
+             Args:
+                 frame (ArComFrame) The frame describing the message
+                 values: The value of each field in the frame, given as keyword arguments
+                         (fields with a fixed value in the frame may be omitted)
+             Returns:
+                 none
+         """
+        self.transport.write(frame.encode(**values))
+
+    def read_frame(self, frame, length=None, timeout=None):
+        """  Reads a message described by a compiled frame from the USB serial buffer, in a single read
+             Args:
+                 frame (ArComFrame) The frame describing the message
+                 length (int) The length of the frame's variable-length fields (if any)
+                 timeout (float) Seconds to wait for the message. If None, the transport's timeout is used
+             Returns:
+                 The message, as a numpy structured scalar. Fields are accessed by name, e.g. reply['firmwareVersion']
+         """
+        return frame.decode(self._read_exact(frame.size(length), timeout), length)
+
+    def drain_input(self, quiet_time=0.01, max_time=1):
+        """  Discards incoming bytes until none arrive for quiet_time seconds, e.g. to discard late replies
+             Args:
+                 quiet_time (float) Seconds without input after which the input is considered drained
+                 max_time (float) The longest time to drain for, in seconds (in case input never stops)
+             Returns:
+                 nBytes (int) the number of bytes discarded
+         """
+        end_time = time.monotonic() + max_time
+        n_discarded = 0
+        while time.monotonic() < end_time:
+            data = self.transport.read(max(self.transport.bytes_available(), 1), quiet_time)
+            if not data:
+                break
+            n_discarded += len(data)
+        return n_discarded
+
+    def _read_exact(self, n_bytes2read, timeout=None):
+        return self.transport.read_exact(n_bytes2read, timeout)
+
+    def __del__(self):
+        self.transport.close()
+
+
+class Transport(object):
+    def __init__(self, timeout=10, read_chunk_size=None):
+        """  Base class for the byte streams ArCom reads and writes. Subclasses implement write(), read(),
+             bytes_available() and close(). read_exact() is built on read().
+             Args:
+                 timeout (float) Seconds a read waits for data before it times out
+                 read_chunk_size (int) The maximum number of bytes requested from the OS in one read. None for no limit
+             Returns:
+                 none
+        """
+        self.timeout = timeout
+        self.read_chunk_size = read_chunk_size
+
+    def write(self, message_bytes):
+        """  Writes bytes to the stream """
+        raise NotImplementedError
+
+    def read(self, n_bytes, timeout=None):
+        """  Reads up to n_bytes, returning as soon as any are available
+             Args:
+                 n_bytes (int) The maximum number of bytes to read
+                 timeout (float) Seconds to wait for data. If None, self.timeout is used
+             Returns:
+                 The bytes read (empty if the read timed out)
+        """
+        raise NotImplementedError
+
+    def bytes_available(self):
+        """  Returns the number of bytes that can be read without waiting """
+        raise NotImplementedError
+
+    def close(self):
+        """  Closes the stream """
+        raise NotImplementedError
+
+    def read_exact(self, n_bytes, timeout=None):
+        """  Reads exactly n_bytes. Raises ArCOMTimeoutError if they do not arrive within timeout seconds
+             (self.timeout if timeout is None)
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        message_bytes = bytearray()
+        while len(message_bytes) < n_bytes:
+            timeout = max(deadline - time.monotonic(), 0)
+            data = self.read(min(n_bytes - len(message_bytes), self.read_chunk_size or n_bytes), timeout)
+            if not data and timeout == 0:
+                break
+            message_bytes += data
+        return _checkRead(bytes(message_bytes), n_bytes)
+
+
+class SerialTransport(Transport):
+    TIMEOUT_TOLERANCE = 0.1  # PySerial reconfigures the port each time its timeout changes, so the port's timeout is
+    #                          only changed when a read needs one that differs by more than this fraction. A read may
+    #                          wait up to this fraction longer than requested.
+
+    def __init__(self, port, baud_rate=12000000, timeout=10, read_chunk_size=None, write_buffer_size=None,
+                 rtscts=True):
+        """  A USB serial port, read and written with PySerial
+             Args:
+                 port (string) The name of the USB serial port as known to the OS, or an open serial-like object
+                 baud_rate (uint32) The speed of the target USB serial device (bits/second)
+                 timeout (float) Seconds a read waits for data before it times out
+                 read_chunk_size (int) The maximum number of bytes requested from the OS in one read. None for no limit
+                 write_buffer_size (int) The size of the driver's transmit buffer in bytes (Windows only, see
+                                         PySerial's set_buffer_size). None to keep the driver's default
+                 rtscts (bool) Enables RTS/CTS flow control
+             Returns:
+                 none
+        """
+        if isinstance(port, str):
+            import serial
+            self.serialObject = serial.Serial(port, baud_rate, timeout=timeout, rtscts=rtscts)
+        else:
+            self.serialObject = port  # Keeps its own timeout
+        self._timeout = getattr(self.serialObject, 'timeout', None)  # Serial-like objects may not have one
+        self.read_chunk_size = read_chunk_size
+        if write_buffer_size is not None and hasattr(self.serialObject, 'set_buffer_size'):
+            self.serialObject.set_buffer_size(tx_size=write_buffer_size)
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+        self.serialObject.timeout = timeout
+
+    def write(self, message_bytes):
+        self.serialObject.write(message_bytes)
+
+    def read(self, n_bytes, timeout=None):
+        n_bytes = min(n_bytes, max(self.serialObject.inWaiting(), 1))
+        self._usePortTimeout(timeout)
+        return self.serialObject.read(n_bytes)
+
+    def read_exact(self, n_bytes, timeout=None):
+        if self.read_chunk_size is None or n_bytes <= self.read_chunk_size:
+            self._usePortTimeout(timeout)
+            return _checkRead(self.serialObject.read(n_bytes), n_bytes)  # PySerial waits for all n_bytes
+        return super().read_exact(n_bytes, timeout)
+
+    def bytes_available(self):
+        return self.serialObject.inWaiting()
+
+    def close(self):
+        self.serialObject.close()
+
+    def _usePortTimeout(self, timeout):
+        """  Sets the port's timeout for a read, unless it is already within TIMEOUT_TOLERANCE of timeout """
+        if timeout is None:
+            timeout = self._timeout
+        port_timeout = getattr(self.serialObject, 'timeout', None)
+        if timeout is None or port_timeout is None:
+            if port_timeout != timeout:
+                self.serialObject.timeout = timeout
+        elif not timeout <= port_timeout <= timeout*(1 + self.TIMEOUT_TOLERANCE):
+            self.serialObject.timeout = timeout*(1 + self.TIMEOUT_TOLERANCE/2)  # Leaves room for later reads to vary
+
+
+class TCPTransport(Transport):
+    def __init__(self, host, port, timeout=10, read_chunk_size=65536, write_buffer_size=None):
+        """  A TCP connection to a byte stream, e.g. a serial port shared over the network by a serial-to-TCP bridge
+             Args:
+                 host (string) The host name or IP address
+                 port (int) The TCP port
+                 timeout (float) Seconds a read (or the connection attempt) waits before it times out
+                 read_chunk_size (int) The maximum number of bytes received from the socket in one call
+                 write_buffer_size (int) The socket's send buffer size in bytes (SO_SNDBUF). None for the OS default
+             Returns:
+                 none
+        """
+        import select
+        import socket
+        super().__init__(timeout, read_chunk_size)
+        self._select = select.select
+        self.socket = socket.create_connection((host, port), timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send short commands immediately
+        if write_buffer_size is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, write_buffer_size)
+        self._buffer = bytearray()
+
+    def write(self, message_bytes):
+        self.socket.sendall(message_bytes)
+
+    def read(self, n_bytes, timeout=None):
+        if not self._buffer:
+            self._receive(self.timeout if timeout is None else timeout)
+        message_bytes = bytes(self._buffer[:n_bytes])
+        del self._buffer[:n_bytes]
+        return message_bytes
+
+    def bytes_available(self):
+        while self._receive(0):
+            pass
+        return len(self._buffer)
+
+    def close(self):
+        self.socket.close()
+
+    def _receive(self, timeout):
+        readable, _, _ = self._select([self.socket], [], [], timeout)
+        if not readable:
+            return False
+        data = self.socket.recv(self.read_chunk_size or 65536)
+        if not data:
+            raise ArCOMError('Error: the TCP connection was closed by the remote host.')
+        self._buffer += data
+        return True
+
+
+class MemoryTransport(Transport):
+    def __init__(self, inbox, outbox, timeout=10):
+        """  One end of an in-memory byte pipe. Create connected ends with MemoryTransport.pair()
+             Args:
+                 inbox (_MemoryPipe) The pipe this end reads from
+                 outbox (_MemoryPipe) The pipe this end writes to
+                 timeout (float) Seconds a read waits for data before it times out
+             Returns:
+                 none
+        """
+        super().__init__(timeout)
+        self._inbox = inbox
+        self._outbox = outbox
+
+    @staticmethod
+    def pair(timeout=10):
+        """  Returns two connected MemoryTransports. Bytes written to one can be read from the other """
+        pipe_a, pipe_b = _MemoryPipe(), _MemoryPipe()
+        return MemoryTransport(pipe_a, pipe_b, timeout), MemoryTransport(pipe_b, pipe_a, timeout)
+
+    def write(self, message_bytes):
+        self._outbox.put(bytes(message_bytes))
+
+    def read(self, n_bytes, timeout=None):
+        return self._inbox.get(n_bytes, self.timeout if timeout is None else timeout)
+
+    def bytes_available(self):
+        return self._inbox.available()
+
+    def close(self):
+        self._inbox.close()
+        self._outbox.close()
+
+
+class _MemoryPipe(object):
+    def __init__(self):
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, message_bytes):
+        with self._condition:
+            if self._closed:
+                raise ArCOMError('Error: the in-memory transport is closed.')
+            self._buffer += message_bytes
+            self._condition.notify_all()
+
+    def get(self, n_bytes, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._buffer or self._closed, timeout)
+            message_bytes = bytes(self._buffer[:n_bytes])
+            del self._buffer[:n_bytes]
+            return message_bytes
+
+    def available(self):
+        with self._condition:
+            return len(self._buffer)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class TracingTransport(Transport):
+    def __init__(self, transport, hook=None):
+        """  Wraps a transport, and counts the bytes and time of each write and read. Installed only while tracing,
+             so untraced reads and writes have no overhead.
+             Example: arcom.transport = TracingTransport(arcom.transport)
+             Args:
+                 transport (Transport) The transport to wrap
+                 hook (function) Called after each write and read as hook(direction, message_bytes, seconds),
+                                 where direction is 'write' or 'read'. None for counts only
+             Returns:
+                 none
+        """
+        self.transport = transport
+        self.hook = hook
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.write_time = 0  # Seconds spent in writes
+        self.read_time = 0  # Seconds spent in reads, including waiting for data
+        self.n_writes = 0
+        self.n_reads = 0
+
+    @property
+    def timeout(self):
+        return self.transport.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.transport.timeout = timeout
+
+    def __getattr__(self, name):  # e.g. serialObject, read_chunk_size
+        if name == 'transport':  # Not set yet (e.g. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.transport, name)
+
+    def write(self, message_bytes):
+        start_time = time.perf_counter()
+        self.transport.write(message_bytes)
+        self._count('write', message_bytes, time.perf_counter() - start_time)
+
+    def read(self, n_bytes, timeout=None):
+        start_time = time.perf_counter()
+        message_bytes = self.transport.read(n_bytes, timeout)
+        self._count('read', message_bytes, time.perf_counter() - start_time)
+        return message_bytes
+
+    def read_exact(self, n_bytes, timeout=None):
+        start_time = time.perf_counter()
+        try:
+            message_bytes = self.transport.read_exact(n_bytes, timeout)
+        except ArCOMTimeoutError:
+            self._count('read', b'', time.perf_counter() - start_time)
+            raise
+        self._count('read', message_bytes, time.perf_counter() - start_time)
+        return message_bytes
+
+    def bytes_available(self):
+        return self.transport.bytes_available()
+
+    def close(self):
+        self.transport.close()
+
+    def _count(self, direction, message_bytes, seconds):
+        if direction == 'write':
+            self.bytes_written += len(message_bytes)
+            self.write_time += seconds
+            self.n_writes += 1
+        else:
+            self.bytes_read += len(message_bytes)
+            self.read_time += seconds
+            self.n_reads += 1
+        if self.hook is not None:
+            self.hook(direction, message_bytes, seconds)
+
+
+def open_transport(port, baud_rate=12000000):
+    """  Returns a transport for a port given as a Transport (returned as is), a 'tcp://host:port' address,
+         a USB serial port name, or an open serial-like object
+    """
+    if isinstance(port, Transport):
+        return port
+    if isinstance(port, str) and port.startswith('tcp://'):
+        host, _, tcp_port = port[len('tcp://'):].rpartition(':')
+        return TCPTransport(host, int(tcp_port))
+    return SerialTransport(port, baud_rate)
+
+
+class ArComFrame(object):
+    def __init__(self, *fields):
+        """  Describes the binary layout of a message, and compiles it to a reusable encoder/decoder.
+             Messages are encoded in place in a preallocated buffer, so encoding a frame allocates nothing new.
+             Args:
+                 Each argument is a tuple describing one field of the message, in the order it is transmitted:
+                     (name, datatype) A single value
+                     (name, datatype, count) An array of count values. If count is None, the field has variable length,
+                                             set when the frame is encoded. All variable-length fields in a frame
+                                             share the same length.
+                     (name, datatype, count, value) A field with a fixed value (e.g. an op code),
+                                                    written once when the frame is compiled
+             Returns:
+                 none
+             Example:
+                 ArComFrame(('opCode', 'uint8', 2, (213, 74)), ('param', 'uint8'), ('channel', 'uint8'), ('value', 'uint32'))
+        """
+        self._fields = []
+        self._fixedValues = {}
+        for field in fields:
+            name, datatype = field[0], field[1]
+            count = field[2] if len(field) > 2 else 1
+            self._fields.append((name, _datatype(datatype), count))
+            if len(field) > 3:
+                self._fixedValues[name] = field[3]
+        self._variableFields = [name for name, datatype, count in self._fields if count is None]
+        self._buffers = {}  # Compiled buffers, indexed by the length of variable-length fields
+        if not self._variableFields:
+            self._buffer(None)
+
+    def size(self, length=None):
+        """  Returns the size of the encoded frame in bytes
+             Args:
+                 length (int) The length of the frame's variable-length fields (if any)
+         """
+        return self._buffer(length).itemsize
+
+    def encode(self, **values):
+        """  Encodes a message into the frame's preallocated buffer
+             Args:
+                 values: The value of each field in the frame, given as keyword arguments
+                         (fields with a fixed value in the frame may be omitted)
+             Returns:
+                 A memoryview of the encoded message. It is only valid until the frame is next encoded
+                 (use bytes() on the result to keep a copy)
+         """
+        length = None
+        if self._variableFields:
+            length = len(values[self._variableFields[0]])
+        buffer = self._buffer(length)
+        for name, value in values.items():
+            buffer[name] = value
+        return buffer.data.cast('B')
+
+    def decode(self, message_bytes, length=None):
+        """  Decodes a message
+             Args:
+                 message_bytes (bytes) The encoded message
+                 length (int) The length of the frame's variable-length fields (if any)
+             Returns:
+                 The message, as a numpy structured scalar. Fields are accessed by name
+         """
+        return np.frombuffer(message_bytes, self._buffer(length).dtype, 1)[0]
+
+    def _buffer(self, length):
+        if length not in self._buffers:
+            if len(self._buffers) > 8:  # Keep buffers for the most recently used lengths only
+                self._buffers.clear()
+            dtype = np.dtype([(name, datatype) if count == 1 else
+                              (name, datatype, (length if count is None else count,))
+                              for name, datatype, count in self._fields])
+            buffer = np.zeros((), dtype)
+            for name, value in self._fixedValues.items():
+                buffer[name] = value
+            self._buffers[length] = buffer
+        return self._buffers[length]
+
+
+def _checkRead(message_bytes, n_bytes2read):
+    n_bytes_read = len(message_bytes)
+    if n_bytes_read < n_bytes2read:
+        raise ArCOMTimeoutError('Error: serial port timed out. ' + str(n_bytes_read) +
+                         ' bytes read. Expected ' + str(n_bytes2read) + ' byte(s).')
+    return message_bytes
+
+
+def _datatype(datatype):
+    if datatype not in _DATATYPES:
+        raise ArCOMError('Error: ' + str(datatype) + ' is not a data type supported by ArCOM.')
+    return _DATATYPES[datatype]
+
+
+class ArCOMError(Exception):
+    pass
+
+
+class ArCOMTimeoutError(ArCOMError):
+    pass
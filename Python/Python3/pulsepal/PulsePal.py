@@ -0,0 +1,1518 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from .ArCOM import ArCom, ArComFrame, ArCOMError
+from .PulsePalConversion import seconds2Cycles, volts2Bits, cycles2Seconds, bits2Volts, compactWaveform
+from .PulsePalValidation import (OUTPUT_PARAMETER_NAMES, validateParams, validateParam, validateCustomTrain,
+                                validateCustomWaveform, formatViolations)
+from .PulsePalParameters import (OUTPUT_PARAMS_DTYPE, TRIGGER_PARAMS_DTYPE, ParameterField, ChannelParameters,
+                                ParameterFieldAttribute)
+from .PulsePalSDSettings import (encodeSettingsFile, decodeSettingsFile, decodeLoadReply, isValidProgram,
+                                firmwareDefaults, checkFileName, LOAD_REPLY_SIZE, SETTINGS_FILE_SIZE)
+import collections
+import contextlib
+import functools
+import json
+import numpy as np
+import math
+import os
+import time
+
+WaveformUpload = collections.namedtuple('WaveformUpload', ['nSamples', 'nPulses', 'phase1Duration',
+                                                           'compressionRatio', 'bytesSaved'])
+WaveformUpload.__doc__ = """
+The result of sending a custom waveform.
+    nSamples (int): Samples in the waveform
+    nPulses (int): Pulses sent to the device (fewer than nSamples if runs were merged)
+    phase1Duration (float): The phase1Duration that plays the waveform on an output channel. Units = seconds.
+    compressionRatio (float): nSamples/nPulses
+    bytesSaved (int): Bytes not sent, compared with one pulse per sample
+"""
+
+
+def _traced(method):
+    """
+    Decorates a public command method. While tracing, the call's start time is kept so that the encoding time of its
+    messages can be measured (see PulsePalTrace). Calls made from inside a traced call are timed as part of it.
+    """
+    @functools.wraps(method)
+    def traced_method(self, *args, **kwargs):
+        if self.tracer is None or self._traceStart is not None:
+            return method(self, *args, **kwargs)
+        self._traceStart = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._traceStart = None
+    return traced_method
+
+
+class PulsePalObject(object):
+    # Constants
+    OP_MENU_BYTE = 213
+    HANDSHAKE_OPCODE = 72
+    HANDSHAKE_RESPONSE = 75
+    DAC_BITMAX_MODEL_1 = 255
+    DAC_BITMAX_MODEL_2 = 65535
+    CYCLE_FREQUENCY = 20000  # Hz
+    SYNC_ROUND_TRIP_COST = 256  # Bytes that could be sent in the time of one USB round-trip. Used by syncAllParams()
+    #                             to choose between single-parameter writes (op 74) and a full program (op 73)
+    STATE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pulsepal_state.json')  # Parameters on each device
+    #                  (by port and firmware version) when it was last disconnected by a session that uses the cache
+    #                  (see adopt_state and disconnect()). Set to None to disable the cache.
+    ACK_TIMEOUT = 1  # Seconds to wait for an acknowledgement, after the time the message takes to send (see below)
+    LINK_THROUGHPUT = 100000  # Bytes/second assumed when allowing time for a long message (e.g. a custom train) to send
+    RESYNC_TIMEOUT = 0.1  # Seconds resync() waits for each handshake reply
+    RESYNC_ATTEMPTS = 3  # Handshakes resync() tries before giving up
+    RESYNC_QUIET_TIME = 0.01  # resync() discards input until no bytes arrive for this many seconds
+    SD_LOAD_TIMEOUT = 0.5  # Seconds loadSettingsFile() waits for the loaded program. A failed load returns nothing.
+    tracer = None  # A PulsePalTracer while tracing (see startTrace())
+    _lastTracer = None  # The tracer of the last trace, kept by stopTrace() for stats()
+    triggerTimer = None  # A PulsePalTriggerTimer while soft-triggers are timed (see startTriggerTiming())
+    _traceStart = None  # While tracing, the time the current API call (or its previous message) started
+    _cachesState = False  # True if disconnect() saves the device's parameters to the state cache (see adopt_state)
+    
+    def __init__(self, port_name, adopt_state=False):
+        """
+        Initializes a new instance of the PulsePalObject.
+
+        Args:
+            port_name (str): The name of the USB serial port to which the Pulse Pal is connected (e.g. COM3 on Windows)
+                             Also accepted: a 'tcp://host:port' address, an ArCOM Transport (e.g. a tuned
+                             SerialTransport), or an open serial-like object, e.g. PulsePalEmulator.EmulatedSerial()
+            adopt_state (bool): If True, the device's current parameters are adopted instead of being reset to defaults,
+                                and no program is sent. Parameters are read from the state cache if this port was
+                                last disconnected by a PulsePalObject (see STATE_CACHE_PATH). Otherwise, on Pulse Pal 2,
+                                they are read from the device's microSD settings file (op 85). Note: the settings file
+                                holds the parameters loaded at power-up or by the last save/load, not later changes
+                                made over USB. If neither source is available, parameters are reset as usual.
+                                The session saves the device's parameters to the state cache when it disconnects,
+                                for the next session with adopt_state=True. Sessions without it do not use the cache.
+
+        Raises:
+            PulsePalError: If there is a problem initializing the connection.
+        """
+        self.Port = ArCom(port_name, 12000000)  # ArCom (Arduino Communication) wraps PySerial
+        #                                         to simplify data transactions with Arduino
+        
+        # handshake to confirm connectivity
+        self.Port.write_frame(_HANDSHAKE_FRAME)
+        handshake = self.Port.read_frame(_HANDSHAKE_REPLY_FRAME)  # Handshake byte and firmware version, in one read
+        self._setup(handshake)
+        self.Port.write_frame(_CLIENT_NAME_FRAME)  # Client name op + 'PYTHON' in ASCII
+        if isinstance(port_name, str):
+            self._stateCacheKey = port_name + '|' + str(self.firmware_version)
+        self._cachesState = adopt_state
+        if not (adopt_state and self._adoptState()):
+            self.set2DefaultParams()  # Initializes all parameters to default values
+            self.syncAllParams()  # Sets all parameters on the device to the current class parameters
+
+    def _setup(self, handshake):
+        """
+        Configures the object for the connected device's model, which is inferred from its firmware version.
+
+        Args:
+            handshake: The device's reply to the handshake op code, decoded with _HANDSHAKE_REPLY_FRAME
+
+        Raises:
+            PulsePalError: If the handshake reply is incorrect.
+        """
+        self._model = 0
+        self._dac_bitMax = 0
+        if handshake['response'] != self.HANDSHAKE_RESPONSE:
+            raise PulsePalError('Error: incorrect handshake returned.')
+        
+        # setup
+        firmware_version = int(handshake['firmwareVersion'])
+        if firmware_version < 20:  # Model can be inferred from firmware version. Model 1 spanned firmware v1-19.
+            self._model = 1
+            self._dac_bitMax = self.DAC_BITMAX_MODEL_1
+        else:
+            self._model = 2
+            self._dac_bitMax = self.DAC_BITMAX_MODEL_2
+        self._frames = _compileFrames(self._model)  # Reusable encoders for this model's op codes
+        self.firmware_version = firmware_version
+        if self.firmware_version == 20:
+            print("Notice: NOTE: A firmware update is available. It fixes a bug in Pulse Gated trigger mode when used with multiple inputs.")
+            print("To update, follow the instructions at https://sites.google.com/site/pulsepalwiki/updating-firmware")
+        self.outputParameterNames = list(OUTPUT_PARAMETER_NAMES)
+        self.triggerParameterNames = ['triggerMode']
+        # Parameter store (see PulsePalParameters): one record per channel, one float64 field per parameter
+        self._outputParams = np.zeros(4, dtype=OUTPUT_PARAMS_DTYPE)
+        self._triggerParams = np.zeros(2, dtype=TRIGGER_PARAMS_DTYPE)
+        self._outputParamMatrix = self._outputParams.view('float64').reshape(4, 17)  # The same store, channels x codes
+        self._triggerModes = self._triggerParams['triggerMode']
+        self._paramFieldViews = {name: ParameterField(self._outputParams[name]) for name in OUTPUT_PARAMETER_NAMES}
+        self._paramFieldViews['triggerMode'] = ParameterField(self._triggerModes)
+        self.writeBehind = False  # If True, changed parameters are synced to the device before each soft-trigger
+        self._syncedParams = None  # Parameters on the device as of the last sync, in device units. None if unknown.
+        self._syncedTriggerModes = None
+        self._transactionQueue = None  # Commands queued in the current transaction. None if not in a transaction.
+        self.autoResync = True  # If True, the connection is resynchronized after a command fails (see resync())
+        self._deadline = None  # Deadline for acknowledgements set by deadline() (time.monotonic()). None if not set.
+        self._desynchronized = False  # True if replies may be misaligned with commands, until resync() succeeds
+        self._unacknowledgedBytes = 0  # Size of the last write, until all of its acknowledgements are received
+        self._lastGoodProgram = None  # (params, trigger_modes) last known to be on the device, kept when a command fails
+        self._customTrainMessages = {}  # The last acknowledged upload to each custom train slot, by ID
+        self._pendingCustomTrains = set()  # Custom train slots with an upload that has not been acknowledged
+
+    def set2DefaultParams(self):
+        """
+           Returns all params to the defaults. This is called by the constructor, and may be
+           subsequently called by the user (e.g. before running a new experiment)
+        """
+        self.isBiphasic = [float('nan'), 0, 0, 0, 0]
+        self.phase1Voltage = [float('nan'), 5, 5, 5, 5]
+        self.phase2Voltage = [float('nan'), -5, -5, -5, -5]
+        self.restingVoltage = [float('nan'), 0, 0, 0, 0]
+        self.phase1Duration = [float('nan'), 0.001, 0.001, 0.001, 0.001]
+        self.interPhaseInterval = [float('nan'), 0.001, 0.001, 0.001, 0.001]
+        self.phase2Duration = [float('nan'), 0.001, 0.001, 0.001, 0.001]
+        self.interPulseInterval = [float('nan'), 0.01, 0.01, 0.01, 0.01]
+        self.burstDuration = [float('nan'), 0, 0, 0, 0]
+        self.interBurstInterval = [float('nan'), 0, 0, 0, 0]
+        self.pulseTrainDuration = [float('nan'), 1, 1, 1, 1]
+        self.pulseTrainDelay = [float('nan'), 0, 0, 0, 0]
+        self.linkTriggerChannel1 = [float('nan'), 1, 1, 1, 1]
+        self.linkTriggerChannel2 = [float('nan'), 0, 0, 0, 0]
+        self.customTrainID = [float('nan'), 0, 0, 0, 0]
+        self.customTrainTarget = [float('nan'), 0, 0, 0, 0]
+        self.customTrainLoop = [float('nan'), 0, 0, 0, 0]
+        self.triggerMode = [float('nan'), 0, 0]
+
+    def outputChannel(self, channel):
+        """
+        Returns a view of every parameter of an output channel, as attributes. Setting an attribute sets the parameter
+        field, like assigning to its list (e.g. myPulsePal.outputChannel(2).phase1Voltage = 5 is the same as
+        myPulsePal.phase1Voltage[2] = 5). Call syncAllParams() to send changes to the device.
+
+        Args:
+            channel (int): The output channel (1-4)
+
+        Returns:
+            PulsePalParameters.ChannelParameters: The channel's parameters
+        """
+        if channel not in range(1, 5):
+            raise PulsePalError('Error: ' + str(channel) + ' is not an output channel (1-4).')
+        return ChannelParameters(self._outputParams, channel - 1)
+
+    def triggerChannel(self, channel):
+        """
+        Returns a view of the parameters of a trigger channel (1-2), as attributes. See outputChannel().
+        """
+        if channel not in range(1, 3):
+            raise PulsePalError('Error: ' + str(channel) + ' is not a trigger channel (1-2).')
+        return ChannelParameters(self._triggerParams, channel - 1)
+
+    def parameterMatrix(self):
+        """
+        Returns a copy of the output channel parameter fields as a matrix, with one row per output channel and one
+        column per parameter, in the order of self.outputParameterNames. Units: Voltage (if volts), Seconds (if time),
+        Integer (if item)
+        """
+        return self._outputParamMatrix.copy()
+
+    def setParameterMatrix(self, matrix, trigger_modes=None):
+        """
+        Sets the parameter fields of all output channels at once, like the ParameterMatrix of the MATLAB
+        ProgramPulsePal(). Call syncAllParams() to send them to the device.
+
+        Args:
+            matrix (array-like): Parameter values with shape (4, 17): one row per output channel, one column per
+                                 parameter, in the order of self.outputParameterNames (see parameterMatrix())
+            trigger_modes (array-like): The mode of each trigger channel. None to leave them unchanged.
+        """
+        matrix = np.asarray(matrix, dtype='float64')
+        if matrix.shape != self._outputParamMatrix.shape:
+            raise PulsePalError('Error: the parameter matrix must have one row per output channel and one column per '
+                                'parameter (shape (4, 17)), not shape ' + str(matrix.shape) + '.')
+        self._outputParamMatrix[:] = matrix
+        if trigger_modes is not None:
+            self._triggerModes[:] = trigger_modes
+
+    @_traced
+    def setFixedVoltage(self, channel, voltage):
+        """
+        Sets a fixed voltage for the specified output channel.
+
+        Args:
+            channel (int): The channel number to set (1-4)
+            voltage (float): The voltage level to set. Units = Volts.
+
+        Raises:
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        message = self._frames['fixedVoltage'].encode(channel=channel, voltage=self._volts2Bits(voltage))
+        self._transmit(message, 1, ('setFixedVoltage', (channel, voltage)))
+        
+    @_traced
+    def programOutputChannelParam(self, param_name, channel, value):
+        """
+        Programs a parameter for an output channel on the Pulse Pal device.
+
+        Args:
+            param_name (str): The name of the parameter to program. Names are given above in self.outputParameterNames.
+            channel (int): The output channel number to program the parameter for (1-4)
+            value: The value to set for the parameter. Units: Voltage (if volts), Seconds (if time), Integer (if item)
+
+        Raises:
+            PulsePalValidationError: If the value or channel is invalid. Nothing is sent.
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        original_value = value
+        if isinstance(param_name, str):
+            param_code = self.outputParameterNames.index(param_name)+1
+        else:
+            param_code = param_name
+        _raiseViolations(validateParam(param_code, channel, value, self._dac_bitMax, self.CYCLE_FREQUENCY))
+        if 2 <= param_code <= 3 or param_code == 17:
+            value = self._volts2Bits(value)
+        elif 4 <= param_code <= 11:
+            value = int(self._seconds2Cycles(value))
+        self._writeParam(param_code, channel, value, ('programOutputChannelParam', (param_name, channel, original_value)),
+                         lambda: self._updateOutputParamField(param_code, channel, original_value))
+
+    def _updateOutputParamField(self, param_code, channel, original_value):
+        """
+        Updates the PulsePal object's parameter field for an output channel parameter after it is programmed.
+        """
+        self._outputParamMatrix[channel - 1, param_code - 1] = original_value
+
+    @_traced
+    def programTriggerChannelParam(self, param_name, channel, value):
+        """
+        Programs a parameter for the trigger channel on the Pulse Pal device.
+
+        Args:
+            param_name (str): The name of the parameter to program. Names are given above in self.triggerParameterNames.
+            channel (int): The trigger channel number to program the parameter for (1-2)
+            value: The value to set for the parameter.
+
+        Raises:
+            PulsePalValidationError: If the value or channel is invalid. Nothing is sent.
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        original_value = value
+        if isinstance(param_name, str):
+            param_code = self.triggerParameterNames.index(param_name)+128
+        else:
+            param_code = param_name
+        _raiseViolations(validateParam(param_code, channel, value, self._dac_bitMax, self.CYCLE_FREQUENCY))
+        self._writeParam(param_code, channel, value, ('programTriggerChannelParam', (param_name, channel, value)),
+                         lambda: self._updateTriggerParamField(param_code, channel, original_value))
+
+    def _updateTriggerParamField(self, param_code, channel, original_value):
+        """
+        Updates the PulsePal object's parameter field for a trigger channel parameter after it is programmed.
+        """
+        if param_code == 128:
+            self._triggerModes[channel - 1] = original_value
+
+    @_traced
+    def syncAllParams(self, force_full=False):
+        """
+        Synchronizes all current parameters of the PulsePalObject to the device.
+        Only parameters that changed since the last sync are sent. Depending on how many changed, they are sent as
+        single-parameter writes (in one write, with one wait for their acknowledgements) or as one full program,
+        whichever is shorter.
+
+        Args:
+            force_full (bool): If True, the full program is sent even if the device is thought to be up to date.
+                               Use this if the device's parameters may have changed outside of this object.
+
+        Raises:
+            PulsePalValidationError: If any parameter is invalid (see validateProgram()). Nothing is sent.
+            PulsePalError: If the device does not acknowledge the synchronization command.
+        """
+        self._syncParams(force_full)
+
+    def validateProgram(self, custom_trains=None, voltage_tolerance=None):
+        """
+        Checks the current parameters of all channels, and optionally custom trains, without sending anything.
+        Parameters are also checked by syncAllParams(), and custom trains by sendCustomPulseTrain() and
+        sendCustomWaveform(), which raise a PulsePalValidationError listing every violation.
+
+        Args:
+            custom_trains (dict): Custom trains to check, by ID (1-2). Each is a (pulse_times, pulse_voltages) tuple,
+                                  as passed to sendCustomPulseTrain().
+            voltage_tolerance (float): If given, voltages the DAC cannot produce to within this tolerance are
+                                       reported. Units = volts.
+
+        Returns:
+            list of PulsePalValidation.Violation: Every violation found. Empty if the program is valid.
+        """
+        violations = validateParams(self._paramFields(), self._triggerModes, self._dac_bitMax,
+                                    self.CYCLE_FREQUENCY, voltage_tolerance)
+        for custom_train_id, (pulse_times, pulse_voltages) in sorted((custom_trains or {}).items()):
+            violations.extend(validateCustomTrain(custom_train_id, pulse_times, pulse_voltages, self._dac_bitMax,
+                                                  self.CYCLE_FREQUENCY, voltage_tolerance))
+        return violations
+
+    @_traced
+    def applyProgram(self, program):
+        """
+        Applies a PulsePalProgram. Its precompiled full program (op 73) and custom train uploads are sent in one write,
+        and the parameter fields are set to the program's values once they are acknowledged. Nothing is converted or
+        encoded, so switching between prepared programs costs one write and one acknowledgement check.
+
+        Args:
+            program (PulsePalProgram): The program. It is compiled for this device's model on first use, and the
+                                       compiled bytes are reused after that (see PulsePalProgram.compile()).
+
+        Raises:
+            PulsePalValidationError: If the program is invalid on this device's model. Nothing is sent.
+            PulsePalError: If the device does not acknowledge the program.
+        """
+        compiled = program.compile(self._model)
+        self._pendingCustomTrains.update(compiled.customTrainMessages)
+
+        def program_acknowledged():
+            self._outputParamMatrix[:] = compiled.fieldMatrix
+            self._triggerModes[:] = compiled.fieldTriggerModes
+            self._setSyncedProgram(compiled.params.copy(), compiled.triggerModes.copy())
+            self._customTrainMessages.update(compiled.customTrainMessages)
+            self._pendingCustomTrains.difference_update(compiled.customTrainMessages)
+        self._transmit(compiled.message, 1 + len(compiled.customTrainMessages), ('applyProgram', ()),
+                       program_acknowledged)
+
+    def _syncParams(self, force_full):
+        """
+        Sends parameters that changed since the last sync (or all parameters, if force_full is True). See syncAllParams()
+        """
+        _raiseViolations(validateParams(self._paramFields(), self._triggerModes, self._dac_bitMax,
+                                        self.CYCLE_FREQUENCY))
+        params, trigger_modes = self._programImage()
+        if force_full or self._syncedParams is None:
+            self._writeProgram(params, trigger_modes)
+        else:
+            changed_channels, changed_params = np.nonzero(params != self._syncedParams)
+            changed_triggers = np.flatnonzero(trigger_modes != self._syncedTriggerModes)
+            # The single-parameter writes are sent together, so their acknowledgements cost one round trip
+            n_round_trips = min(len(changed_params) + len(changed_triggers), 1)
+            param_bytes = (sum(self._paramFrame(code+1).size() for code in changed_params) +
+                           self._frames['byteParam'].size()*len(changed_triggers))
+            param_cost = param_bytes + n_round_trips*self.SYNC_ROUND_TRIP_COST
+            program_cost = self._frames['program'].size() + self.SYNC_ROUND_TRIP_COST
+            if param_cost <= program_cost:
+                with PulsePalObject.transaction(self):  # Joins the caller's transaction, if any
+                    for channel, code in zip(changed_channels, changed_params):
+                        self._writeParam(code+1, channel+1, params[channel, code], ('syncAllParams', ()))
+                    for channel in changed_triggers:
+                        self._writeParam(128, channel+1, trigger_modes[channel], ('syncAllParams', ()))
+            else:
+                self._writeProgram(params, trigger_modes)
+
+    def _programImage(self):
+        """
+        Converts the current parameter fields to device units.
+
+        Returns:
+            tuple: (params, trigger_modes). params is an int64 array with one row per output channel and one
+                   column per parameter code (column 0 = code 1, see self.outputParameterNames).
+                   trigger_modes is an int64 array with the trigger mode of each trigger channel.
+        """
+        return _convertProgram(self._paramFields(), self._triggerModes, self._dac_bitMax, self.CYCLE_FREQUENCY)
+
+    def _paramFields(self):
+        """
+        Returns the current output channel parameter fields as a float64 array, with one row per channel and one
+        column per parameter code. Units: Voltage (if volts), Seconds (if time), Integer (if item)
+        """
+        return self._outputParamMatrix.copy()
+
+    def _writeProgram(self, params, trigger_modes):
+        """
+        Sends a full program (op 73) to the device.
+
+        Args:
+            params (ndarray): Output channel parameters in device units, as returned by _programImage()
+            trigger_modes (ndarray): Trigger channel modes, as returned by _programImage()
+
+        Raises:
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        self._transmit(self._programMessage(params, trigger_modes), 1, ('syncAllParams', ()),
+                       lambda: self._setSyncedProgram(params, trigger_modes))
+
+    def _programMessage(self, params, trigger_modes):
+        """
+        Encodes a full program (op 73). See _writeProgram().
+        """
+        return _encodeProgram(self._frames, self._model, params, trigger_modes)
+
+    def _setSyncedProgram(self, params, trigger_modes):
+        """
+        Records the program on the device after a full program is acknowledged.
+        """
+        self._syncedParams = params
+        self._syncedTriggerModes = trigger_modes
+
+    def _writeParam(self, param_code, channel, value, command, on_ack=None):
+        """
+        Sends a single parameter (op 74) to the device, and updates the record of synced parameters.
+
+        Args:
+            param_code (int): The parameter code (1-17 for output channel params, 128 for trigger mode)
+            channel (int): The output or trigger channel to program
+            value (int): The parameter value in device units (cycles, DAC bits or byte value)
+            command (tuple): The public method sending the parameter and its arguments (for error messages)
+            on_ack (callable): Called after the device acknowledges the parameter
+
+        Raises:
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        message = self._paramFrame(param_code).encode(param=param_code, channel=channel, value=value)
+
+        def param_acknowledged():
+            # Update the record of parameters on the device
+            if param_code == 128:
+                if self._syncedTriggerModes is not None:
+                    self._syncedTriggerModes[channel-1] = value
+            elif self._syncedParams is not None:
+                self._syncedParams[channel-1, param_code-1] = value
+            if on_ack is not None:
+                on_ack()
+        self._transmit(message, 1, command, param_acknowledged)
+
+    def _paramFrame(self, param_code):
+        """
+        Returns the frame used to program a single parameter with op 74. The frame depends on the parameter's type.
+        """
+        if 2 <= param_code <= 3 or param_code == 17:
+            return self._frames['voltageParam']
+        elif 4 <= param_code <= 11:
+            return self._frames['timeParam']
+        return self._frames['byteParam']
+
+    @_traced
+    def sendCustomPulseTrain(self, custom_train_id, pulse_times, pulse_voltages):
+        """
+        Sends a custom pulse train to the Pulse Pal device.
+
+        Args:
+            custom_train_id (int): The ID of the custom train to send (1-2)
+            pulse_times (list or ndarray of float): The times at which each pulse should occur. Units = seconds.
+            pulse_voltages (list or ndarray of float): The voltages for each pulse. Units = volts.
+
+        Raises:
+            PulsePalValidationError: If the custom train is invalid (see PulsePalValidation.validateCustomTrain()).
+                                     Nothing is sent.
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        _raiseViolations(validateCustomTrain(custom_train_id, pulse_times, pulse_voltages, self._dac_bitMax,
+                                             self.CYCLE_FREQUENCY))
+        message = _encodeCustomTrain(self._frames, custom_train_id, pulse_times, pulse_voltages, self._dac_bitMax,
+                                     self.CYCLE_FREQUENCY)
+        self._transmitCustomTrain(custom_train_id, message, ('sendCustomPulseTrain', (custom_train_id,)))
+        
+    @_traced
+    def sendCustomWaveform(self, custom_train_id, pulse_width, pulse_voltages, compact=False):  # For custom pulse trains with pulse times = pulse width
+        """
+        Sends a custom waveform to the Pulse Pal device.
+        To play it, set phase1Duration of the output channel to the returned phase1Duration (pulse_width, unless
+        compacted).
+
+        Args:
+            custom_train_id (int): The ID of the custom waveform train to send (1-2)
+            pulse_width (float): The width of each pulse in the waveform. Units = seconds.
+            pulse_voltages (list or ndarray of float): The voltages for each pulse in the waveform. Units = volts.
+            compact (bool): If True, runs of samples with the same DAC value are merged into single pulses, with a
+                            longer phase1Duration (see PulsePalConversion.compactWaveform()). The output is the same.
+                            One pulse per sample is sent if there are no runs to merge.
+
+        Returns:
+            WaveformUpload: The number of pulses sent, the phase1Duration to play them, and the bytes saved.
+
+        Raises:
+            PulsePalValidationError: If the waveform is invalid (see PulsePalValidation.validateCustomWaveform()).
+                                     Nothing is sent.
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        _raiseViolations(validateCustomWaveform(custom_train_id, pulse_width, pulse_voltages, self._dac_bitMax,
+                                                self.CYCLE_FREQUENCY))
+        message, upload = _encodeCustomWaveform(self._frames, custom_train_id, pulse_width, pulse_voltages,
+                                                self._dac_bitMax, self.CYCLE_FREQUENCY, compact)
+        self._transmitCustomTrain(custom_train_id, message, ('sendCustomWaveform', (custom_train_id, pulse_width)))
+        return upload
+
+    def _transmitCustomTrain(self, custom_train_id, message, command):
+        """
+        Sends a custom train upload, and keeps a copy once it is acknowledged, so that resync() can restore the slot
+        if a later upload to it fails.
+        """
+        message = bytes(message)
+        self._pendingCustomTrains.add(custom_train_id)
+
+        def upload_acknowledged():
+            self._customTrainMessages[custom_train_id] = message
+            self._pendingCustomTrains.discard(custom_train_id)
+        self._transmit(message, 1, command, upload_acknowledged)
+
+    @_traced
+    def setContinuousLoop(self, channel, state):
+        """
+        Sets the continuous loop state for a specified output channel.
+
+        Args:
+            channel (int): The output channel number to set the continuous loop state (1-4)
+            state (int): The state to set for the continuous loop (1 for on, 0 for off).
+
+        Raises:
+            PulsePalError: If the device does not acknowledge the command.
+        """
+        message = self._frames['continuousLoop'].encode(channel=channel, state=state)
+        self._transmit(message, 1, ('setContinuousLoop', (channel, state)))
+
+    @_traced
+    def triggerOutputChannels(self, channel1, channel2, channel3, channel4):
+        """
+        Triggers the output channels on the Pulse Pal device.
+        If self.writeBehind is True, parameters changed since the last sync are sent to the device first.
+        The message for each combination of channels is encoded in advance. Outside a transaction, and when not
+        tracing, it is written directly; the device does not reply to soft-triggers.
+
+        Args:
+            channel1 (int): 1 to trigger Ch1, 0 if not
+            channel2 (int): 1 to trigger Ch2, 0 if not
+            channel3 (int): 1 to trigger Ch3, 0 if not
+            channel4 (int): 1 to trigger Ch4, 0 if not
+        """
+        if self.writeBehind:
+            self._syncParams(False)  # Flush parameters changed since the last sync
+        trigger_byte = (1*channel1) + (2*channel2) + (4*channel3) + (8*channel4)
+        if not 0 <= trigger_byte < 16:
+            raise PulsePalError('Error: triggerOutputChannels() takes 1 (trigger) or 0 for each channel.')
+        message = _TRIGGER_MESSAGES[trigger_byte]
+        if self._transactionQueue is None and self.tracer is None:
+            timer = self.triggerTimer
+            if timer is None:
+                self.Port.write_bytes(message)
+            else:
+                start_time = time.perf_counter()
+                self.Port.write_bytes(message)
+                timer.record(start_time, time.perf_counter(), trigger_byte)
+            return
+        self._transmit(message, 0, ('triggerOutputChannels', (channel1, channel2, channel3, channel4)))
+
+    @_traced
+    def abortPulseTrains(self):
+        """
+        Aborts all pulse trains currently being output by the Pulse Pal device.
+        Like soft-triggers, the message is encoded in advance and written directly outside a transaction.
+        """
+        if self._transactionQueue is None and self.tracer is None:
+            self.Port.write_bytes(_ABORT_MESSAGE)
+            return
+        self._transmit(_ABORT_MESSAGE, 0, ('abortPulseTrains', ()))
+
+    @_traced
+    def saveSettingsFile(self, file_name):
+        """
+        Saves the device's parameters to a settings file on its microSD card (Pulse Pal 2 only). A file with the same
+        name is overwritten. The file becomes the current settings file, which the device loads when it starts.
+        Changed parameter fields are synced to the device first. Custom trains are not saved in settings files.
+
+        Args:
+            file_name (str): The file name, with an extension (e.g. 'session1.pps')
+        """
+        name_bytes = self._settingsFileName(file_name)
+        self.syncAllParams()
+        message = self._frames['settingsFile'].encode(settingsOp=1, nameLength=len(name_bytes),
+                                                      fileName=np.frombuffer(name_bytes, 'uint8'))
+        self._transmit(message, 0, ('saveSettingsFile', (file_name,)))
+
+    @_traced
+    def loadSettingsFile(self, file_name):
+        """
+        Loads a settings file from the device's microSD card (Pulse Pal 2 only), and sets the parameter fields to the
+        loaded program. Switching between prepared programs this way sends a short message instead of a full program.
+        Custom trains are not stored in settings files, so custom train slots keep their last upload.
+        If the file does not exist or is not valid, the firmware loads its default parameters instead, and saves them
+        to a file with this name. The parameter fields are then set to the firmware's defaults, and an error is raised.
+
+        Args:
+            file_name (str): The file name, with an extension (e.g. 'session1.pps')
+
+        Raises:
+            PulsePalError: If the file could not be loaded, or if called inside a transaction (the loaded program
+                           is read before the method returns).
+        """
+        name_bytes = self._settingsFileName(file_name)
+        self._checkRequestAllowed('loadSettingsFile')
+        message = self._frames['settingsFile'].encode(settingsOp=2, nameLength=len(name_bytes),
+                                                      fileName=np.frombuffer(name_bytes, 'uint8'))
+        try:
+            reply = self._request(message, LOAD_REPLY_SIZE, 'loadSettingsFile', self.SD_LOAD_TIMEOUT)
+        except ArCOMError:
+            self.Port.drain_input(self.RESYNC_QUIET_TIME)  # Discards the rest of a reply that arrived late
+            self._setProgramFields(*firmwareDefaults())
+            raise PulsePalError('Error: Pulse Pal could not load settings file ' + file_name + '. It loaded its '
+                                'default parameters instead, and saved them to ' + file_name + '.') from None
+        self._setProgramFields(*decodeLoadReply(reply))
+
+    @_traced
+    def deleteSettingsFile(self, file_name):
+        """
+        Deletes a settings file from the device's microSD card (Pulse Pal 2 only). The device's parameters are not
+        changed.
+
+        Args:
+            file_name (str): The file name, with an extension (e.g. 'session1.pps')
+        """
+        name_bytes = self._settingsFileName(file_name)
+        message = self._frames['settingsFile'].encode(settingsOp=3, nameLength=len(name_bytes),
+                                                      fileName=np.frombuffer(name_bytes, 'uint8'))
+        self._transmit(message, 0, ('deleteSettingsFile', (file_name,)))
+
+    @_traced
+    def readSettingsFile(self):
+        """
+        Reads the program in the device's current settings file (op 85, Pulse Pal 2 only), without changing the
+        parameter fields. The current file is the one last saved or loaded, so it does not include later changes.
+
+        Returns:
+            dict: The value of each parameter, as {param name: [nan, channel 1 value, ...]} like the parameter fields
+                  (e.g. settings['phase1Voltage'][2] is channel 2's phase 1 voltage), including 'triggerMode'.
+                  None if the file does not hold a valid program.
+
+        Raises:
+            PulsePalError: If called inside a transaction.
+        """
+        self._settingsFileName(None)
+        self._checkRequestAllowed('readSettingsFile')
+        program = self._readSettingsFile()
+        if program is None:
+            return None
+        return self._programFields(*program)
+
+    def exportSettingsFile(self, path):
+        """
+        Writes the current parameter fields to a local settings file, e.g. to copy to the device's microSD card.
+        The fields are not sent to the device.
+
+        Args:
+            path (str): The file to write
+
+        Raises:
+            PulsePalValidationError: If a parameter cannot be represented on the device.
+        """
+        self._settingsFileName(None)
+        _raiseViolations(self.validateProgram())
+        with open(path, 'wb') as settings_file:
+            settings_file.write(encodeSettingsFile(*self._programImage()))
+
+    def _settingsFileName(self, file_name):
+        """
+        Checks that the device has a microSD card, and encodes a settings file name (if not None) for op 90.
+        """
+        if self._model != 2:
+            raise PulsePalError('Error: Pulse Pal 1 does not have a microSD card for settings files.')
+        if file_name is None:
+            return None
+        try:
+            return checkFileName(file_name)
+        except ValueError as error:
+            raise PulsePalError(str(error)) from None
+
+    def _checkRequestAllowed(self, method_name):
+        """
+        Checks that a request with a reply that is read directly (not as an acknowledgement) can be sent now.
+        """
+        if self._transactionQueue is not None:
+            raise PulsePalError('Error: ' + method_name + '() reads a reply from the device, so it cannot be called '
+                                'inside a transaction.')
+        self._checkSync()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Batches commands to reduce USB round-trips. Inside the transaction, commands are queued instead of sent.
+        When the transaction ends, all queued commands are sent in a single write, and their acknowledgements are
+        collected together. Parameter fields are updated as each command is acknowledged.
+        If the block raises an exception, the queued commands are discarded. Nested transactions join the outer one.
+
+        Example:
+            with myPulsePal.transaction():
+                myPulsePal.programOutputChannelParam('phase1Voltage', 1, 5)
+                myPulsePal.programOutputChannelParam('phase1Duration', 1, 0.002)
+
+        Raises:
+            PulsePalError: If a command is not acknowledged. The error reports which command failed.
+        """
+        if self._transactionQueue is not None:
+            yield
+            return
+        self._transactionQueue = []
+        try:
+            yield
+            queue = self._transactionQueue
+        finally:
+            self._transactionQueue = None
+        self._sendQueue(queue)
+
+    def _sendQueue(self, queue):
+        """
+        Sends queued commands in a single write, then receives their acknowledgements in order.
+
+        Args:
+            queue (list): Queued commands, as (message, n_ack_bytes, command, on_ack) tuples (see _transmit)
+
+        Raises:
+            PulsePalTimeoutError, PulsePalNackError: If a command is not acknowledged. The error reports which
+                                                     command failed.
+            PulsePalDesyncError: If stray bytes are waiting in the input and autoResync is False, or resync fails.
+        """
+        if not queue:
+            return
+        expects_acks = any(command[1] > 0 for command in queue)
+        if expects_acks:
+            self._checkSync()
+        message_bytes = b''.join(command[0] for command in queue)
+        tracer, timer = self.tracer, self.triggerTimer
+        if tracer is not None or timer is not None:
+            write_start = time.perf_counter()
+        self.Port.write_bytes(message_bytes)
+        if tracer is not None or timer is not None:
+            write_end = time.perf_counter()
+        if timer is not None:
+            for message, _, command, _ in queue:
+                if command[0] == 'triggerOutputChannels':
+                    timer.record(write_start, write_end, message[2])
+        deadline = self._ackDeadline(len(message_bytes))
+        if expects_acks:
+            self._unacknowledgedBytes = len(message_bytes)
+        for i, (message, n_ack_bytes, command, on_ack) in enumerate(queue):
+            error_type, reply = None, None
+            if n_ack_bytes > 0:
+                error_type, reply = self._receiveAck(n_ack_bytes, deadline)
+            if tracer is not None:
+                tracer.messageSent(command[0], message, None, 0, write_end - write_start,
+                                   time.perf_counter() - write_end if n_ack_bytes > 0 else 0,
+                                   0 if reply is None else len(reply), _traceStatus(error_type))
+            if error_type is not None:
+                self._commandFailed(error_type, 'Error: Pulse Pal ' + _describeAckFailure(error_type, reply) +
+                                    ' command ' + str(i+1) + ' of ' + str(len(queue)) + ' in the transaction: ' +
+                                    _describeCommand(message, command) +
+                                    '. Commands after it may not have been applied.')
+            if on_ack is not None:
+                on_ack()
+        self._unacknowledgedBytes = 0
+
+    def _transmit(self, message, n_ack_bytes, command, on_ack=None):
+        """
+        Sends a message to the device and receives its acknowledgement.
+        Inside a transaction, the message is queued and sent when the transaction ends.
+
+        Args:
+            message (bytes-like): The encoded message
+            n_ack_bytes (int): The number of acknowledgement bytes the device returns for this message (0 or 1)
+            command (tuple): The public method sending the message and its arguments (for error messages)
+            on_ack (callable): Called after the device acknowledges the message (or after it is sent, if n_ack_bytes is 0)
+
+        Raises:
+            PulsePalTimeoutError: If the acknowledgement does not arrive before the deadline (see _ackDeadline()).
+            PulsePalNackError: If the device replies with something other than the acknowledgement byte.
+            PulsePalDesyncError: If stray bytes are waiting in the input and autoResync is False, or resync fails.
+        """
+        tracer = self.tracer
+        if tracer is not None:
+            start_time, encode_time = self._traceEncodeTime()
+        if self._transactionQueue is not None:
+            message = bytes(message)
+            self._transactionQueue.append((message, n_ack_bytes, command, on_ack))
+            if tracer is not None:
+                tracer.messageQueued(message, start_time, encode_time)
+            return
+        if n_ack_bytes > 0:
+            self._checkSync()
+        if tracer is not None:
+            write_start = time.perf_counter()
+        self.Port.write_bytes(message)
+        if tracer is not None:
+            write_end = time.perf_counter()
+            if self.triggerTimer is not None and command[0] == 'triggerOutputChannels':
+                self.triggerTimer.record(write_start, write_end, message[2])
+            if n_ack_bytes == 0:
+                tracer.messageSent(command[0], message, start_time, encode_time, write_end - write_start, 0, 0)
+        if n_ack_bytes > 0:
+            self._unacknowledgedBytes = len(message)
+            error_type, reply = self._receiveAck(n_ack_bytes, self._ackDeadline(len(message)))
+            if tracer is not None:
+                tracer.messageSent(command[0], message, start_time, encode_time, write_end - write_start,
+                                   time.perf_counter() - write_end, 0 if reply is None else len(reply),
+                                   _traceStatus(error_type))
+            if error_type is not None:
+                self._commandFailed(error_type, 'Error: Pulse Pal ' + _describeAckFailure(error_type, reply) +
+                                    ' a call to ' + command[0] + '().')
+            self._unacknowledgedBytes = 0
+        if on_ack is not None:
+            on_ack()
+
+    def _request(self, message, n_reply_bytes, method, timeout=None):
+        """
+        Writes a message that the device answers with a reply (e.g. a settings file), and reads the reply.
+        While tracing, the exchange is recorded like an acknowledged command.
+
+        Args:
+            message (bytes): The message
+            n_reply_bytes (int): The length of the reply
+            method (str): The public method sending the message (for the trace)
+            timeout (float): Seconds to wait for the reply. If None, the port's timeout is used
+
+        Returns:
+            ndarray: The reply, as uint8 values
+
+        Raises:
+            ArCOMError: If the reply does not arrive in time.
+        """
+        tracer = self.tracer
+        if tracer is None:
+            self.Port.write_bytes(message)
+            return self.Port.read(n_reply_bytes, 'uint8', timeout=timeout)
+        start_time, encode_time = self._traceEncodeTime()
+        write_start = time.perf_counter()
+        self.Port.write_bytes(message)
+        write_end = time.perf_counter()
+        try:
+            reply = self.Port.read(n_reply_bytes, 'uint8', timeout=timeout)
+        except ArCOMError:
+            tracer.messageSent(method, message, start_time, encode_time, write_end - write_start,
+                               time.perf_counter() - write_end, 0, 'timeout')
+            raise
+        tracer.messageSent(method, message, start_time, encode_time, write_end - write_start,
+                           time.perf_counter() - write_end, len(reply))
+        return reply
+
+    def _traceEncodeTime(self):
+        """
+        While tracing, returns the start time (time.perf_counter()) and encoding time of a message about to be sent,
+        measured from the start of the API call or the previous message of the same call.
+        """
+        now = time.perf_counter()
+        start_time = now if self._traceStart is None else self._traceStart
+        if self._traceStart is not None:
+            self._traceStart = now
+        return start_time, now - start_time
+
+    def _receiveAck(self, n_ack_bytes, deadline):
+        """
+        Receives acknowledgement bytes, waiting until the deadline (time.monotonic()).
+
+        Returns:
+            tuple: (error_type, reply). error_type is None if the acknowledgement arrived, PulsePalTimeoutError if it
+                   did not, or PulsePalNackError if other bytes arrived instead. reply is the bytes received.
+        """
+        try:
+            reply = self.Port.read(n_ack_bytes, 'uint8', timeout=max(deadline - time.monotonic(), 0))
+        except ArCOMError:
+            return PulsePalTimeoutError, None
+        if (reply != 1).any():  # The firmware acknowledges each command with 1
+            return PulsePalNackError, reply
+        return None, reply
+
+    def _ackDeadline(self, n_bytes_written):
+        """
+        Returns the time (time.monotonic()) by which the acknowledgements of a write must arrive: the deadline set by
+        deadline() if there is one, otherwise ACK_TIMEOUT after the write is expected to finish sending.
+        """
+        if self._deadline is not None:
+            return self._deadline
+        return time.monotonic() + self.ACK_TIMEOUT + n_bytes_written/self.LINK_THROUGHPUT
+
+    def _checkSync(self):
+        """
+        Checks that replies are aligned with commands before a command that expects one. Stray bytes in the input
+        (e.g. a late acknowledgement) would otherwise be read as its reply. If the stream is not aligned, it is
+        resynchronized if autoResync is True, or PulsePalDesyncError is raised.
+        """
+        if not self._desynchronized and self.Port.bytes_available() == 0:
+            return
+        if not self.autoResync:
+            raise PulsePalDesyncError('Error: replies from Pulse Pal are not aligned with commands (stray bytes were '
+                                      'received, or a command failed). Call resync() to recover.')
+        self.resync()
+
+    def _commandFailed(self, error_type, message):
+        """
+        Records that the device's state and the alignment of its replies are unknown after a failed command,
+        resynchronizes if autoResync is True, and raises the error.
+        """
+        if self._syncedParams is not None:
+            self._lastGoodProgram = (self._syncedParams.copy(), self._syncedTriggerModes.copy())
+        self._syncedParams = None  # The device's state is unknown after an unacknowledged command
+        self._syncedTriggerModes = None
+        self._desynchronized = True
+        if self.autoResync:
+            try:
+                self.resync()
+            except PulsePalDesyncError as resync_error:
+                raise error_type(message + ' ' + str(resync_error)) from resync_error
+            message += (' The connection was resynchronized and the last acknowledged parameters were restored. '
+                        'Retry the command to apply it.')
+        raise error_type(message)
+
+    def resync(self):
+        """
+        Recovers from a lost, late or corrupted reply without reconnecting. Called automatically after a failed
+        command if self.autoResync is True.
+        1. Zero bytes are sent to complete any message the device is still waiting for (e.g. if part of a write was
+           lost). The firmware discards zero bytes between messages.
+        2. Input is discarded until the device is quiet, and the device is handshaken (op 72) to realign replies.
+        3. The last program known to be on the device is sent again, with the last acknowledged upload to any custom
+           train slot whose latest upload was not acknowledged.
+        Fixed voltages (setFixedVoltage) and continuous loop states are not restored.
+
+        Raises:
+            PulsePalDesyncError: If the device does not reply to the handshake. If part of a message was lost, the
+                                 firmware may show "COMM. FAILURE!" and wait for a click of its joystick; click it,
+                                 then call resync() again.
+        """
+        self.Port.write_bytes(bytes(max(self._unacknowledgedBytes, self._frames['program'].size())))
+        for attempt in range(self.RESYNC_ATTEMPTS):
+            self.Port.drain_input(self.RESYNC_QUIET_TIME)
+            self.Port.write_frame(_HANDSHAKE_FRAME)
+            try:
+                reply = self.Port.read_frame(_HANDSHAKE_REPLY_FRAME, timeout=self.RESYNC_TIMEOUT)
+            except ArCOMError:
+                continue
+            if (reply['response'] == self.HANDSHAKE_RESPONSE and int(reply['firmwareVersion']) == self.firmware_version
+                    and self.Port.bytes_available() == 0):
+                break
+        else:
+            raise PulsePalDesyncError('Error: Pulse Pal did not reply to ' + str(self.RESYNC_ATTEMPTS) +
+                                      ' resynchronization handshakes. If it shows "COMM. FAILURE!", click its joystick '
+                                      'and call resync() again.')
+        self._desynchronized = False
+        self._unacknowledgedBytes = 0
+        # Restore the last known program, and custom train slots with a failed upload
+        if self._syncedParams is not None:
+            self._lastGoodProgram = (self._syncedParams.copy(), self._syncedTriggerModes.copy())
+        messages = []
+        if self._lastGoodProgram is not None:
+            messages.append(bytes(self._programMessage(*self._lastGoodProgram)))
+        messages += [self._customTrainMessages[custom_train_id] for custom_train_id in sorted(self._pendingCustomTrains)
+                     if custom_train_id in self._customTrainMessages]
+        if not messages:
+            return
+        message_bytes = b''.join(messages)
+        self.Port.write_bytes(message_bytes)
+        for _ in messages:
+            if self._receiveAck(1, self._ackDeadline(len(message_bytes)))[0] is not None:
+                self._desynchronized = True
+                raise PulsePalDesyncError('Error: Pulse Pal did not acknowledge the program restored by resync().')
+        if self._lastGoodProgram is not None:
+            self._setSyncedProgram(*self._lastGoodProgram)
+            self._lastGoodProgram = None
+        self._pendingCustomTrains.clear()
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """
+        Sets a deadline for the acknowledgements of commands sent inside the block, in place of ACK_TIMEOUT.
+        A command that is not acknowledged in time raises PulsePalTimeoutError. Nested deadlines cannot extend an
+        outer one. Note: if autoResync is True, resynchronizing after a failure can take longer than the deadline.
+
+        Example:
+            with myPulsePal.deadline(0.005):  # Each command in the block must be acknowledged within 5ms of entry
+                myPulsePal.programOutputChannelParam('phase1Voltage', 1, 5)
+
+        Args:
+            seconds (float): Time from entering the block until the deadline. Units = seconds.
+        """
+        outer_deadline = self._deadline
+        deadline = time.monotonic() + seconds
+        self._deadline = deadline if outer_deadline is None else min(deadline, outer_deadline)
+        try:
+            yield
+        finally:
+            self._deadline = outer_deadline
+
+    def _toDecimal(self, value):
+        """
+        Converts a value to a Decimal with a Pulse Pal's required precision.
+
+        Args:
+            value (float): The value to convert to Decimal.
+
+        Returns:
+            Decimal: The value converted to a Decimal with fixed precision (0.0000)
+        """
+        from decimal import Decimal  # Imported on first use, so that importing this module does not load it
+        return Decimal(value).quantize(Decimal('1.0000'))
+
+    def _volts2Bits(self, value):
+        """
+        Converts a voltage value in range -10V to +10V to its corresponding bit value for the 12-bit DAC.
+
+        Args:
+            value (float): The voltage value to convert.
+
+        Returns:
+            int: The bit value corresponding to the given voltage.
+        """
+        return math.ceil(((self._toDecimal(value) + 10) / self._toDecimal(20)) * self._dac_bitMax)
+
+    def _seconds2Cycles(self, value):
+        """
+        Converts a time value in seconds to the corresponding number of refresh cycles for the Pulse Pal device.
+
+        Args:
+            value (float): The time value in seconds to convert.
+
+        Returns:
+            Decimal: The number of cycles corresponding to the given time value.
+        """
+        return self._toDecimal(value)*self._toDecimal(self.CYCLE_FREQUENCY)
+
+    def startTrace(self, trace_path=None, hooks=()):
+        """
+        Starts recording each message sent to the device, with its timing (see PulsePalTrace).
+
+        Example:
+            tracer = myPulsePal.startTrace('session.trace')
+            myPulsePal.programOutputChannelParam('phase1Voltage', 1, 5)
+            print(myPulsePal.stats()['programOutputChannelParam'].meanAckTime)
+
+        Args:
+            trace_path (str): A binary trace file to write the records to (see PulsePalTrace.readTrace()). None for
+                              no file.
+            hooks (list): Functions called with each PulsePalTrace.CommandRecord as it is made
+
+        Returns:
+            PulsePalTracer: The tracer, which keeps the statistics. A trace already running is stopped first.
+        """
+        from .PulsePalTrace import PulsePalTracer  # Tracing is optional, so its module is imported on first use
+        self.stopTrace()
+        tracer = PulsePalTracer(trace_path, hooks)
+        tracer.attach(self.Port)
+        self.tracer = tracer
+        return tracer
+
+    def stopTrace(self):
+        """
+        Stops tracing and closes the trace file. Returns the tracer (None if not tracing), whose statistics remain
+        available.
+        """
+        tracer = self.tracer
+        if tracer is not None:
+            self.tracer = None
+            self._lastTracer = tracer
+            tracer.detach(self.Port)
+            tracer.close()
+        return tracer
+
+    def startTriggerTiming(self, capacity=65536):
+        """
+        Starts timing soft-triggers: the host time (time.perf_counter()) just before and just after the write of each
+        trigger is recorded, to measure trigger latency and jitter (see PulsePalTrace.PulsePalTriggerTimer). A trigger
+        sent in a transaction (or by a ThreadedPulsePalObject's I/O thread) is timed by the write that sends it with
+        the rest of the transaction. Timing adds two clock reads per trigger.
+
+        Example:
+            myPulsePal.startTriggerTiming()
+            for trial in range(1000):
+                myPulsePal.triggerOutputChannels(1, 0, 0, 0)
+                time.sleep(0.01)
+            print(myPulsePal.stopTriggerTiming().stats().jitter)
+
+        Args:
+            capacity (int): Triggers to allocate room for in advance
+
+        Returns:
+            PulsePalTriggerTimer: The timer, which keeps the timestamps. A timer already running is replaced.
+        """
+        from .PulsePalTrace import PulsePalTriggerTimer
+        self.triggerTimer = PulsePalTriggerTimer(capacity)
+        return self.triggerTimer
+
+    def stopTriggerTiming(self):
+        """
+        Stops timing soft-triggers. Returns the timer (None if not timing), whose timestamps remain available.
+        """
+        timer, self.triggerTimer = self.triggerTimer, None
+        return timer
+
+    def stats(self):
+        """
+        Returns latency and throughput statistics for each API method in the current (or last) trace, as
+        {method name: PulsePalTrace.MethodStats}. Empty if nothing was traced.
+        """
+        tracer = self.tracer if self.tracer is not None else self._lastTracer
+        if tracer is None:
+            return {}
+        return tracer.stats()
+
+    def disconnect(self, end_session=True):
+        """
+        Ends the session with the device (op 81) and closes the USB serial port. The object cannot be used afterwards.
+        This is called automatically if the object is deleted.
+
+        Args:
+            end_session (bool): If False, the port is closed without ending the session, so the device keeps its
+                                fixed voltages and ongoing pulse trains (op 81 stops them). The parameters are saved
+                                to the state cache, so a PulsePalObject created later with adopt_state=True adopts
+                                them. (Sessions created with adopt_state=True save them in either case.)
+        """
+        if self.Port is None:
+            return
+        if self._cachesState or not end_session:
+            self._saveCachedState()
+        if end_session:
+            self.Port.write_frame(_DISCONNECT_FRAME)
+        self.Port.close()
+        self.Port = None
+
+    def _adoptState(self):
+        """
+        Fills the parameter fields from the state cache, or the device's settings file, and records them as synced.
+        Returns True if the parameters were adopted.
+        """
+        state = self._takeCachedState()
+        if state is None and self._model == 2:
+            state = self._readSettingsFile()
+        if state is None:
+            return False
+        self._setProgramFields(*state)
+        return True
+
+    def _setProgramFields(self, params, trigger_modes):
+        """
+        Sets the parameter fields to a program on the device (in device units, as in _programImage()), and records
+        it as synced.
+        """
+        self._outputParamMatrix[:], self._triggerModes[:] = self._programMatrix(params, trigger_modes)
+        self._setSyncedProgram(params, trigger_modes)
+
+    def _programFields(self, params, trigger_modes):
+        """
+        Converts a program in device units (as in _programImage()) to parameter field values.
+
+        Returns:
+            dict: {param name: [nan, channel 1 value, ...]}, including 'triggerMode'
+        """
+        fields, trigger_fields = self._programMatrix(params, trigger_modes)
+        program_fields = {name: [float('nan')] + values
+                          for name, values in zip(self.outputParameterNames, fields.T.tolist())}
+        program_fields['triggerMode'] = [float('nan')] + trigger_fields.tolist()
+        return program_fields
+
+    def _programMatrix(self, params, trigger_modes):
+        """
+        Converts a program in device units (as in _programImage()) to user units, as float64 arrays laid out like
+        the parameter store: (fields, trigger_modes), with fields as channels x parameter codes.
+        """
+        fields = np.empty((4, 17), dtype='float64')
+        fields[:, _BYTE_PARAMS] = params[:, _BYTE_PARAMS]
+        fields[:, _TIME_PARAMS] = cycles2Seconds(params[:, _TIME_PARAMS], self.CYCLE_FREQUENCY)
+        fields[:, _VOLTAGE_PARAMS] = bits2Volts(params[:, _VOLTAGE_PARAMS], self._dac_bitMax)
+        return fields, np.asarray(trigger_modes, dtype='float64')
+
+    def _readSettingsFile(self):
+        """
+        Reads the device's current microSD settings file (op 85). Returns (params, trigger_modes) as in
+        _programImage(), or None if the file does not hold a valid program.
+        """
+        try:
+            params, trigger_modes = decodeSettingsFile(self._request(_SETTINGS_FILE_REQUEST_FRAME.encode(),
+                                                                     SETTINGS_FILE_SIZE - 1, 'readSettingsFile'))
+        except ArCOMError:
+            return None
+        if not isValidProgram(params, trigger_modes):
+            return None  # Not a valid program (e.g. no settings file was loaded)
+        return params, trigger_modes
+
+    def _takeCachedState(self):
+        """
+        Removes this device's entry from the state cache, and returns it as (params, trigger_modes), or None.
+        The entry is removed so that it cannot be adopted again if this session ends without saving a new one.
+        """
+        key = getattr(self, '_stateCacheKey', None)
+        if key is None or self.STATE_CACHE_PATH is None:
+            return None
+        try:
+            with _lockStateCache(self.STATE_CACHE_PATH):
+                cache = _loadStateCache(self.STATE_CACHE_PATH)
+                entry = cache.pop(key, None)
+                if entry is None:
+                    return None
+                _saveStateCache(self.STATE_CACHE_PATH, cache)
+            params = np.array(entry['params'], dtype='int64').reshape(4, 17)
+            trigger_modes = np.array(entry['triggerModes'], dtype='int64').reshape(2)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return params, trigger_modes
+
+    def _saveCachedState(self):
+        """
+        Saves the parameters on the device to the state cache, if they are known.
+        """
+        key = getattr(self, '_stateCacheKey', None)
+        if key is None or self.STATE_CACHE_PATH is None or self._syncedParams is None:
+            return
+        try:
+            with _lockStateCache(self.STATE_CACHE_PATH):  # Other processes may update other devices' entries
+                cache = _loadStateCache(self.STATE_CACHE_PATH)
+                cache[key] = {'params': self._syncedParams.tolist(),
+                              'triggerModes': self._syncedTriggerModes.tolist()}
+                _saveStateCache(self.STATE_CACHE_PATH, cache)
+        except Exception:  # Includes errors at interpreter shutdown, when this is called from __del__
+            pass  # The cache is an optimization. A session that cannot save it is not an error.
+
+    def __del__(self):
+        """
+        Destructor method that ensures the Pulse Pal connection is closed if the object is deleted.
+        """
+        if getattr(self, 'Port', None) is not None:
+            try:
+                PulsePalObject.disconnect(self)
+            except Exception:  # The device or interpreter may already be gone; errors can't be raised from here
+                pass
+
+
+def _compileFrames(model):
+    """
+    Compiles the binary frame of each Pulse Pal op code with model-specific fields or variable content.
+    Each PulsePalObject compiles its own frames, since frames are encoded in place in a preallocated buffer.
+
+    Args:
+        model (int): The Pulse Pal model (1 or 2). Pulse Pal 1 uses 8-bit voltages, Pulse Pal 2 uses 16-bit voltages.
+
+    Returns:
+        dict: The compiled frames (ArComFrame), indexed by name
+    """
+    op_menu = ('opMenu', 'uint8', 1, PulsePalObject.OP_MENU_BYTE)
+    voltage_type = 'uint8' if model == 1 else 'uint16'
+    if model == 1:
+        program = ArComFrame(op_menu, ('opCode', 'uint8', 1, 73), ('times', 'uint32', 32), ('byteParams', 'uint8', 28),
+                             ('triggerLinks', 'uint8', 8), ('triggerModes', 'uint8', 2))
+        custom_train_header = (op_menu, ('opCode', 'uint8'), ('packetCorrection', 'uint8', 1, 0))
+    else:
+        program = ArComFrame(op_menu, ('opCode', 'uint8', 1, 73), ('times', 'uint32', 32), ('voltages', 'uint16', 12),
+                             ('byteParams', 'uint8', 16), ('triggerLinks', 'uint8', 8), ('triggerModes', 'uint8', 2))
+        custom_train_header = (op_menu, ('opCode', 'uint8'))
+    param_header = (op_menu, ('opCode', 'uint8', 1, 74), ('param', 'uint8'), ('channel', 'uint8'))
+    return {
+        'program': program,
+        'byteParam': ArComFrame(*param_header, ('value', 'uint8')),
+        'voltageParam': ArComFrame(*param_header, ('value', voltage_type)),
+        'timeParam': ArComFrame(*param_header, ('value', 'uint32')),
+        'customTrain': ArComFrame(*custom_train_header, ('nPulses', 'uint32'), ('pulseTimes', 'uint32', None),
+                                  ('pulseVoltages', voltage_type, None)),
+        'fixedVoltage': ArComFrame(op_menu, ('opCode', 'uint8', 1, 79), ('channel', 'uint8'), ('voltage', voltage_type)),
+        'continuousLoop': ArComFrame(op_menu, ('opCode', 'uint8', 1, 82), ('channel', 'uint8'), ('state', 'uint8')),
+        'settingsFile': ArComFrame(op_menu, ('opCode', 'uint8', 1, 90),
+                                   ('settingsOp', 'uint8'),  # 1 = save, 2 = load, 3 = delete
+                                   ('nameLength', 'uint8'), ('fileName', 'uint8', None)),
+    }
+
+
+def _convertProgram(fields, trigger_modes, dac_bitmax, cycle_frequency):
+    """
+    Converts output channel parameter fields (as returned by PulsePalObject._paramFields()) and trigger modes to
+    device units. See PulsePalObject._programImage().
+    """
+    params = np.empty((4, 17), dtype='int64')
+    params[:, _BYTE_PARAMS] = fields[:, _BYTE_PARAMS]
+    params[:, _TIME_PARAMS] = seconds2Cycles(fields[:, _TIME_PARAMS], cycle_frequency)
+    params[:, _VOLTAGE_PARAMS] = volts2Bits(fields[:, _VOLTAGE_PARAMS], dac_bitmax)
+    return params, np.array(trigger_modes, dtype='int64')
+
+
+def _encodeProgram(frames, model, params, trigger_modes):
+    """
+    Encodes a full program (op 73) in device units with a model's frames (see _compileFrames()).
+    """
+    program = {'times': params[:, _TIME_PARAMS].ravel(),  # 8 time params per channel, channel-major
+               'triggerLinks': params[:, [11, 12]].T.ravel(),  # Trigger channel 1 links to ch1-4, then trigger channel 2
+               'triggerModes': trigger_modes}
+    if model == 1:  # Pulse Pal v1 has 8-bit voltages, sent with the other 8-bit params
+        program['byteParams'] = params[:, [0, 1, 2, 13, 14, 15, 16]].ravel()
+    else:
+        program['voltages'] = params[:, _VOLTAGE_PARAMS].ravel()
+        program['byteParams'] = params[:, [0, 13, 14, 15]].ravel()
+    return frames['program'].encode(**program)
+
+
+def _encodeCustomTrain(frames, custom_train_id, pulse_times, pulse_voltages, dac_bitmax, cycle_frequency):
+    """
+    Encodes a custom train upload (op 75 or 76) with a model's frames (see _compileFrames()). Times are in seconds and
+    voltages in volts.
+    """
+    n_pulses = len(pulse_times)
+    pulse_times = seconds2Cycles(pulse_times, cycle_frequency)  # Convert seconds to multiples of update cycle
+    pulse_voltages = volts2Bits(pulse_voltages, dac_bitmax)
+    op_code = custom_train_id + 74  # Serial op codes are 75 if custom train 1, 76 if 2
+    return frames['customTrain'].encode(opCode=op_code, nPulses=n_pulses, pulseTimes=pulse_times,
+                                        pulseVoltages=pulse_voltages)
+
+
+def _encodeCustomWaveform(frames, custom_train_id, pulse_width, pulse_voltages, dac_bitmax, cycle_frequency, compact):
+    """
+    Encodes a custom waveform upload (op 75 or 76) with a model's frames (see _compileFrames()), optionally compacted.
+    See PulsePalObject.sendCustomWaveform().
+
+    Returns:
+        tuple: (message, WaveformUpload)
+    """
+    n_samples = len(pulse_voltages)
+    pulse_width_cycles = seconds2Cycles(pulse_width, cycle_frequency)  # Convert seconds to multiples of update cycle
+    pulse_voltages = volts2Bits(pulse_voltages, dac_bitmax)
+    phase1_duration = pulse_width_cycles
+    pulse_times = None
+    if compact:
+        compact_times, compact_voltages, compact_duration = compactWaveform(int(pulse_width_cycles), pulse_voltages)
+        if compact_times.size < n_samples:
+            pulse_times, pulse_voltages, phase1_duration = compact_times, compact_voltages, compact_duration
+    if pulse_times is None:
+        pulse_times = np.arange(n_samples, dtype='uint32')*pulse_width_cycles  # Consecutive pulses
+    n_pulses = len(pulse_times)
+    op_code = custom_train_id + 74  # 75 if custom train 1, 76 if 2
+    message = frames['customTrain'].encode(opCode=op_code, nPulses=n_pulses, pulseTimes=pulse_times,
+                                           pulseVoltages=pulse_voltages)
+    bytes_per_pulse = 4 + pulse_voltages.itemsize  # uint32 time + DAC value
+    return message, WaveformUpload(n_samples, n_pulses, int(phase1_duration)/cycle_frequency,
+                                   n_samples/n_pulses if n_pulses else 1.0, (n_samples - n_pulses)*bytes_per_pulse)
+
+
+# Frames with fixed content are shared by all PulsePalObjects
+_HANDSHAKE_FRAME = ArComFrame(('opCode', 'uint8', 2, (PulsePalObject.OP_MENU_BYTE, PulsePalObject.HANDSHAKE_OPCODE)))
+_HANDSHAKE_REPLY_FRAME = ArComFrame(('response', 'uint8'), ('firmwareVersion', 'uint32'))
+_CLIENT_NAME_FRAME = ArComFrame(('opCode', 'uint8', 2, (PulsePalObject.OP_MENU_BYTE, 89)),
+                                ('clientName', 'uint8', 6, tuple(b'PYTHON')))
+_ABORT_FRAME = ArComFrame(('opCode', 'uint8', 2, (PulsePalObject.OP_MENU_BYTE, 80)))
+_TRIGGER_FRAME = ArComFrame(('opCode', 'uint8', 2, (PulsePalObject.OP_MENU_BYTE, 77)), ('channels', 'uint8'))
+# Soft-trigger messages for each combination of output channels (bit n-1 = channel n), and the abort message
+_TRIGGER_MESSAGES = tuple(bytes(_TRIGGER_FRAME.encode(channels=channels)) for channels in range(16))
+_ABORT_MESSAGE = bytes(_ABORT_FRAME.encode())
+_DISCONNECT_FRAME = ArComFrame(('opCode', 'uint8', 2, (PulsePalObject.OP_MENU_BYTE, 81)))
+_SETTINGS_FILE_REQUEST_FRAME = ArComFrame(('opCode', 'uint8', 2, (PulsePalObject.OP_MENU_BYTE, 85)))
+
+
+def _describeCommand(message, command):
+    """
+    Formats a queued command for error messages, e.g. "programOutputChannelParam('phase1Voltage', 1, 5) (op 74)"
+    """
+    method_name, args = command
+    return method_name + '(' + ', '.join(repr(arg) for arg in args) + ') (op ' + str(message[1]) + ')'
+
+
+_TIME_PARAMS = slice(3, 11)  # Columns of the program image holding time params (codes 4-11)
+_VOLTAGE_PARAMS = [1, 2, 16]  # Columns holding voltage params (codes 2, 3 and 17)
+_BYTE_PARAMS = [0, 11, 12, 13, 14, 15]  # Columns holding single byte params (codes 1, 12-16)
+
+
+def _raiseViolations(violations):
+    if violations:
+        raise PulsePalValidationError('Error: invalid Pulse Pal program. Nothing was sent.\n' +
+                                      formatViolations(violations), violations)
+
+
+def _traceStatus(error_type):
+    """
+    Returns the status of a traced message (see PulsePalTrace.CommandRecord) from the error of its acknowledgement
+    """
+    if error_type is None:
+        return 'ok'
+    return 'nack' if error_type is PulsePalNackError else 'timeout'
+
+
+def _describeAckFailure(error_type, reply):
+    """
+    Describes a failed acknowledgement, to complete "Pulse Pal ... <command>" in error messages
+    """
+    if error_type is PulsePalNackError:
+        return 'replied ' + str(reply.tolist()) + ' instead of acknowledging'
+    return 'did not acknowledge'
+
+
+@contextlib.contextmanager
+def _lockStateCache(path):
+    """
+    Holds an exclusive lock on the state cache (a lock file next to it) for a read-modify-write, so that concurrent
+    processes (e.g. several pulsepal commands) do not lose each other's updates.
+    """
+    with open(path + '.lock', 'a+b') as lock_file:
+        if os.name == 'nt':
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)  # Retries for up to 10 seconds
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+            yield
+
+
+def _loadStateCache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as cache_file:
+        return json.load(cache_file)
+
+
+def _saveStateCache(path, cache):
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(temp_path, path)  # Replaced in one step, so other processes never read a partial file
+
+        
+for _name in OUTPUT_PARAMETER_NAMES + ('triggerMode',):
+    setattr(PulsePalObject, _name, ParameterFieldAttribute(_name))  # e.g. myPulsePal.phase1Voltage[channel]
+del _name
+
+
+class PulsePalError(Exception):
+    pass
+
+
+class PulsePalValidationError(PulsePalError):
+    """
+    Raised before any I/O when parameters or custom trains cannot be sent as given.
+    The violations attribute holds every violation found (a list of PulsePalValidation.Violation).
+    """
+    def __init__(self, message, violations):
+        super(PulsePalValidationError, self).__init__(message)
+        self.violations = violations
+
+
+class PulsePalTimeoutError(PulsePalError):
+    """
+    Raised when an acknowledgement does not arrive before its deadline (see PulsePalObject.ACK_TIMEOUT and deadline())
+    """
+    pass
+
+
+class PulsePalNackError(PulsePalError):
+    """
+    Raised when the device replies to a command with something other than its acknowledgement byte
+    """
+    pass
+
+
+class PulsePalDesyncError(PulsePalError):
+    """
+    Raised when replies from the device are not aligned with commands, and could not be (or were not) resynchronized
+    """
+    pass
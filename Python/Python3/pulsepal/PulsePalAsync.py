@@ -0,0 +1,308 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# AsyncPulsePalObject is an asyncio client for Pulse Pal. Its operations are coroutines, so the event loop keeps
+# running while commands are sent and acknowledged. Serial reads and writes run on worker threads.
+# Replies from the device are read continuously by a reader task, which resolves one future per expected reply.
+
+from .PulsePal import PulsePalObject, PulsePalTimeoutError, PulsePalNackError, _HANDSHAKE_FRAME, \
+    _HANDSHAKE_REPLY_FRAME, _CLIENT_NAME_FRAME, _DISCONNECT_FRAME, _describeCommand
+from .ArCOM import ArCom
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import collections
+import contextlib
+import time
+
+
+class AsyncPulsePalObject(PulsePalObject):
+    ACK_TIMEOUT = 10  # Seconds to wait for a reply before raising an error
+    READ_POLL_INTERVAL = 0.1  # Seconds a read may block its worker thread (sets how quickly disconnect() returns)
+
+    def __init__(self, port_name):
+        """
+        Initializes a new instance of the AsyncPulsePalObject and opens the USB serial port.
+        The device is not contacted until connect() is awaited.
+
+        Example:
+            myPulsePal = AsyncPulsePalObject('COM3')
+            await myPulsePal.connect()
+            await myPulsePal.programOutputChannelParam('phase1Voltage', 1, 10)
+            await myPulsePal.triggerOutputChannels(1, 0, 0, 0)
+            await myPulsePal.disconnect()
+
+        Args:
+            port_name (str): The name of the USB serial port to which the Pulse Pal is connected (e.g. COM3 on Windows)
+        """
+        self.Port = ArCom(port_name, 12000000)
+        self.Port.transport.timeout = self.READ_POLL_INTERVAL
+        self._transactionQueue = None
+        self._executor = ThreadPoolExecutor(max_workers=2)  # One thread for the reader task, one for writes
+        self._pendingReplies = collections.deque()  # (number of bytes, future) for each expected reply, in order
+        self._replyBuffer = bytearray()
+        self._writeLock = None
+        self._readerTask = None
+        self._connected = False
+
+    async def connect(self):
+        """
+        Starts the reader task, handshakes with the device and sets all parameters to their default values.
+
+        Raises:
+            PulsePalError: If there is a problem initializing the connection.
+        """
+        self._writeLock = asyncio.Lock()
+        self._readerTask = asyncio.ensure_future(self._readReplies())
+        reply = await self._request(_HANDSHAKE_FRAME.encode(), _HANDSHAKE_REPLY_FRAME.size(), ('connect', ()))
+        self._setup(_HANDSHAKE_REPLY_FRAME.decode(reply))
+        self._connected = True
+        await self._write(_CLIENT_NAME_FRAME.encode())
+        self.set2DefaultParams()
+        await self.syncAllParams()
+
+    async def disconnect(self):
+        """
+        Ends the session with the device (op 81), stops the reader task and closes the USB serial port.
+        """
+        if self._connected:
+            await self._write(_DISCONNECT_FRAME.encode())
+            self._connected = False
+        if self._readerTask is not None:
+            self._readerTask.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._readerTask
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        self.Port.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.disconnect()
+
+    async def syncAllParams(self, force_full=False):
+        """ Coroutine version of PulsePalObject.syncAllParams() """
+        await self._run(PulsePalObject.syncAllParams, force_full)
+
+    async def applyProgram(self, program):
+        """ Coroutine version of PulsePalObject.applyProgram() """
+        await self._run(PulsePalObject.applyProgram, program)
+
+    async def programOutputChannelParam(self, param_name, channel, value):
+        """ Coroutine version of PulsePalObject.programOutputChannelParam() """
+        await self._run(PulsePalObject.programOutputChannelParam, param_name, channel, value)
+
+    async def programTriggerChannelParam(self, param_name, channel, value):
+        """ Coroutine version of PulsePalObject.programTriggerChannelParam() """
+        await self._run(PulsePalObject.programTriggerChannelParam, param_name, channel, value)
+
+    async def setFixedVoltage(self, channel, voltage):
+        """ Coroutine version of PulsePalObject.setFixedVoltage() """
+        await self._run(PulsePalObject.setFixedVoltage, channel, voltage)
+
+    async def sendCustomPulseTrain(self, custom_train_id, pulse_times, pulse_voltages):
+        """ Coroutine version of PulsePalObject.sendCustomPulseTrain() """
+        await self._run(PulsePalObject.sendCustomPulseTrain, custom_train_id, pulse_times, pulse_voltages)
+
+    async def sendCustomWaveform(self, custom_train_id, pulse_width, pulse_voltages, compact=False):
+        """ Coroutine version of PulsePalObject.sendCustomWaveform() """
+        return await self._run(PulsePalObject.sendCustomWaveform, custom_train_id, pulse_width, pulse_voltages,
+                               compact)
+
+    async def setContinuousLoop(self, channel, state):
+        """ Coroutine version of PulsePalObject.setContinuousLoop() """
+        await self._run(PulsePalObject.setContinuousLoop, channel, state)
+
+    async def triggerOutputChannels(self, channel1, channel2, channel3, channel4):
+        """ Coroutine version of PulsePalObject.triggerOutputChannels() """
+        await self._run(PulsePalObject.triggerOutputChannels, channel1, channel2, channel3, channel4)
+
+    async def abortPulseTrains(self):
+        """ Coroutine version of PulsePalObject.abortPulseTrains() """
+        await self._run(PulsePalObject.abortPulseTrains)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Asynchronous version of PulsePalObject.transaction(). Commands awaited inside the block are queued, and sent
+        in a single write when the block exits. Note: commands issued by other tasks while the block runs join it.
+
+        Example:
+            async with myPulsePal.transaction():
+                await myPulsePal.programOutputChannelParam('phase1Voltage', 1, 5)
+                await myPulsePal.programOutputChannelParam('phase1Duration', 1, 0.002)
+        """
+        if self._transactionQueue is not None:
+            yield
+            return
+        self._transactionQueue = []
+        try:
+            yield
+            queue = self._transactionQueue
+        finally:
+            self._transactionQueue = None
+        await self._sendQueue(queue)
+
+    async def _run(self, method, *args):
+        """
+        Runs a PulsePalObject method with its commands queued instead of sent, then sends them and awaits their
+        acknowledgements. Inside a transaction, the commands join the transaction's queue.
+        """
+        if self._transactionQueue is not None:
+            return method(self, *args)
+        self._transactionQueue = []
+        try:
+            result = method(self, *args)
+            queue = self._transactionQueue
+        finally:
+            self._transactionQueue = None
+        await self._sendQueue(queue)
+        return result
+
+    async def _sendQueue(self, queue):
+        """
+        Sends queued commands in a single write, then awaits each acknowledgement in order.
+
+        Raises:
+            PulsePalTimeoutError: If a command is not acknowledged within ACK_TIMEOUT.
+            PulsePalNackError: If the device replies to a command with something other than the acknowledgement byte.
+        """
+        if not queue:
+            return
+        loop = asyncio.get_running_loop()
+        acks = []
+        try:
+            async with self._writeLock:  # Replies must be expected in the same order the commands are written
+                acks = [self._expectReply(n_ack_bytes) if n_ack_bytes > 0 else None
+                        for _, n_ack_bytes, _, _ in queue]
+                write_start = time.perf_counter()
+                await loop.run_in_executor(self._executor, self.Port.write_bytes,
+                                           b''.join(command[0] for command in queue))
+                write_end = time.perf_counter()
+            await self._receiveAcks(queue, acks, write_end - write_start, write_end)
+        except BaseException:  # Including cancellation of the awaiting task
+            # Stop expecting the batch's other replies, so that later replies are matched to their own commands
+            self._dropReplies(acks)
+            raise
+
+    async def _receiveAcks(self, queue, acks, write_time, write_end):
+        """
+        Awaits the acknowledgement of each command in a batch sent by _sendQueue(), in order.
+        """
+        tracer = self.tracer
+        for (message, n_ack_bytes, command, on_ack), ack in zip(queue, acks):
+            reply = b''
+            if ack is not None:
+                try:
+                    reply = await self._awaitReply(ack, message, command)
+                except PulsePalTimeoutError:
+                    if tracer is not None:
+                        tracer.messageSent(command[0], message, None, 0, write_time, time.perf_counter() - write_end,
+                                           0, 'timeout')
+                    raise
+            # The firmware acknowledges each command with 1
+            nacked = ack is not None and reply != bytes([1])*n_ack_bytes
+            if tracer is not None:
+                tracer.messageSent(command[0], message, None, 0, write_time,
+                                   time.perf_counter() - write_end if ack is not None else 0, len(reply),
+                                   'nack' if nacked else 'ok')
+            if nacked:
+                self._syncedParams = None
+                self._syncedTriggerModes = None
+                raise PulsePalNackError('Error: Pulse Pal replied ' + str(list(reply)) + ' instead of '
+                                        'acknowledging ' + _describeCommand(message, command) + '.')
+            if on_ack is not None:
+                on_ack()
+
+    async def _request(self, message, n_reply_bytes, command):
+        """
+        Sends a message and returns the device's reply.
+        """
+        async with self._writeLock:
+            reply = self._expectReply(n_reply_bytes)
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.Port.write_bytes, message)
+        return await self._awaitReply(reply, message, command)
+
+    async def _write(self, message):
+        """
+        Sends a message with no reply.
+        """
+        async with self._writeLock:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.Port.write_bytes, message)
+
+    def _expectReply(self, n_bytes):
+        future = asyncio.get_running_loop().create_future()
+        self._pendingReplies.append((n_bytes, future))
+        return future
+
+    def _dropReplies(self, futures):
+        """
+        Stops expecting replies (futures from _expectReply(), or None), and discards the bytes received so far.
+        """
+        dropped = set(id(future) for future in futures if future is not None)
+        self._pendingReplies = collections.deque(pending for pending in self._pendingReplies
+                                                 if id(pending[1]) not in dropped)
+        self._replyBuffer.clear()
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+    async def _awaitReply(self, reply, message, command):
+        try:
+            return await asyncio.wait_for(reply, self.ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._dropReplies([reply])  # Later replies must be matched to their own commands
+            self._syncedParams = None  # The device's state is unknown after an unacknowledged command
+            self._syncedTriggerModes = None
+            raise PulsePalTimeoutError('Error: Pulse Pal did not reply to ' + _describeCommand(message, command) + '.')
+
+    async def _readReplies(self):
+        """
+        Reader task. Reads bytes from the device as they arrive, and resolves the futures of expected replies in order.
+        Bytes that arrive when no reply is expected are discarded.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.run_in_executor(self._executor, self._readAvailable)
+            if not data:
+                continue
+            self._replyBuffer += data
+            while self._pendingReplies and len(self._replyBuffer) >= self._pendingReplies[0][0]:
+                n_bytes, future = self._pendingReplies.popleft()
+                reply = bytes(self._replyBuffer[:n_bytes])
+                del self._replyBuffer[:n_bytes]
+                if not future.done():
+                    future.set_result(reply)
+            if not self._pendingReplies:
+                self._replyBuffer.clear()
+
+    def _readAvailable(self):
+        """
+        Reads all bytes available from the USB serial buffer, waiting up to READ_POLL_INTERVAL for at least one byte.
+        """
+        return self.Port.transport.read(max(self.Port.bytes_available(), 1))
+
+    def __del__(self):
+        if getattr(self, '_connected', False):  # The session was not ended with disconnect()
+            try:
+                PulsePalObject.disconnect(self)
+            except Exception:  # The port, executor or interpreter may already be gone; errors can't be raised from here
+                pass
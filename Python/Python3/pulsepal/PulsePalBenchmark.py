@@ -0,0 +1,275 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Benchmarks for the host-side hot paths of the PulsePal and ArCOM modules. Each benchmark reports the median time of
+# one call and the bytes it writes to the port. The device is replaced by a port that acknowledges every message
+# without parsing it, so only host-side encoding and writing are timed.
+# The startup benchmarks time a new Python process: importing a module, and running the pulsepal command (see
+# PulsePalCLI) to send a soft-trigger to a local TCP socket standing in for the device, as a shell-driven rig would
+# once per trial.
+#
+# Usage:
+#   python PulsePalBenchmark.py                                 Runs the benchmarks and prints the results
+#   python PulsePalBenchmark.py startup                         Runs the benchmarks whose names start with 'startup'
+#   python PulsePalBenchmark.py --output results.json           Also saves the results as JSON
+#   python PulsePalBenchmark.py --save-baseline                 Saves the results as the baseline
+#   python PulsePalBenchmark.py --baseline PulsePalBenchmarkBaseline.json
+#                                 Compares against a baseline. Exits with status 1 if a benchmark is slower than
+#                                 the baseline by more than --tolerance, or writes a different number of bytes.
+
+from .ArCOM import SerialTransport
+from .PulsePal import PulsePalObject
+from .PulsePalEmulator import EmulatedSerial, PulsePalEmulator
+from .PulsePalProgram import PulsePalProgram
+from .PulsePalTrace import PulsePalTriggerTimer
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(MODULE_DIR, 'PulsePalBenchmarkBaseline.json')
+MIN_REPEATS = 5
+MIN_DURATION = 0.2  # Seconds each benchmark is repeated for (at least MIN_REPEATS times)
+
+
+class AckingPort(object):
+    """
+    A serial-like port that counts the bytes written to it, and returns acknowledgement bytes (1) for every read.
+    """
+    def __init__(self):
+        self.bytesWritten = 0
+
+    def write(self, message_bytes):
+        self.bytesWritten += len(message_bytes)
+        return len(message_bytes)
+
+    def read(self, n_bytes=1):
+        return b'\x01' * n_bytes
+
+    def inWaiting(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class SocketPort(object):
+    """
+    A local TCP socket that stands in for a device port ('tcp://host:port', see ArCOM.TCPTransport), and counts the
+    bytes written to it. Connections are accepted and read after the writer has closed them.
+    """
+    def __init__(self):
+        self.bytesWritten = 0
+        self._server = socket.create_server(('127.0.0.1', 0))
+        self.address = 'tcp://127.0.0.1:' + str(self._server.getsockname()[1])
+
+    def receive(self):
+        """
+        Reads one closed connection to the end
+        """
+        connection, _ = self._server.accept()
+        with connection:
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    return
+                self.bytesWritten += len(data)
+
+    def close(self):
+        """
+        Closes the listening socket
+        """
+        self._server.close()
+
+
+def connect(firmware_version):
+    """
+    Returns a PulsePalObject connected to an emulated device (firmware_version < 20 for Pulse Pal 1), with its port
+    replaced by an AckingPort after the handshake.
+    """
+    pulse_pal = PulsePalObject(EmulatedSerial(PulsePalEmulator(firmware_version)))
+    pulse_pal.Port.transport = SerialTransport(AckingPort())
+    return pulse_pal
+
+
+def measure(port, function):
+    """
+    Calls a function repeatedly, and returns the median duration of a call and the bytes it wrote to the port.
+    """
+    durations = []
+    n_bytes = None
+    start_time = time.perf_counter()
+    while len(durations) < MIN_REPEATS or time.perf_counter() - start_time < MIN_DURATION:
+        bytes_before = port.bytesWritten
+        call_start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - call_start)
+        n_bytes = port.bytesWritten - bytes_before
+    return {'seconds': float(np.median(durations)), 'bytes': n_bytes, 'repeats': len(durations)}
+
+
+def benchmarks():
+    """
+    Returns {benchmark name: (port, function)}. Each function calls a PulsePalObject connected to the port.
+    """
+    cases = {}
+    for model, firmware_version in ((1, 5), (2, 21)):
+        pulse_pal = connect(firmware_version)
+        prefix = 'model' + str(model) + '.'
+
+        def add(name, function, port=pulse_pal.Port.serialObject):
+            cases[prefix + name] = (port, function)
+
+        add('syncAllParams.full', lambda p=pulse_pal: p.syncAllParams(force_full=True))
+
+        def sync_one_change(p=pulse_pal):
+            p.phase1Voltage[1] = -p.phase1Voltage[1]
+            p.syncAllParams()
+        add('syncAllParams.oneChange', sync_one_change)
+        add('applyProgram', lambda p=pulse_pal, program=PulsePalProgram.fromPulsePal(pulse_pal): p.applyProgram(program))
+        add('programOutputChannelParam.voltage',
+            lambda p=pulse_pal: p.programOutputChannelParam('phase1Voltage', 1, 2.5))
+        add('programOutputChannelParam.time',
+            lambda p=pulse_pal: p.programOutputChannelParam('phase1Duration', 1, 0.0025))
+        add('programOutputChannelParam.byte', lambda p=pulse_pal: p.programOutputChannelParam('isBiphasic', 1, 1))
+        for n_points in (10, 1000, 5000) if model == 2 else (10, 1000):  # Pulse Pal 1 holds 1000 pulses per train
+            pulse_times = np.arange(n_points) * 0.001
+            voltages = np.sin(np.arange(n_points) / 10) * 10
+            add('sendCustomPulseTrain.' + str(n_points),
+                lambda p=pulse_pal, t=pulse_times, v=voltages: p.sendCustomPulseTrain(1, t, v))
+            add('sendCustomWaveform.' + str(n_points),
+                lambda p=pulse_pal, v=voltages: p.sendCustomWaveform(2, 0.0001, v))
+        add('triggerOutputChannels', lambda p=pulse_pal: p.triggerOutputChannels(1, 0, 1, 0))
+
+        def trigger_timed(p=pulse_pal, timer=PulsePalTriggerTimer()):
+            p.triggerTimer = timer
+            p.triggerOutputChannels(1, 0, 1, 0)
+            p.triggerTimer = None
+        add('triggerOutputChannels.timed', trigger_timed)
+        add('abortPulseTrains', lambda p=pulse_pal: p.abortPulseTrains())
+    cases.update(startupBenchmarks())
+    return cases
+
+
+def startupBenchmarks():
+    """
+    Returns {benchmark name: (port, function)} for the startup benchmarks. Each function runs a new Python process.
+    The pulsepal command benchmarks listen on a SocketPort, which must be closed after use.
+    """
+    def run_process(*args):
+        subprocess.run([sys.executable] + list(args), cwd=os.path.dirname(MODULE_DIR), check=True)
+    cases = {'startup.python': (AckingPort(), lambda: run_process('-c', 'pass'))}
+    for module in ('ArCOM', 'PulsePal', 'PulsePalCLI'):
+        cases['startup.import.' + module] = (AckingPort(),
+                                             lambda module=module: run_process('-c', 'import pulsepal.' + module))
+    for command in (['trigger', '1', '3'], ['abort']):
+        port = SocketPort()
+
+        def run_command(port=port, command=command):
+            run_process('-m', 'pulsepal.PulsePalCLI', *command, '--port', port.address)
+            port.receive()
+        cases['startup.pulsepal.' + command[0]] = (port, run_command)
+    return cases
+
+
+def run(names=None):
+    """
+    Runs the benchmarks (all, or those whose names start with one of the given prefixes), and returns the results.
+    """
+    results = {}
+    cases = benchmarks()
+    try:
+        for name, (port, function) in cases.items():
+            if names and not any(name.startswith(prefix) for prefix in names):
+                continue
+            results[name] = measure(port, function)
+    finally:
+        for port, _ in cases.values():
+            if isinstance(port, SocketPort):
+                port.close()
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'results': results}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results against a baseline. Returns a list of regressions (as strings).
+    A benchmark regresses if it is slower than the baseline by more than tolerance (a fraction),
+    or if it writes a different number of bytes.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        if result['bytes'] != reference['bytes']:
+            regressions.append(name + ': writes ' + str(result['bytes']) + ' bytes (baseline ' +
+                               str(reference['bytes']) + ')')
+        if result['seconds'] > reference['seconds'] * (1 + tolerance):
+            regressions.append(name + ': ' + _formatSeconds(result['seconds']) + ' (baseline ' +
+                               _formatSeconds(reference['seconds']) + ')')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the host-side hot paths of the Pulse Pal Python API.')
+    parser.add_argument('names', nargs='*', help='Benchmark name prefixes to run (default: all)')
+    parser.add_argument('--output', help='Saves the results to this JSON file')
+    parser.add_argument('--baseline', help='Compares the results against this JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='Saves the results as ' + DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fraction by which a benchmark may be slower than the baseline (default: 0.25)')
+    args = parser.parse_args(argv)
+    results = run(args.names)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    for name, result in results['results'].items():
+        line = name.ljust(44) + _formatSeconds(result['seconds']).rjust(12) + str(result['bytes']).rjust(10) + ' bytes'
+        reference = baseline['results'].get(name) if baseline else None
+        if reference:
+            line += '   x' + format(result['seconds'] / reference['seconds'], '.2f') + ' vs baseline'
+        print(line)
+    for path in filter(None, (args.output, DEFAULT_BASELINE if args.save_baseline else None)):
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+def _formatSeconds(seconds):
+    if seconds >= 0.01:  # e.g. startup benchmarks
+        return format(seconds * 1e3, '.1f') + ' ms'
+    return format(seconds * 1e6, '.1f') + ' us'
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pulsepal command, for scripts and shell-driven rigs that control a Pulse Pal one command per process.
+# It is installed with the package (see pyproject.toml), or run as python PulsePalCLI.py.
+# trigger and abort are made to be called once per trial: they write their 2-3 byte message to the port directly
+# (the device accepts soft-triggers and aborts without a handshake), and import neither NumPy nor the PulsePal module.
+# The other commands connect a PulsePalObject with adopt_state=True, and close the port without ending the device's
+# session (see PulsePalObject.disconnect()), so the device keeps its program and outputs between commands.
+# With --server (or the PULSEPAL_SERVER environment variable), commands are sent to a PulsePalServer instead, which
+# holds the connection to the device. Otherwise the port is given by --port, or the PULSEPAL_PORT variable.
+#
+# Usage:
+#   pulsepal trigger 1 3 --port /dev/ttyACM0        Soft-triggers output channels 1 and 3
+#   pulsepal abort                                  Aborts all pulse trains (port from PULSEPAL_PORT)
+#   pulsepal set-voltage 2 5.0                      Sets output channel 2 to a fixed 5V
+#   pulsepal load-program burst.json                Applies a PulsePalProgram saved as JSON
+#   pulsepal upload-waveform 1 chirp.npy --pulse-width 0.0001
+#                                                   Sends the voltages in a .npy file to custom train 1. Conversions
+#                                                   are kept in PulsePalWaveformLibrary's disk cache.
+# Exit status: 0 on success, 1 if the command failed (the error is printed), 2 for invalid arguments.
+
+import os
+import sys
+
+PORT_VARIABLE = 'PULSEPAL_PORT'
+SERVER_VARIABLE = 'PULSEPAL_SERVER'
+
+_OP_MENU_BYTE = 213  # As in PulsePalObject.OP_MENU_BYTE. The PulsePal module is not imported for trigger and abort.
+_TRIGGER_OPCODE = 77
+_ABORT_OPCODE = 80
+_BAUD_RATE = 12000000  # As used by PulsePalObject
+
+
+def trigger(channels, port=None, server=None):
+    """
+    Soft-triggers output channels, without a handshake.
+
+    Args:
+        channels (list of int): The output channels to trigger (1-4)
+        port (str): The device's USB serial port, or a 'tcp://host:port' address (see ArCOM.TCPTransport)
+        server (str): The address of a PulsePalServer to send the trigger to, instead of the port
+    """
+    channel_bits = _channelBits(channels)
+    if server is not None:
+        _serverRequest(server, 'triggerOutputChannels', *channel_bits)
+    else:
+        trigger_byte = sum(bit << i for i, bit in enumerate(channel_bits))  # Bit n-1 = channel n
+        _writeMessage(port, bytes((_OP_MENU_BYTE, _TRIGGER_OPCODE, trigger_byte)))
+
+
+def abort(port=None, server=None):
+    """
+    Aborts all pulse trains, without a handshake (see trigger())
+    """
+    if server is not None:
+        _serverRequest(server, 'abortPulseTrains')
+    else:
+        _writeMessage(port, bytes((_OP_MENU_BYTE, _ABORT_OPCODE)))
+
+
+def setVoltage(channel, voltage, port=None, server=None):
+    """
+    Sets an output channel to a fixed voltage (see PulsePalObject.setFixedVoltage())
+    """
+    if server is not None:
+        _serverRequest(server, 'setFixedVoltage', channel, voltage)
+        return
+    pulse_pal = _connect(port)
+    try:
+        pulse_pal.setFixedVoltage(channel, voltage)
+    finally:
+        pulse_pal.disconnect(end_session=False)
+
+
+def loadProgram(path, port=None, server=None):
+    """
+    Applies a program saved as JSON (see PulsePalProgram.fromJSON() and PulsePalObject.applyProgram()).
+    On a server, the program's parameters and custom trains are sent as separate requests.
+    """
+    from .PulsePalProgram import PulsePalProgram
+    program = PulsePalProgram.fromJSON(path)
+    if server is not None:
+        _serverRequest(server, 'setParams', {name: list(values) for name, values in program.fields.items()})
+        for custom_train_id, (pulse_times, pulse_voltages) in sorted(program.customTrains.items()):
+            _serverRequest(server, 'sendCustomPulseTrain', custom_train_id, pulse_times, pulse_voltages)
+        return
+    pulse_pal = _connect(port)
+    try:
+        pulse_pal.applyProgram(program)
+    finally:
+        pulse_pal.disconnect(end_session=False)
+
+
+def uploadWaveform(custom_train_id, path, pulse_width, compact=False, port=None, server=None, cache_dir=None):
+    """
+    Sends the voltages in a .npy file to a custom train (see PulsePalObject.sendCustomWaveform()). When sent to the
+    port, the conversion is kept in a PulsePalWaveformLibrary disk cache, so later uploads of the file skip it.
+
+    Args:
+        cache_dir (str): The disk cache's folder. None for PulsePalWaveformLibrary.DEFAULT_CACHE_DIR.
+
+    Returns:
+        WaveformUpload: The result of the upload
+    """
+    from .PulsePal import WaveformUpload
+    from .PulsePalWaveformLibrary import PulsePalWaveformLibrary, DEFAULT_CACHE_DIR
+    if not path.endswith('.npy'):
+        raise ValueError('Error: waveforms are read from .npy files. ' + path + ' is not a .npy file.')
+    directory, file_name = os.path.split(path)
+    library = PulsePalWaveformLibrary(directory or os.curdir, DEFAULT_CACHE_DIR if cache_dir is None else cache_dir)
+    name = file_name[:-len('.npy')]
+    if server is not None:
+        voltages = library.source(name)
+        return WaveformUpload(*_serverRequest(server, 'sendCustomWaveform', custom_train_id, pulse_width,
+                                              voltages.tolist(), compact))
+    pulse_pal = _connect(port)
+    try:
+        return library.upload(pulse_pal, custom_train_id, name, pulse_width, compact)
+    finally:
+        pulse_pal.disconnect(end_session=False)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    command = _parseQuickCommand(argv)  # trigger and abort are parsed without argparse, which is slower to import
+    if command is None:
+        command = _parseArgs(argv)
+    function, kwargs, port, server = command
+    if server is None and port is None:
+        server = os.environ.get(SERVER_VARIABLE)
+        port = os.environ.get(PORT_VARIABLE)
+        if server is not None:
+            port = None
+        elif port is None:
+            print('pulsepal: no port given. Use --port or --server, or set ' + PORT_VARIABLE + ' or ' +
+                  SERVER_VARIABLE + '.', file=sys.stderr)
+            return 2
+    try:
+        result = function(port=port, server=server, **kwargs)
+    except Exception as error:  # Reported without a traceback, as a command line tool does
+        print('pulsepal: ' + str(error), file=sys.stderr)
+        return 1
+    if result is not None:
+        print(result)
+    return 0
+
+
+def _parseQuickCommand(argv):
+    """
+    Parses a trigger or abort command: 'trigger' with channel numbers, or 'abort', and optionally --port or --server.
+    Returns (function, keyword arguments, port, server), or None if argv is anything else (including --help or an
+    error), which is then parsed by argparse.
+    """
+    if not argv or argv[0] not in ('trigger', 'abort'):
+        return None
+    options = {'--port': None, '--server': None}
+    channels = []
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in options and options[arg] is None:
+            options[arg] = next(args, None)
+            if options[arg] is None:
+                return None
+        elif arg.isdigit() and argv[0] == 'trigger':
+            channels.append(int(arg))
+        else:
+            return None
+    if (argv[0] == 'trigger' and not channels) or None not in options.values():
+        return None
+    function, kwargs = (trigger, {'channels': channels}) if argv[0] == 'trigger' else (abort, {})
+    return function, kwargs, options['--port'], options['--server']
+
+
+def _parseArgs(argv):
+    """
+    Parses any command with argparse. Returns (function, keyword arguments, port, server). Exits with status 2 if argv
+    is invalid.
+    """
+    import argparse
+    target = argparse.ArgumentParser(add_help=False)
+    target_options = target.add_mutually_exclusive_group()
+    target_options.add_argument('--port', help='The USB serial port (default: $' + PORT_VARIABLE + ')')
+    target_options.add_argument('--server', help='The address of a PulsePalServer (default: $' + SERVER_VARIABLE + ')')
+    parser = argparse.ArgumentParser(prog='pulsepal', description='Controls a Pulse Pal from the command line.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('trigger', parents=[target], help='Soft-triggers output channels')
+    command.add_argument('channels', nargs='+', type=int, help='Output channels to trigger (1-4)')
+    command.set_defaults(function=trigger)
+    command = commands.add_parser('abort', parents=[target], help='Aborts all pulse trains')
+    command.set_defaults(function=abort)
+    command = commands.add_parser('set-voltage', parents=[target], help='Sets an output channel to a fixed voltage')
+    command.add_argument('channel', type=int, help='The output channel (1-4)')
+    command.add_argument('voltage', type=float, help='The voltage. Units = volts.')
+    command.set_defaults(function=setVoltage)
+    command = commands.add_parser('load-program', parents=[target], help='Applies a program saved as JSON')
+    command.add_argument('path', help='The program (see PulsePalProgram.saveJSON())')
+    command.set_defaults(function=loadProgram)
+    command = commands.add_parser('upload-waveform', parents=[target], help='Sends a waveform to a custom train')
+    command.add_argument('custom_train_id', type=int, help='The custom train (1-2)')
+    command.add_argument('path', help='A .npy file of voltages. Units = volts.')
+    command.add_argument('--pulse-width', type=float, required=True, help='The width of each sample. Units = seconds.')
+    command.add_argument('--compact', action='store_true', help='Merges runs of identical samples')
+    command.add_argument('--cache-dir', help='The folder of the disk cache of converted waveforms')
+    command.set_defaults(function=uploadWaveform)
+    kwargs = vars(parser.parse_args(argv))
+    function, port, server = kwargs.pop('function'), kwargs.pop('port'), kwargs.pop('server')
+    del kwargs['command']
+    return function, kwargs, port, server
+
+
+def _channelBits(channels):
+    """
+    Returns (channel1, channel2, channel3, channel4), each 1 if the channel is in channels and 0 if not
+    """
+    channels = set(channels)
+    if not channels <= {1, 2, 3, 4}:
+        raise ValueError('Error: output channels are numbered 1-4, not ' + str(max(channels - {1, 2, 3, 4})) + '.')
+    return tuple(int(channel in channels) for channel in (1, 2, 3, 4))
+
+
+def _writeMessage(port, message):
+    """
+    Opens a port, writes a message, and closes the port once the message has been sent
+    """
+    if port.startswith('tcp://'):
+        import socket
+        host, _, tcp_port = port[len('tcp://'):].rpartition(':')
+        with socket.create_connection((host, int(tcp_port)), 10) as connection:
+            connection.sendall(message)
+        return
+    import serial
+    with serial.Serial(port, _BAUD_RATE, timeout=10, rtscts=True) as serial_port:
+        serial_port.write(message)
+        serial_port.flush()  # Waits until the message is sent. Closing the port may discard unsent bytes.
+
+
+def _serverRequest(address, method, *args):
+    """
+    Sends one request to a PulsePalServer and returns its result. This is the server's wire protocol (see
+    PulsePalServer), with arrays sent as JSON lists, so that NumPy is not needed.
+    """
+    import json
+    import socket
+    import struct
+    lengths = struct.Struct('<II')
+    if address.startswith('tcp://'):
+        host, _, tcp_port = address[len('tcp://'):].rpartition(':')
+        connection = socket.create_connection((host, int(tcp_port)))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+    with connection:
+        header = json.dumps({'method': method, 'args': args}).encode()
+        connection.sendall(lengths.pack(len(header), 0) + header)
+        header_length, payload_length = lengths.unpack(_receiveExact(connection, lengths.size))
+        reply = json.loads(_receiveExact(connection, header_length))
+        _receiveExact(connection, payload_length)
+    if 'error' in reply:
+        raise RuntimeError(reply['error'] if reply['errorType'] == 'PulsePalError' else
+                           reply['errorType'] + ': ' + reply['error'])
+    return reply['result']
+
+
+def _receiveExact(connection, n_bytes):
+    message_bytes = bytearray()
+    while len(message_bytes) < n_bytes:
+        data = connection.recv(n_bytes - len(message_bytes))
+        if not data:
+            raise EOFError('Error: the connection to the Pulse Pal server was closed.')
+        message_bytes += data
+    return bytes(message_bytes)
+
+
+def _connect(port):
+    from .PulsePal import PulsePalObject
+    return PulsePalObject(port, adopt_state=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Vectorized unit conversion for Pulse Pal parameters. Whole arrays of times (seconds) and voltages (volts) are
+# converted to the device's units (hardware cycles and DAC bits) in one pass. Results are identical to the scalar
+# Decimal conversions in PulsePalObject, which quantize each value to 4 decimal places before converting it.
+
+import numpy as np
+
+CYCLE_FREQUENCY = 20000  # Hz
+_QUANTUM = 10000  # Values are quantized to 1/_QUANTUM (0.0001) before conversion
+_TIE_TOLERANCE = 1e-9  # Relative distance from a rounding boundary at which the exact Decimal path is used
+
+
+def quantize(values):
+    """
+    Quantizes values to 4 decimal places, with the same result as Decimal(value).quantize(Decimal('1.0000')).
+
+    Args:
+        values (array-like of float): The values to quantize.
+
+    Returns:
+        ndarray (int64): The quantized values, in units of 0.0001
+
+    Raises:
+        ValueError: If any value is NaN or infinite.
+    """
+    values = np.asarray(values, dtype='float64')
+    shape = values.shape
+    values = values.reshape(-1)
+    if not np.isfinite(values).all():
+        raise ValueError('Error: Pulse Pal parameters cannot be NaN or infinite.')
+    scaled = values*_QUANTUM
+    units = np.rint(scaled)  # Rounds half to even, as Decimal.quantize() does by default
+    # Float multiplication can move a value that lies just off a rounding boundary onto it (or across it).
+    # Values that land near a boundary are re-quantized exactly from their binary value, as Decimal does.
+    near_tie = np.abs(np.abs(scaled - units) - 0.5) <= _TIE_TOLERANCE*np.maximum(np.abs(scaled), 1)
+    if near_tie.any():
+        from decimal import Decimal  # Rarely needed, so imported on first use rather than with the module
+        units[near_tie] = [int(Decimal(value).quantize(Decimal('1.0000')).scaleb(4)) for value in values[near_tie]]
+    return units.astype('int64').reshape(shape)
+
+
+def seconds2Cycles(values, cycle_frequency=CYCLE_FREQUENCY):
+    """
+    Converts time values in seconds to the corresponding number of refresh cycles.
+
+    Args:
+        values (array-like of float): The time values to convert. Units = seconds.
+        cycle_frequency (int): The device refresh rate. Units = Hz.
+
+    Returns:
+        ndarray (uint32): The number of cycles corresponding to each time value.
+
+    Raises:
+        ValueError: If a value is NaN, infinite, or out of range for a 32-bit cycle count.
+    """
+    cycles = (quantize(values)*cycle_frequency)//_QUANTUM
+    return _checkedCast(cycles, 'uint32', 'time')
+
+
+def volts2Bits(values, dac_bitmax):
+    """
+    Converts voltage values in range -10V to +10V to the corresponding DAC bit values.
+
+    Args:
+        values (array-like of float): The voltage values to convert. Units = volts.
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+
+    Returns:
+        ndarray (uint8 if dac_bitmax < 256, otherwise uint16): The DAC bit value for each voltage.
+
+    Raises:
+        ValueError: If a value is NaN, infinite, or outside the DAC range.
+    """
+    dac_bitmax = int(dac_bitmax)
+    numerator = (quantize(values) + 10*_QUANTUM)*dac_bitmax
+    bits = -((-numerator)//(20*_QUANTUM))  # Integer ceiling division
+    return _checkedCast(bits, dacDatatype(dac_bitmax), 'voltage')
+
+
+def cycles2Seconds(values, cycle_frequency=CYCLE_FREQUENCY):
+    """
+    Converts numbers of refresh cycles to time values in seconds (the inverse of seconds2Cycles).
+    Cycle counts are exact at 4 decimal places if they are even (at 20kHz). An odd count (e.g. set on the device
+    itself) is returned exactly, but seconds2Cycles() of the result gives the next even count.
+
+    Args:
+        values (array-like of int): The numbers of cycles to convert.
+        cycle_frequency (int): The device refresh rate. Units = Hz.
+
+    Returns:
+        ndarray (float64): The time value of each cycle count. Units = seconds.
+    """
+    return np.asarray(values, dtype='int64')/cycle_frequency
+
+
+def bits2Volts(values, dac_bitmax):
+    """
+    Converts DAC bit values to voltages (the inverse of volts2Bits). Each voltage is the value with the fewest decimal
+    places (at most 4) that volts2Bits() converts back to the same DAC bit value, choosing the one closest to the DAC
+    value's exact voltage among those. Round values such as 5V therefore read back as they were set.
+
+    Args:
+        values (array-like of int): The DAC bit values to convert.
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+
+    Returns:
+        ndarray (float64): The voltage of each DAC bit value. Units = volts.
+    """
+    dac_bitmax = int(dac_bitmax)
+    bits = np.asarray(values, dtype='int64')
+    # volts2Bits() computes ceil((units + 10*_QUANTUM)*dac_bitmax/(20*_QUANTUM)), so the units that give bits are
+    # from floor((bits - 1)*20*_QUANTUM/dac_bitmax) + 1 to floor(bits*20*_QUANTUM/dac_bitmax), offset by -10*_QUANTUM.
+    # Each DAC step spans > 1 unit, so the range is never empty. 10*_QUANTUM is a multiple of every step below.
+    low = np.maximum((bits - 1)*20*_QUANTUM//dac_bitmax + 1, 0) - 10*_QUANTUM
+    high = bits*20*_QUANTUM//dac_bitmax - 10*_QUANTUM
+    units = high
+    found = np.zeros(bits.shape, dtype=bool)
+    for step in (_QUANTUM, _QUANTUM//10, _QUANTUM//100, _QUANTUM//1000, 1):
+        # The multiple of step nearest the exact value bits*20*_QUANTUM/dac_bitmax, moved into the range
+        nearest = (bits*40*_QUANTUM + dac_bitmax*step)//(2*dac_bitmax*step)*step - 10*_QUANTUM
+        nearest = np.minimum(np.maximum(nearest, -(-low//step)*step), high//step*step)
+        use = ~found & (nearest >= low) & (nearest <= high)
+        units = np.where(use, nearest, units)
+        found = found | use
+    return units/_QUANTUM
+
+
+def compactWaveform(pulse_width, voltage_bits):
+    """
+    Merges runs of identical DAC values in a custom waveform into single pulses, without changing its output.
+
+    The firmware holds a custom pulse's voltage until the next pulse if the next pulse starts within phase1Duration.
+    So a run of samples can be played as one pulse if phase1Duration is at least the run's duration. Runs longer
+    than phase1Duration are split. The last pulse (and the first, when the train loops) lasts exactly
+    phase1Duration, so phase1Duration is the shorter of the first and last runs. A waveform with a single run is
+    sent as 2 or 3 pulses, since the firmware never ends a train made of one pulse at time 0.
+
+    Args:
+        pulse_width (int): The duration of each sample. Units = cycles.
+        voltage_bits (array-like of int): The DAC value of each sample.
+
+    Returns:
+        tuple: (pulse_times, pulse_voltages, phase1_duration). The custom pulse train (times in cycles as uint32,
+               DAC values with the input's datatype), and the phase1Duration that plays it (cycles).
+               With no runs to merge, this is the dense waveform (one pulse per sample, phase1Duration = pulse_width).
+    """
+    voltage_bits = np.asarray(voltage_bits)
+    n_samples = voltage_bits.size
+    if n_samples == 0:
+        return np.zeros(0, dtype='uint32'), voltage_bits, pulse_width
+    run_starts = np.concatenate(([0], np.flatnonzero(voltage_bits[1:] != voltage_bits[:-1]) + 1))
+    if run_starts.size == 1:
+        max_samples = max(n_samples//2, 1)
+        piece_starts = np.unique([0, max_samples, n_samples - max_samples])[:n_samples]  # Full, remainder, full
+        return (np.asarray(piece_starts*pulse_width, dtype='uint32'), voltage_bits[piece_starts],
+                max_samples*pulse_width)
+    run_lengths = np.diff(np.append(run_starts, n_samples))
+    max_samples = int(min(run_lengths[0], run_lengths[-1]))
+    n_pieces = -(-run_lengths//max_samples)  # Pieces of each run (ceiling division)
+    piece_run = np.repeat(np.arange(run_lengths.size), n_pieces)
+    piece_index = np.arange(n_pieces.sum()) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    piece_starts = run_starts[piece_run] + piece_index*max_samples
+    # Runs are split into full pieces then a remainder, except the last run, which must end with a full piece
+    remainder = int(run_lengths[-1] % max_samples)
+    if remainder:
+        piece_starts[(piece_run == run_lengths.size - 1) & (piece_index > 0)] -= max_samples - remainder
+    pulse_times = _checkedCast(piece_starts.astype('int64')*pulse_width, 'uint32', 'time')
+    return pulse_times, voltage_bits[piece_starts], max_samples*pulse_width
+
+
+def dacDatatype(dac_bitmax):
+    """
+    Returns the datatype used to transmit DAC bit values for a Pulse Pal model.
+
+    Args:
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+
+    Returns:
+        str: 'uint8' for 8-bit DACs (Pulse Pal 1), 'uint16' for 16-bit DACs (Pulse Pal 2)
+    """
+    if int(dac_bitmax) < 256:
+        return 'uint8'
+    return 'uint16'
+
+
+def _checkedCast(values, datatype, kind):
+    limits = np.iinfo(datatype)
+    if values.size > 0 and (values.min() < limits.min or values.max() > limits.max):
+        raise ValueError('Error: ' + kind + ' value out of range for the Pulse Pal ' + datatype + ' parameter format.')
+    return values.astype(datatype)
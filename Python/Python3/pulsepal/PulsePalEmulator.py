@@ -0,0 +1,491 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalEmulator is a pure-Python emulator of the Pulse Pal serial protocol, as implemented in
+# Firmware/PulsePal_2_0_1 (Pulse Pal 2) and Firmware/PulsePal_1_1 (Pulse Pal 1, 8-bit voltages).
+# It keeps the state it receives in device units, so tests can assert on what a device would have been sent.
+# Pulse output is not simulated. The emulator can be connected in-process with EmulatedSerial, or to any
+# serial client through a pseudo-terminal with EmulatorPty (POSIX only).
+#
+# Example:
+#   from PulsePal import PulsePalObject
+#   from PulsePalEmulator import EmulatedSerial
+#   link = EmulatedSerial(latency=0.001, bandwidth=1000000)  # Optional round-trip latency and bytes/second
+#   myPulsePal = PulsePalObject(link)
+#   myPulsePal.programOutputChannelParam('phase1Voltage', 1, 10)
+#   assert link.emulator.param('phase1Voltage', 1) == 65535
+
+import collections
+import os
+import select
+import threading
+import time
+import numpy as np
+
+OP_MENU_BYTE = 213
+HANDSHAKE_RESPONSE = 75
+MAX_CUSTOM_PULSES = 5000  # Size of the firmware's custom pulse train buffers (Pulse Pal 2)
+MAX_CUSTOM_PULSES_MODEL_1 = 1000  # Pulses per custom train on Pulse Pal 1 (firmware 1.1)
+SETTINGS_FILE_TERMINATOR = 252  # Last byte of a valid microSD settings file
+SETTINGS_FILE_SIZE = 179
+DEFAULT_SETTINGS_FILE = 'default.pps'
+
+# Output parameters in the order of their op 74 parameter codes (1-17)
+OUTPUT_PARAM_NAMES = ('isBiphasic', 'phase1Voltage', 'phase2Voltage', 'phase1Duration', 'interPhaseInterval',
+                      'phase2Duration', 'interPulseInterval', 'burstDuration', 'interBurstInterval',
+                      'pulseTrainDuration', 'pulseTrainDelay', 'linkTriggerChannel1', 'linkTriggerChannel2',
+                      'customTrainID', 'customTrainTarget', 'customTrainLoop', 'restingVoltage')
+TRIGGER_MODE_CODE = 128
+_TIME_PARAMS = slice(3, 11)  # Columns of outputParams holding times (codes 4-11), in op 73 order
+_VOLTAGE_PARAMS = [1, 2, 16]  # Phase 1, phase 2 and resting voltage, in op 73 order
+_LINK_PARAMS = [11, 12]
+_MODEL_2_BYTE_PARAMS = [0, 13, 14, 15]  # Byte params of op 73 on Pulse Pal 2, in order
+_MODEL_1_BYTE_PARAMS = [0, 1, 2, 13, 14, 15, 16]  # Byte params of op 73 on Pulse Pal 1 (includes voltages), in order
+
+
+class PulsePalEmulator(object):
+    def __init__(self, firmware_version=21, strict=True):
+        """
+        Initializes an emulated Pulse Pal with the firmware's default parameters.
+
+        Args:
+            firmware_version (int): The firmware version reported in the handshake. Versions below 20 emulate
+                                    Pulse Pal 1 (8-bit voltages, no microSD card); 20 and above emulate Pulse Pal 2.
+            strict (bool): If True, messages the firmware would mishandle (e.g. a custom train longer than
+                           the model's MAX_CUSTOM_PULSES, or an invalid channel) raise PulsePalEmulatorError from receive().
+                           They are always recorded in self.errors, and otherwise ignored.
+        """
+        self.firmware_version = firmware_version
+        self.model = 1 if firmware_version < 20 else 2
+        self.strict = strict
+        self._dacType = np.dtype('<u1') if self.model == 1 else np.dtype('<u2')
+        self.maxCustomPulses = MAX_CUSTOM_PULSES_MODEL_1 if self.model == 1 else MAX_CUSTOM_PULSES
+        self.outputParams = np.zeros((4, len(OUTPUT_PARAM_NAMES)), dtype='int64')  # Device units, by param code
+        self.triggerModes = np.zeros(2, dtype='int64')
+        self.customTrains = {1: self._customTrain(0), 2: self._customTrain(0)}  # {ID: (times (cycles), voltages)}
+        self.outputVoltages = np.zeros(4, dtype='int64')  # DAC codes currently output on each channel
+        self.continuousLoop = np.zeros(4, dtype=bool)
+        self.connected = False
+        self.clientName = None
+        self.lcdMessage = None
+        self.triggerLog = []  # Channel masks of soft triggers (op 77), in the order they were received
+        self.abortCount = 0
+        self.opLog = []  # Op codes received, in order
+        self.errors = []
+        self.sdFiles = {}  # microSD settings files: {name: file bytes} (Pulse Pal 2)
+        self.settingsFileName = DEFAULT_SETTINGS_FILE
+        self._handlers = {72: self._handshake, 73: self._programAll, 74: self._programParam,
+                          75: self._customTrainHandler(1), 76: self._customTrainHandler(2), 77: self._softTrigger,
+                          78: self._lcdMessage, 79: self._fixedVoltage, 80: self._abort, 81: self._disconnect,
+                          82: self._continuousLoop, 89: self._clientName}
+        if self.model == 2:
+            self._handlers.update({85: self._readSettingsFile, 90: self._settingsFileOp})
+        self._input = bytearray()
+        self._output = bytearray()
+        self._parser = self._parse()
+        self._nBytesNeeded = next(self._parser)
+        self._loadDefaultParameters()
+
+    def receive(self, message_bytes):
+        """
+        Processes bytes received from the client, and returns the bytes the device replies with.
+        Messages may arrive split across calls, or several in one call.
+
+        Raises:
+            PulsePalEmulatorError: If strict is True, and the bytes include a message the firmware would mishandle.
+        """
+        n_errors = len(self.errors)
+        self._input += message_bytes
+        while len(self._input) >= self._nBytesNeeded:
+            chunk = bytes(self._input[:self._nBytesNeeded])
+            del self._input[:self._nBytesNeeded]
+            self._nBytesNeeded = self._parser.send(chunk)
+        reply = bytes(self._output)
+        self._output.clear()
+        if self.strict and len(self.errors) > n_errors:
+            raise PulsePalEmulatorError('Error: ' + '. '.join(self.errors[n_errors:]) + '.')
+        return reply
+
+    def param(self, param_name, channel):
+        """
+        Returns an output channel parameter in device units (cycles of 50us for times, DAC codes for voltages).
+
+        Args:
+            param_name (str): The parameter name, as in PulsePalObject.outputParameterNames
+            channel (int): The output channel (1-4)
+        """
+        return int(self.outputParams[channel - 1, OUTPUT_PARAM_NAMES.index(param_name)])
+
+    def settingsFile(self):
+        """
+        Returns the bytes of a microSD settings file holding the current parameters (as saved by op 90).
+        """
+        channel_params = np.zeros(4, dtype=[('times', '<u4', 8), ('isBiphasic', 'u1'), ('voltages', '<u2', 3),
+                                            ('customTrain', 'u1', 3)])
+        channel_params['times'] = self.outputParams[:, _TIME_PARAMS]
+        channel_params['isBiphasic'] = self.outputParams[:, 0]
+        channel_params['voltages'] = self.outputParams[:, _VOLTAGE_PARAMS]
+        channel_params['customTrain'] = self.outputParams[:, 13:16]
+        trigger_params = np.zeros(2, dtype=[('mode', 'u1'), ('links', 'u1', 4)])
+        trigger_params['mode'] = self.triggerModes
+        trigger_params['links'] = self.outputParams[:, _LINK_PARAMS].T
+        return channel_params.tobytes() + trigger_params.tobytes() + bytes([SETTINGS_FILE_TERMINATOR])
+
+    # Message parsing. _parse() is a generator that yields the number of bytes it needs next, and is sent them.
+    # Op handlers are generators in the same style, so each one reads its message as the firmware does.
+
+    def _parse(self):
+        while True:
+            byte = yield 1
+            if byte[0] != OP_MENU_BYTE:
+                continue  # The firmware discards bytes until the op menu byte
+            op_code = (yield 1)[0]
+            self.opLog.append(op_code)
+            handler = self._handlers.get(op_code)
+            if handler is None:
+                self._error('Unsupported op code ' + str(op_code))
+                continue
+            yield from handler()
+
+    def _handshake(self):
+        self._output += bytes([HANDSHAKE_RESPONSE]) + np.uint32(self.firmware_version).astype('<u4').tobytes()
+        self.connected = True
+        return
+        yield
+
+    def _programAll(self):
+        times = np.frombuffer((yield 128), dtype='<u4').reshape(4, 8)
+        self.outputParams[:, _TIME_PARAMS] = times
+        if self.model == 1:
+            self.outputParams[:, _MODEL_1_BYTE_PARAMS] = np.frombuffer((yield 28), dtype='u1').reshape(4, 7)
+        else:
+            self.outputParams[:, _VOLTAGE_PARAMS] = np.frombuffer((yield 24), dtype='<u2').reshape(4, 3)
+            self.outputParams[:, _MODEL_2_BYTE_PARAMS] = np.frombuffer((yield 16), dtype='u1').reshape(4, 4)
+        self.outputParams[:, _LINK_PARAMS] = np.frombuffer((yield 8), dtype='u1').reshape(2, 4).T
+        self.triggerModes[:] = np.frombuffer((yield 2), dtype='u1')
+        self._output.append(1)
+        self.outputVoltages[:] = self.outputParams[:, 16]
+
+    def _programParam(self):
+        param_code, channel = (yield 2)
+        if param_code in (2, 3, 17):
+            value_type = self._dacType
+        elif 4 <= param_code <= 11:
+            value_type = np.dtype('<u4')
+        elif 1 <= param_code <= len(OUTPUT_PARAM_NAMES) or param_code == TRIGGER_MODE_CODE:
+            value_type = np.dtype('u1')
+        else:  # The firmware reads no value for an unknown parameter code, and acknowledges
+            self._error('Unknown parameter code ' + str(param_code))
+            self._output.append(1)
+            return
+        value = int(np.frombuffer((yield value_type.itemsize), dtype=value_type)[0])
+        if param_code == TRIGGER_MODE_CODE:
+            if self._validChannel(channel, 2):
+                self.triggerModes[channel - 1] = value
+        elif self._validChannel(channel, 4):
+            self.outputParams[channel - 1, param_code - 1] = value
+            if param_code == 17:
+                self.outputVoltages[channel - 1] = value
+        self._output.append(1)
+
+    def _customTrainHandler(self, train_id):
+        def handler():
+            correction = 0
+            if self.model == 1:
+                correction = (yield 1)[0]  # Pulse Pal 1 drops the last pulse if this byte is 1
+            n_pulses = int(np.frombuffer((yield 4), dtype='<u4')[0])
+            times = np.frombuffer((yield 4 * n_pulses), dtype='<u4')
+            voltages = np.frombuffer((yield self._dacType.itemsize * n_pulses), dtype=self._dacType)
+            if correction == 1:
+                times, voltages = times[:-1], voltages[:-1]
+            if len(times) > self.maxCustomPulses:
+                self._error('Custom train ' + str(train_id) + ' has ' + str(len(times)) + ' pulses. The firmware '
+                            'stores up to ' + str(self.maxCustomPulses))
+            else:
+                self.customTrains[train_id] = (times.copy(), voltages.copy())
+            self._output.append(1)
+        return handler
+
+    def _softTrigger(self):
+        self.triggerLog.append((yield 1)[0])
+
+    def _lcdMessage(self):
+        message_length = (yield 1)[0]
+        self.lcdMessage = (yield message_length).replace(b'\xfe', b'\n').decode('ascii', 'replace')
+
+    def _fixedVoltage(self):
+        channel = (yield 1)[0]
+        value = int(np.frombuffer((yield self._dacType.itemsize), dtype=self._dacType)[0])
+        if self._validChannel(channel, 4):
+            self.outputVoltages[channel - 1] = value
+        self._output.append(1)
+
+    def _abort(self):
+        self.abortCount += 1
+        self.outputVoltages[:] = self.outputParams[:, 16]
+        return
+        yield
+
+    def _disconnect(self):
+        self.connected = False
+        self.clientName = None
+        self.outputVoltages[:] = self.outputParams[:, 16]
+        return
+        yield
+
+    def _continuousLoop(self):
+        channel, state = (yield 2)
+        if self._validChannel(channel, 4):
+            self.continuousLoop[channel - 1] = bool(state)
+            if not state:
+                self.outputVoltages[channel - 1] = self.outputParams[channel - 1, 16]
+        self._output.append(1)
+
+    def _clientName(self):
+        self.clientName = (yield 6).decode('ascii', 'replace')
+
+    def _readSettingsFile(self):
+        self._output += self.sdFiles.get(self.settingsFileName, bytes(SETTINGS_FILE_SIZE))[:SETTINGS_FILE_SIZE - 1]
+        return
+        yield
+
+    def _settingsFileOp(self):
+        settings_op, name_length = (yield 2)
+        self.settingsFileName = (yield name_length).decode('ascii', 'replace')
+        if settings_op == 1:  # Save
+            self.sdFiles[self.settingsFileName] = self.settingsFile()
+        elif settings_op == 2:  # Load. On success, the device returns the loaded parameters in op 73 order.
+            settings_file = self.sdFiles.get(self.settingsFileName, b'')
+            if len(settings_file) == SETTINGS_FILE_SIZE and settings_file[-1] == SETTINGS_FILE_TERMINATOR:
+                self._restoreSettingsFile(settings_file)
+                self._output += self.outputParams[:, _TIME_PARAMS].astype('<u4').tobytes()
+                self._output += self.outputParams[:, _VOLTAGE_PARAMS].astype('<u2').tobytes()
+                self._output += self.outputParams[:, _MODEL_2_BYTE_PARAMS].astype('u1').tobytes()
+                self._output += self.outputParams[:, _LINK_PARAMS].T.astype('u1').tobytes()
+                self._output += self.triggerModes.astype('u1').tobytes()
+            else:  # The firmware loads (and saves) default parameters, and returns nothing
+                self._loadDefaultParameters()
+                self.settingsFileName = 'defaultSettings.pps'
+        elif settings_op == 3:  # Delete
+            self.sdFiles.pop(self.settingsFileName, None)
+
+    def _restoreSettingsFile(self, settings_file):
+        channel_params = np.frombuffer(settings_file, count=4, dtype=[('times', '<u4', 8), ('isBiphasic', 'u1'),
+                                                                       ('voltages', '<u2', 3), ('customTrain', 'u1', 3)])
+        trigger_params = np.frombuffer(settings_file, count=2, offset=channel_params.nbytes,
+                                       dtype=[('mode', 'u1'), ('links', 'u1', 4)])
+        self.outputParams[:, _TIME_PARAMS] = channel_params['times']
+        self.outputParams[:, 0] = channel_params['isBiphasic']
+        self.outputParams[:, _VOLTAGE_PARAMS] = channel_params['voltages']
+        self.outputParams[:, 13:16] = channel_params['customTrain']
+        self.outputParams[:, _LINK_PARAMS] = trigger_params['links'].T
+        self.triggerModes[:] = trigger_params['mode']
+
+    def _loadDefaultParameters(self):
+        """
+        Loads the firmware's default parameters (LoadDefaultParameters() in the firmware), and saves them to the
+        current settings file on Pulse Pal 2.
+        """
+        self.outputParams[:, _TIME_PARAMS] = [2, 2, 2, 20, 0, 0, 20000, 0]
+        if self.model == 1:
+            self.outputParams[:, _VOLTAGE_PARAMS] = [192, 192, 128]
+        else:
+            self.outputParams[:, _VOLTAGE_PARAMS] = [49152, 16384, 32768]
+        self.outputParams[:, [0, 12, 13, 14, 15]] = 0
+        self.outputParams[:, 11] = 1
+        self.triggerModes[:] = 0
+        self.outputVoltages[:] = self.outputParams[:, 16]
+        if self.model == 2:
+            self.sdFiles[self.settingsFileName] = self.settingsFile()
+
+    def _customTrain(self, n_pulses):
+        return np.zeros(n_pulses, dtype='<u4'), np.zeros(n_pulses, dtype=self._dacType)
+
+    def _validChannel(self, channel, n_channels):
+        if 1 <= channel <= n_channels:
+            return True
+        self._error('Invalid channel ' + str(channel) + ' in op ' + str(self.opLog[-1]))
+        return False
+
+    def _error(self, message):
+        self.errors.append(message)  # Raised by receive() if strict, after the bytes received are processed
+
+
+class EmulatedSerial(object):
+    def __init__(self, emulator=None, latency=0, bandwidth=None, timeout=10):
+        """
+        An in-process serial link to an emulated Pulse Pal, with PySerial's interface.
+        Pass it to PulsePalObject in place of a port name.
+
+        Args:
+            emulator (PulsePalEmulator): The emulated device. A Pulse Pal 2 with firmware 21 is created if None.
+            latency (float): Seconds added to each round-trip (from the end of a write, until its reply can be read)
+            bandwidth (float): Link speed in bytes/second. Writes occupy the link in sequence. None for no limit.
+            timeout (float): Seconds a read waits for the requested bytes, as in PySerial
+        """
+        self.emulator = emulator if emulator is not None else PulsePalEmulator()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.timeout = timeout
+        self.is_open = True
+        self.bytesWritten = 0
+        self._replies = collections.deque()  # (time the reply can be read, reply bytes)
+        self._readBuffer = bytearray()
+        self._linkFreeTime = 0  # Time the link finishes sending the previous write
+        self._lostWriteBytes = 0  # Faults set by injectFault()
+        self._lostReplyBytes = 0
+        self._condition = threading.Condition()
+
+    def injectFault(self, lost_reply_bytes=0, lost_write_bytes=0, stray_bytes=b''):
+        """
+        Simulates link faults, to test recovery (see PulsePalObject.resync()).
+
+        Args:
+            lost_reply_bytes (int): The next reply bytes from the device to drop
+            lost_write_bytes (int): Bytes to drop from the end of the next write, so the device waits for the rest
+            stray_bytes (bytes): Bytes to place in the input now, as if the device had sent them
+        """
+        with self._condition:
+            self._lostReplyBytes += lost_reply_bytes
+            self._lostWriteBytes += lost_write_bytes
+            self._readBuffer += stray_bytes
+            self._condition.notify_all()
+
+    def write(self, message_bytes):
+        message_bytes = bytes(message_bytes)
+        with self._condition:
+            arrival_time = max(time.perf_counter(), self._linkFreeTime)
+            if self.bandwidth:
+                arrival_time += len(message_bytes) / self.bandwidth
+            self._linkFreeTime = arrival_time
+            self.bytesWritten += len(message_bytes)
+            n_bytes_written = len(message_bytes)
+            if self._lostWriteBytes:
+                n_lost = min(self._lostWriteBytes, len(message_bytes))
+                self._lostWriteBytes -= n_lost
+                message_bytes = message_bytes[:len(message_bytes) - n_lost]
+            reply = self.emulator.receive(message_bytes)
+            if reply and self._lostReplyBytes:
+                n_lost = min(self._lostReplyBytes, len(reply))
+                self._lostReplyBytes -= n_lost
+                reply = reply[n_lost:]
+            if reply:
+                self._replies.append((arrival_time + self.latency, reply))
+                self._condition.notify_all()
+        return n_bytes_written
+
+    def read(self, n_bytes=1):
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        with self._condition:
+            while True:
+                self._receiveReplies()
+                if len(self._readBuffer) >= n_bytes:
+                    break
+                now = time.perf_counter()
+                wait_time = None if deadline is None else deadline - now
+                if wait_time is not None and wait_time <= 0:
+                    break
+                if self._replies:  # Wait until the next reply arrives
+                    next_reply_time = self._replies[0][0] - now
+                    wait_time = next_reply_time if wait_time is None else min(wait_time, next_reply_time)
+                self._condition.wait(wait_time)
+            message_bytes = bytes(self._readBuffer[:n_bytes])
+            del self._readBuffer[:n_bytes]
+        return message_bytes
+
+    def inWaiting(self):
+        with self._condition:
+            self._receiveReplies()
+            return len(self._readBuffer)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._receiveReplies()
+            self._readBuffer.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def _receiveReplies(self):
+        now = time.perf_counter()
+        while self._replies and self._replies[0][0] <= now:
+            self._readBuffer += self._replies.popleft()[1]
+
+
+class EmulatorPty(object):
+    def __init__(self, emulator=None, latency=0, bandwidth=None):
+        """
+        Serves an emulated Pulse Pal on a pseudo-terminal (POSIX only), so any serial client can connect to it
+        by port name, e.g. PulsePalObject(EmulatorPty().port_name).
+
+        Args:
+            emulator (PulsePalEmulator): The emulated device. A Pulse Pal 2 with firmware 21 is created if None.
+            latency (float): Seconds added before each reply is sent
+            bandwidth (float): Link speed in bytes/second. None for no limit.
+        """
+        import pty
+        import tty
+        self.emulator = emulator if emulator is not None else PulsePalEmulator()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port_name = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='PulsePal emulator', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stops serving, and closes the pseudo-terminal.
+        """
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _serve(self):
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            message_bytes = os.read(self._master, 65536)
+            if self.bandwidth:
+                time.sleep(len(message_bytes) / self.bandwidth)
+            try:
+                reply = self.emulator.receive(message_bytes)
+            except PulsePalEmulatorError:
+                continue  # Recorded in self.emulator.errors
+            if reply:
+                if self.latency:
+                    time.sleep(self.latency)
+                os.write(self._master, reply)
+
+
+class PulsePalEmulatorError(Exception):
+    pass
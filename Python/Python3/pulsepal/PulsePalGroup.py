@@ -0,0 +1,225 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalGroup manages several Pulse Pals as one. Devices are connected, synced and sent custom trains
+# concurrently (one thread per device), so setup time does not grow with the number of devices.
+# Group soft triggers and aborts are pre-encoded, then written to each device back-to-back from one thread,
+# which gives a smaller inter-device skew than waking one thread per device. The host-side spread of each
+# group trigger (from the first write starting to the last write returning) is measured and reported.
+#
+# Example:
+#   rig = PulsePalGroup(['COM3', 'COM4', 'COM5'])  # or PulsePalGroup.discover()
+#   for device in rig:
+#       device.phase1Voltage[1] = 5
+#   rig.syncAllParams()
+#   report = rig.triggerOutputChannels(1, 0, 0, 0)
+#   print(report.spread)  # Seconds
+
+from .PulsePal import PulsePalObject, PulsePalError, _ABORT_MESSAGE, _TRIGGER_MESSAGES
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import time
+
+# USB vendor and product IDs of Pulse Pal serial ports: Arduino Due native port (Pulse Pal 2), Maple (Pulse Pal 1)
+PULSE_PAL_USB_IDS = ((0x2341, 0x003E), (0x2A03, 0x003E), (0x1EAF, 0x0004))
+
+TriggerReport = collections.namedtuple('TriggerReport', ['startTime', 'writeTimes', 'spread'])
+TriggerReport.__doc__ = """
+The host-side timing of a group trigger or abort.
+    startTime (float): time.perf_counter() when the first write started
+    writeTimes (list): Seconds from startTime until each device's write returned, in device order
+    spread (float): Seconds from startTime until the last write returned
+"""
+
+
+class PulsePalGroup(object):
+    def __init__(self, port_names, max_workers=None):
+        """
+        Connects to several Pulse Pals concurrently.
+
+        Args:
+            port_names (list): The USB serial ports of the devices (or any ports accepted by PulsePalObject)
+            max_workers (int): Threads used for concurrent operations. Defaults to one per device.
+
+        Raises:
+            PulsePalError: If any device fails to connect. Devices that did connect are disconnected.
+        """
+        self.portNames = list(port_names)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or max(len(self.portNames), 1))
+        self.devices = []
+        self.lastTriggerReport = None
+        results = self._runAll(PulsePalObject, [(port_name,) for port_name in self.portNames], raise_errors=False)
+        errors = [(port_name, result) for port_name, result in zip(self.portNames, results)
+                  if isinstance(result, Exception)]
+        if errors:
+            for result in results:
+                if isinstance(result, PulsePalObject):
+                    result.disconnect()
+            self._executor.shutdown()
+            raise PulsePalError('Error: could not connect to ' + ', '.join(str(port_name) + ' (' + str(error) + ')'
+                                                                        for port_name, error in errors) + '.')
+        self.devices = results
+
+    @classmethod
+    def discover(cls, max_workers=None):
+        """
+        Connects to every USB serial port whose USB IDs match a Pulse Pal (see PULSE_PAL_USB_IDS).
+
+        Raises:
+            PulsePalError: If no Pulse Pal ports are found, or if a device fails to connect.
+        """
+        port_names = findPulsePalPorts()
+        if not port_names:
+            raise PulsePalError('Error: no Pulse Pal serial ports were found.')
+        return cls(port_names, max_workers)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __getitem__(self, index):
+        return self.devices[index]
+
+    def syncAllParams(self, force_full=False):
+        """
+        Runs syncAllParams() on every device concurrently. See PulsePalObject.syncAllParams()
+
+        Raises:
+            PulsePalError: If any device fails. The error lists each failed device.
+        """
+        self._runAll(PulsePalObject.syncAllParams, [(device, force_full) for device in self.devices])
+
+    def programOutputChannelParam(self, param_name, channel, value):
+        """
+        Programs the same output channel parameter on every device concurrently.
+        """
+        self._runAll(PulsePalObject.programOutputChannelParam,
+                     [(device, param_name, channel, value) for device in self.devices])
+
+    def sendCustomPulseTrain(self, custom_train_id, pulse_times, pulse_voltages):
+        """
+        Sends a custom pulse train to every device concurrently. pulse_times and pulse_voltages may be given once
+        for all devices, or as a list with one entry per device.
+        """
+        self._runAll(PulsePalObject.sendCustomPulseTrain,
+                     [(device, custom_train_id, times, voltages) for device, times, voltages in
+                      zip(self.devices, self._perDevice(pulse_times), self._perDevice(pulse_voltages))])
+
+    def sendCustomWaveform(self, custom_train_id, pulse_width, pulse_voltages, compact=False):
+        """
+        Sends a custom waveform to every device concurrently. pulse_voltages may be given once for all devices,
+        or as a list with one entry per device. Returns each device's WaveformUpload, in device order.
+        """
+        return self._runAll(PulsePalObject.sendCustomWaveform,
+                            [(device, custom_train_id, pulse_width, voltages, compact) for device, voltages in
+                             zip(self.devices, self._perDevice(pulse_voltages))])
+
+    def triggerOutputChannels(self, channel1, channel2, channel3, channel4):
+        """
+        Soft-triggers the same output channels on every device, with the smallest host-side skew possible.
+        Devices with writeBehind set sync their changed parameters first (concurrently).
+
+        Returns:
+            TriggerReport: The host-side timing of the trigger. Also stored in self.lastTriggerReport.
+        """
+        write_behind = [device for device in self.devices if device.writeBehind]
+        if write_behind:
+            self._runAll(PulsePalObject.syncAllParams, [(device,) for device in write_behind])
+        trigger_byte = (1*channel1) + (2*channel2) + (4*channel3) + (8*channel4)
+        if not 0 <= trigger_byte < 16:
+            raise PulsePalError('Error: triggerOutputChannels() takes 1 (trigger) or 0 for each channel.')
+        return self._writeAll([_TRIGGER_MESSAGES[trigger_byte]] * len(self.devices))
+
+    def abortPulseTrains(self):
+        """
+        Aborts pulse trains on every device, with the smallest host-side skew possible.
+
+        Returns:
+            TriggerReport: The host-side timing of the abort. Also stored in self.lastTriggerReport.
+        """
+        return self._writeAll([_ABORT_MESSAGE] * len(self.devices))
+
+    def disconnect(self):
+        """
+        Disconnects every device, and stops the group's threads.
+        """
+        for device in self.devices:
+            device.disconnect()
+        self.devices = []
+        self._executor.shutdown()
+
+    def _writeAll(self, messages):
+        """
+        Writes one pre-encoded message to each device, back-to-back, and measures the host-side spread.
+        """
+        write_functions = [device.Port.write_bytes for device in self.devices]
+        write_times = [0.0] * len(messages)
+        start_time = time.perf_counter()
+        for i, (write, message) in enumerate(zip(write_functions, messages)):
+            write(message)
+            write_times[i] = time.perf_counter()
+        report = TriggerReport(start_time, [write_time - start_time for write_time in write_times],
+                               (write_times[-1] - start_time) if write_times else 0.0)
+        self.lastTriggerReport = report
+        return report
+
+    def _perDevice(self, values):
+        """
+        Returns values for each device: values itself if it is a list with one entry per device,
+        or values repeated for every device.
+        """
+        if isinstance(values, list) and len(values) == len(self.devices) and \
+                all(hasattr(value, '__len__') for value in values):
+            return values
+        return [values] * len(self.devices)
+
+    def _runAll(self, function, arg_lists, raise_errors=True):
+        """
+        Calls function with each list of arguments concurrently, and returns the results in order.
+        If raise_errors is True, failures are raised together as one PulsePalError. Otherwise, exceptions are
+        returned in place of results.
+        """
+        futures = [self._executor.submit(function, *args) for args in arg_lists]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as error:
+                results.append(error)
+        if raise_errors:
+            errors = [(i, result) for i, result in enumerate(results) if isinstance(result, Exception)]
+            if errors:
+                raise PulsePalError('Error: ' + str(len(errors)) + ' of ' + str(len(results)) + ' devices failed: ' +
+                                    '; '.join(str(self.portNames[i]) + ': ' + str(error) for i, error in errors))
+        return results
+
+    def __del__(self):
+        if getattr(self, 'devices', None):
+            self.disconnect()
+
+
+def findPulsePalPorts():
+    """
+    Returns the names of USB serial ports whose USB IDs match a Pulse Pal (see PULSE_PAL_USB_IDS).
+    """
+    from serial.tools import list_ports
+    return sorted(port.device for port in list_ports.comports() if (port.vid, port.pid) in PULSE_PAL_USB_IDS)
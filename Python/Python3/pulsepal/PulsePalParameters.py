@@ -0,0 +1,177 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The parameter store of PulsePalObject. Parameters are kept in structured NumPy arrays with one record per channel
+# (4 output channels, 2 trigger channels) and one float64 field per parameter, in user units: volts, seconds, or
+# integer values. All fields are float64 so that the output channel records can also be viewed as one channels x
+# parameters matrix, which is converted and validated in single vectorized operations, and so that invalid values
+# (e.g. isBiphasic = 2) are kept until validation reports them.
+# The store is exposed in two ways:
+#   ParameterField: one parameter on every channel, indexed by channel number, e.g. myPulsePal.phase1Voltage[2] = 5.
+#                   Index 0 reads as NaN, as in the NaN-padded lists that held parameters before.
+#   ChannelParameters: every parameter of one channel, as attributes, e.g. myPulsePal.outputChannel(2).phase1Voltage
+# Both are views: changes are written to the store directly.
+#
+# Example:
+#   store = np.zeros(4, dtype=OUTPUT_PARAMS_DTYPE)
+#   phase1_voltage = ParameterField(store['phase1Voltage'])
+#   phase1_voltage[1] = 5  # store[0]['phase1Voltage'] is now 5.0
+#   channel2 = ChannelParameters(store, 1)
+#   channel2.phase1Duration = 0.002
+
+from .PulsePalValidation import OUTPUT_PARAMETER_NAMES
+import operator
+import numpy as np
+
+OUTPUT_PARAMS_DTYPE = np.dtype([(name, 'float64') for name in OUTPUT_PARAMETER_NAMES])
+TRIGGER_PARAMS_DTYPE = np.dtype([('triggerMode', 'float64')])
+
+_NAN = float('nan')  # Element 0 of every field, so that fields compare equal to lists built from them
+
+
+class ParameterField(object):
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        """
+        A view of one parameter on every channel, indexed from 1 like the channels. Supports indexing, slicing,
+        iteration, len() and comparison with lists. Use tolist() for a list copy.
+
+        Args:
+            values (ndarray): The parameter's float64 values, one per channel (a field of a parameter store)
+        """
+        self._values = values
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) and operator.index(index) > 0:
+            return self._values.item(index - 1)
+        return self.tolist()[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            values = self.tolist()
+            values[index] = value
+            if len(values) != len(self):
+                raise ValueError('Error: parameters have one value per channel; a slice cannot change their number.')
+            values, index, value = self._values, slice(None), values[1:]
+        else:
+            channel = operator.index(index)
+            if channel < 0:
+                channel += len(self)  # Negative indexes count from the end, as in __getitem__ (-1 is the last channel)
+            if not 0 < channel < len(self):
+                raise IndexError('Error: channels are numbered from 1 to ' + str(len(self) - 1) + '. Index ' +
+                                 str(index) + ' is not a channel.')
+            values, index = self._values, channel - 1
+        try:
+            values[index] = value
+        except ValueError:
+            raise TypeError('Error: Pulse Pal parameters must be numbers, not ' + repr(value) + '.') from None
+
+    def assign(self, values):
+        """
+        Sets every channel's value, from a list in the field format (with element 0 ignored) or one value per channel
+        """
+        values = list(values)
+        if len(values) == len(self):
+            values = values[1:]
+        elif len(values) != len(self._values):
+            raise ValueError('Error: expected ' + str(len(self._values)) + ' values (one per channel), got ' +
+                             str(len(values)) + '.')
+        self[1:] = values
+
+    def tolist(self):
+        """ Returns the values as a list: [nan, channel 1 value, ...] """
+        return [_NAN] + self._values.tolist()
+
+    def __len__(self):
+        return len(self._values) + 1
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        try:
+            other = list(other)
+        except TypeError:
+            return NotImplemented
+        return len(other) == len(self) and self._values.tolist() == other[1:]
+
+    __hash__ = None
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.tolist(), dtype=dtype)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+class ChannelParameters(object):
+    __slots__ = ('_record', 'channel')
+
+    def __init__(self, store, index):
+        """
+        A view of every parameter of one channel, as attributes (e.g. view.phase1Voltage).
+
+        Args:
+            store (ndarray): A structured parameter store (OUTPUT_PARAMS_DTYPE or TRIGGER_PARAMS_DTYPE)
+            index (int): The channel's record (channel number - 1)
+        """
+        object.__setattr__(self, '_record', store[index:index + 1])
+        object.__setattr__(self, 'channel', index + 1)
+
+    def __getattr__(self, name):
+        if name in self._record.dtype.fields:
+            return self._record[name].item(0)
+        raise AttributeError(type(self).__name__ + ' has no parameter ' + repr(name))
+
+    def __setattr__(self, name, value):
+        if name not in self._record.dtype.fields:
+            raise AttributeError(type(self).__name__ + ' has no parameter ' + repr(name))
+        try:
+            self._record[name] = value
+        except ValueError:
+            raise TypeError('Error: Pulse Pal parameters must be numbers, not ' + repr(value) + '.') from None
+
+    def todict(self):
+        """ Returns the channel's parameters as {param name: value} """
+        return {name: self._record[name].item(0) for name in self._record.dtype.names}
+
+    def __dir__(self):
+        return list(self._record.dtype.names) + ['channel', 'todict']
+
+    def __repr__(self):
+        return 'ChannelParameters(channel=' + str(self.channel) + ', ' + repr(self.todict()) + ')'
+
+
+class ParameterFieldAttribute(object):
+    def __init__(self, name):
+        """
+        Exposes a parameter of an object's store as a ParameterField attribute. Assigning a list to the attribute
+        sets every channel (see ParameterField.assign()). The object keeps its fields in a _paramFieldViews dict.
+        """
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return obj._paramFieldViews[self.name]
+
+    def __set__(self, obj, values):
+        obj._paramFieldViews[self.name].assign(values)
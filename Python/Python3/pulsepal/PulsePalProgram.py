@@ -0,0 +1,208 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalProgram is a reusable stimulation configuration: a value for every parameter field, and optionally custom
+# trains. Programs are built from a PulsePalObject's current fields, a dict, or a JSON file, and do not change once
+# built. A program is compiled once per Pulse Pal model: its parameters are validated, converted and encoded as the
+# full program message (op 73) syncAllParams() would send, followed by its custom train uploads. Applying it with
+# PulsePalObject.applyProgram() sends the compiled bytes in one write, checks the acknowledgements, and sets the
+# object's parameter fields to the program's values.
+# The dict and JSON format gives each output channel parameter as a list of 4 values (channels 1-4), and triggerMode
+# as a list of 2 values. Parameters not given take their default value (see PulsePalObject.set2DefaultParams()).
+# Lists in the parameter field format, with a leading NaN (e.g. from readSettingsFile()), are also accepted.
+#
+# Example:
+#   baseline = PulsePalProgram.fromPulsePal(myPulsePal)
+#   burst = PulsePalProgram.fromJSON('burst.json')
+#   for trial in range(100):
+#       myPulsePal.applyProgram(burst if trial % 2 else baseline)  # Compiled on first use, then one write each
+#       myPulsePal.triggerOutputChannels(1, 1, 0, 0)
+
+from .PulsePal import (PulsePalObject, _compileFrames, _convertProgram, _encodeProgram, _encodeCustomTrain,
+                      _raiseViolations)
+from .PulsePalValidation import OUTPUT_PARAMETER_NAMES, validateParams, validateCustomTrain
+import collections
+import json
+import math
+import types
+import numpy as np
+
+CompiledProgram = collections.namedtuple('CompiledProgram', ['model', 'message', 'params', 'triggerModes',
+                                                             'customTrainMessages', 'fields', 'fieldMatrix',
+                                                             'fieldTriggerModes'])
+CompiledProgram.__doc__ = """
+A PulsePalProgram encoded for one Pulse Pal model.
+    model (int): The Pulse Pal model (1 or 2)
+    message (bytes): The full program (op 73), followed by each custom train upload, sent in one write
+    params (ndarray): Output channel parameters in device units, as in PulsePalObject._programImage()
+    triggerModes (ndarray): The trigger mode of each trigger channel
+    customTrainMessages (dict): Each custom train upload, by custom train ID
+    fields (dict): The program's parameter values, as {param name: (channel 1 value, ...)}, including 'triggerMode'
+    fieldMatrix (ndarray): The output channel parameter values as a float64 matrix, as in
+                           PulsePalObject.parameterMatrix()
+    fieldTriggerModes (ndarray): The trigger modes as float64 values, as in the parameter store
+"""
+
+_FIELD_NAMES = OUTPUT_PARAMETER_NAMES + ('triggerMode',)
+
+
+def _defaultFields():
+    defaults = types.SimpleNamespace()
+    PulsePalObject.set2DefaultParams(defaults)
+    return {name: tuple(getattr(defaults, name)[1:]) for name in _FIELD_NAMES}
+
+
+class PulsePalProgram(object):
+    def __init__(self, params=None, custom_trains=None):
+        """
+        Builds a program. See also fromPulsePal(), fromDict() and fromJSON().
+
+        Args:
+            params (dict): Parameter values, as {param name: [channel 1 value, ...]} (see above). Parameters not given
+                           take their default value.
+            custom_trains (dict): Custom trains to upload with the program, as {ID: (pulse_times, pulse_voltages)}
+                                  (see PulsePalObject.sendCustomPulseTrain())
+
+        Raises:
+            ValueError: If a parameter name is unknown, or a parameter does not have one value per channel.
+        """
+        fields = _defaultFields()
+        for name, values in (params or {}).items():
+            if name not in fields:
+                raise ValueError('Error: ' + repr(name) + ' is not a Pulse Pal parameter.')
+            values = list(values)
+            n_channels = len(fields[name])
+            if len(values) == n_channels + 1 and isinstance(values[0], float) and math.isnan(values[0]):
+                values = values[1:]  # A parameter field, with its unused element 0
+            if len(values) != n_channels:
+                raise ValueError('Error: ' + name + ' must have ' + str(n_channels) + ' values (one per channel).')
+            fields[name] = tuple(values)
+        self._fields = fields
+        self._customTrains = {int(custom_train_id): (tuple(pulse_times), tuple(pulse_voltages))
+                              for custom_train_id, (pulse_times, pulse_voltages) in (custom_trains or {}).items()}
+        self._compiled = {}  # CompiledProgram for each model compiled so far
+
+    @classmethod
+    def fromPulsePal(cls, pulse_pal, custom_trains=None):
+        """
+        Builds a program from a PulsePalObject's current parameter fields (which need not be synced).
+
+        Args:
+            pulse_pal (PulsePalObject): The Pulse Pal
+            custom_trains (dict): Custom trains to upload with the program (see __init__())
+        """
+        return cls({name: getattr(pulse_pal, name)[1:] for name in _FIELD_NAMES}, custom_trains)
+
+    @classmethod
+    def fromDict(cls, program_dict):
+        """
+        Builds a program from a dict in the format written by toDict(): parameters by name, and optionally
+        'customTrains' as {ID: [pulse_times, pulse_voltages]}. IDs may be strings, as in JSON.
+        """
+        params = dict(program_dict)
+        custom_trains = params.pop('customTrains', None)
+        return cls(params, custom_trains)
+
+    @classmethod
+    def fromJSON(cls, path):
+        """
+        Builds a program from a JSON file (see fromDict() and saveJSON())
+        """
+        with open(path) as program_file:
+            return cls.fromDict(json.load(program_file))
+
+    def toDict(self):
+        """
+        Returns the program as a dict of lists, e.g. to save as JSON (see fromDict())
+        """
+        program_dict = {name: list(values) for name, values in self._fields.items()}
+        if self._customTrains:
+            program_dict['customTrains'] = {str(custom_train_id): [list(pulse_times), list(pulse_voltages)]
+                                            for custom_train_id, (pulse_times, pulse_voltages)
+                                            in sorted(self._customTrains.items())}
+        return program_dict
+
+    def saveJSON(self, path):
+        """
+        Saves the program to a JSON file (see fromJSON())
+        """
+        with open(path, 'w') as program_file:
+            json.dump(self.toDict(), program_file, indent=1)
+
+    @property
+    def fields(self):
+        """ The program's parameter values, as {param name: (channel 1 value, ...)}, including 'triggerMode' """
+        return dict(self._fields)
+
+    @property
+    def customTrains(self):
+        """ The program's custom trains, as {ID: (pulse_times, pulse_voltages)} """
+        return dict(self._customTrains)
+
+    def compile(self, model):
+        """
+        Validates and encodes the program for a Pulse Pal model. The result is kept, so each model is compiled once.
+
+        Args:
+            model (int): The Pulse Pal model (1 or 2, see PulsePalObject._model)
+
+        Returns:
+            CompiledProgram: The encoded program
+
+        Raises:
+            PulsePalValidationError: If a parameter or custom train is invalid on this model.
+        """
+        compiled = self._compiled.get(model)
+        if compiled is None:
+            compiled = self._compiled[model] = self._compile(model)
+        return compiled
+
+    def _compile(self, model):
+        dac_bitmax = PulsePalObject.DAC_BITMAX_MODEL_1 if model == 1 else PulsePalObject.DAC_BITMAX_MODEL_2
+        cycle_frequency = PulsePalObject.CYCLE_FREQUENCY
+        fields = np.array([self._fields[name] for name in OUTPUT_PARAMETER_NAMES], dtype='float64').T
+        trigger_modes = list(self._fields['triggerMode'])
+        violations = validateParams(fields, trigger_modes, dac_bitmax, cycle_frequency)
+        for custom_train_id, (pulse_times, pulse_voltages) in sorted(self._customTrains.items()):
+            violations.extend(validateCustomTrain(custom_train_id, pulse_times, pulse_voltages, dac_bitmax,
+                                                  cycle_frequency))
+        _raiseViolations(violations)
+        frames = _compileFrames(model)
+        params, trigger_modes = _convertProgram(fields, trigger_modes, dac_bitmax, cycle_frequency)
+        params.setflags(write=False)
+        trigger_modes.setflags(write=False)
+        custom_train_messages = {custom_train_id: bytes(_encodeCustomTrain(frames, custom_train_id, pulse_times,
+                                                                           pulse_voltages, dac_bitmax, cycle_frequency))
+                                 for custom_train_id, (pulse_times, pulse_voltages)
+                                 in sorted(self._customTrains.items())}
+        message = bytes(_encodeProgram(frames, model, params, trigger_modes)) + b''.join(custom_train_messages.values())
+        fields.setflags(write=False)
+        field_trigger_modes = np.array(self._fields['triggerMode'], dtype='float64')
+        field_trigger_modes.setflags(write=False)
+        return CompiledProgram(model, message, params, trigger_modes, custom_train_messages, dict(self._fields), fields,
+                               field_trigger_modes)
+
+    def __eq__(self, other):
+        if not isinstance(other, PulsePalProgram):
+            return NotImplemented
+        return self._fields == other._fields and self._customTrains == other._customTrains
+
+    def __repr__(self):
+        return 'PulsePalProgram(' + repr(self.toDict()) + ')'
@@ -0,0 +1,635 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalRenderer computes the voltage a Pulse Pal 2 would output for a set of parameters and trigger events,
+# without a device. It runs the pulse train state machine of Firmware/PulsePal_2_0_1 (including its edge rules,
+# e.g. a pulse that cannot finish before the end of a burst is not started, and soft triggers that arrive while a
+# channel is playing are held until it finishes), on the firmware's 20kHz cycle grid.
+# The state machine is only evaluated on cycles where a transition is due, and a stretch of output that repeats
+# (e.g. the pulses of a burst, or the bursts of a train) is replicated with NumPy instead of being re-evaluated.
+# Output is generated in chunks, so long sessions can be rendered in bounded memory.
+#
+# Example:
+#   renderer = PulsePalRenderer(myPulsePal)  # Copies the parameter fields of a PulsePalObject
+#   renderer.setCustomPulseTrain(1, [0, 0.001, 0.002], [5, -5, 5])
+#   triggers = [(0.1, [1, 2]), (2.5, [1])]  # Soft triggers: (time, output channels)
+#   for chunk in renderer.render(60, triggers):  # 60 seconds, one array of shape (nSamples, 4) per second
+#       ...
+#   output = renderer.renderAll(5, triggers)  # Or the whole session as one array
+
+from .PulsePalConversion import seconds2Cycles, volts2Bits
+import numpy as np
+
+_UINT32 = 2**32
+_NO_EVENT = float('inf')
+_NO_LINE_EVENTS = ((0, 0), (0, 0))
+_TIME_PARAMS = slice(3, 11)  # Columns of the parameter image holding times (codes 4-11)
+_VOLTAGE_PARAMS = [1, 2, 16]  # Columns holding voltages (codes 2, 3 and 17)
+
+
+class PulsePalRenderer(object):
+    CYCLE_FREQUENCY = 20000  # Hz
+    DAC_BITMAX = 65535  # Pulse Pal 2 (16-bit DAC)
+    BLOCK_SIZE = 65536  # Maximum DAC writes generated per channel before they are rendered
+
+    def __init__(self, pulse_pal):
+        """
+        Initializes a renderer with a copy of a Pulse Pal's parameter fields.
+
+        Args:
+            pulse_pal: A PulsePalObject, or any object with the same parameter fields (e.g. phase1Voltage,
+                       triggerMode) and an outputParameterNames list. Later changes to it are not seen by the renderer.
+                       The copied fields can be edited on the renderer (e.g. renderer.phase1Voltage[1] = 3).
+        """
+        self.outputParameterNames = list(pulse_pal.outputParameterNames)
+        for name in self.outputParameterNames + ['triggerMode']:
+            setattr(self, name, list(getattr(pulse_pal, name)))
+        self.continuousLoop = [float('nan'), 0, 0, 0, 0]
+        self._customTrains = [(np.zeros(0, dtype='uint32'), np.zeros(0, dtype='uint16'))]*2
+
+    def setCustomPulseTrain(self, custom_train_id, pulse_times, pulse_voltages):
+        """
+        Sets the pulse times and voltages of a custom pulse train, as PulsePalObject.sendCustomPulseTrain() does.
+
+        Args:
+            custom_train_id (int): The ID of the custom train to set (1-2)
+            pulse_times (list or ndarray of float): The times at which each pulse should occur. Units = seconds.
+            pulse_voltages (list or ndarray of float): The voltages for each pulse. Units = volts.
+        """
+        self._customTrains[custom_train_id - 1] = (seconds2Cycles(pulse_times, self.CYCLE_FREQUENCY),
+                                                   volts2Bits(pulse_voltages, self.DAC_BITMAX))
+
+    def setCustomWaveform(self, custom_train_id, pulse_width, pulse_voltages):
+        """
+        Sets a custom waveform, as PulsePalObject.sendCustomWaveform() does.
+
+        Args:
+            custom_train_id (int): The ID of the custom train to set (1-2)
+            pulse_width (float): The width of each pulse in the waveform. Units = seconds.
+            pulse_voltages (list or ndarray of float): The voltages for each pulse in the waveform. Units = volts.
+        """
+        n_pulses = len(pulse_voltages)
+        pulse_width_cycles = seconds2Cycles(pulse_width, self.CYCLE_FREQUENCY)
+        self._customTrains[custom_train_id - 1] = (np.arange(n_pulses, dtype='uint32')*pulse_width_cycles,
+                                                   volts2Bits(pulse_voltages, self.DAC_BITMAX))
+
+    def setContinuousLoop(self, channel, state):
+        """
+        Sets the continuous loop state of an output channel. In continuous loop mode, a triggered pulse train plays
+        until it is stopped by a trigger channel (PulsePalObject.setContinuousLoop() also triggers the channel. To
+        render that, add a soft trigger at the time the loop is started).
+
+        Args:
+            channel (int): The output channel (1-4)
+            state (int): 1 for on, 0 for off
+        """
+        self.continuousLoop[channel] = state
+
+    def render(self, duration, triggers=(), line_events=(), chunk_duration=1, units='volts'):
+        """
+        Renders the output of all four channels, one chunk at a time. Sample n is the output during hardware cycle n.
+        A trigger handled on cycle n changes the output from cycle n+1, as the firmware writes the DAC at the start
+        of the cycle after a transition.
+
+        Args:
+            duration (float): The length of the rendering. Units = seconds.
+            triggers (iterable): Soft triggers, as (time, channels) pairs. channels is a list of output channels (1-4)
+                                 and time (seconds) is when the device handles the trigger (about one cycle after
+                                 the USB command arrives).
+            line_events (iterable): Trigger channel input changes, as (time, trigger_channel, level) tuples.
+                                    level is 1 when a trigger channel becomes active, and 0 when it becomes inactive.
+                                    Both trigger channels start inactive.
+            chunk_duration (float): The length of each chunk. Units = seconds.
+            units (str): 'volts' for float64 voltages, or 'bits' for uint16 DAC values.
+
+        Yields:
+            ndarray: The output of the next chunk, with shape (nSamples, 4). The last chunk may be shorter.
+        """
+        if units not in ('volts', 'bits'):
+            raise ValueError("Error: units must be 'volts' or 'bits'.")
+        n_samples = self._toCycles(duration)
+        chunk_size = self._toCycles(chunk_duration)
+        if chunk_size < 1:
+            raise ValueError('Error: chunk_duration must be at least one cycle.')
+        params, trigger_modes = self._programImage()
+        timeline = self._timeline(triggers, line_events)
+        channels = [_ChannelSimulator(channel, params[channel], trigger_modes, self.continuousLoop[channel + 1],
+                                      self._customTrains, timeline, n_samples, self.BLOCK_SIZE) for channel in range(4)]
+        outputs = [_ChannelOutput(channel.writes(), channel.restingVoltage) for channel in channels]
+        for start in range(0, n_samples, chunk_size):
+            end = min(start + chunk_size, n_samples)
+            chunk = np.empty((end - start, 4), dtype='uint16')
+            for channel, output in enumerate(outputs):
+                chunk[:, channel] = output.fill(start, end)
+            if units == 'volts':
+                chunk = chunk*(20/self.DAC_BITMAX) - 10
+            yield chunk
+
+    def renderAll(self, duration, triggers=(), line_events=(), units='volts'):
+        """
+        Renders the output of all four channels as one array. See render() for arguments.
+
+        Returns:
+            ndarray: The output, with shape (nSamples, 4)
+        """
+        chunks = list(self.render(duration, triggers, line_events, units=units))
+        if not chunks:
+            return np.zeros((0, 4), dtype='float64' if units == 'volts' else 'uint16')
+        return np.concatenate(chunks)
+
+    def _toCycles(self, seconds):
+        return int(round(seconds*self.CYCLE_FREQUENCY))
+
+    def _programImage(self):
+        """
+        Converts the parameter fields to device units, as PulsePalObject does for Pulse Pal 2.
+        """
+        fields = np.array([getattr(self, name)[1:5] for name in self.outputParameterNames], dtype='float64').T
+        params = np.empty((4, 17), dtype='int64')
+        params[:] = fields  # Single byte params
+        params[:, _TIME_PARAMS] = seconds2Cycles(fields[:, _TIME_PARAMS], self.CYCLE_FREQUENCY)
+        params[:, _VOLTAGE_PARAMS] = volts2Bits(fields[:, _VOLTAGE_PARAMS], self.DAC_BITMAX)
+        trigger_modes = [int(mode) for mode in self.triggerMode[1:3]]
+        return params.tolist(), trigger_modes
+
+    def _timeline(self, triggers, line_events):
+        """
+        Merges trigger events into one entry per cycle on which something happens:
+        (cycle, soft trigger channel bits, [trigger channel 1 event, trigger channel 2 event], [levels]).
+        Trigger channel events are coded as in the firmware: 1 = became active, 2 = became inactive, 0 = no change.
+        """
+        soft_bits = {}
+        for time, trigger_channels in triggers:
+            cycle = self._toCycles(time)
+            for channel in trigger_channels:
+                soft_bits[cycle] = soft_bits.get(cycle, 0) | (1 << (int(channel) - 1))
+        new_levels = {}
+        for time, trigger_channel, level in sorted(line_events, key=lambda event: event[0]):
+            new_levels.setdefault(self._toCycles(time), {})[int(trigger_channel) - 1] = 1 if level else 0
+        timeline = []
+        levels = [0, 0]
+        for cycle in sorted(set(soft_bits) | set(new_levels)):
+            events = [0, 0]
+            for trigger_channel, level in new_levels.get(cycle, {}).items():
+                if level != levels[trigger_channel]:
+                    events[trigger_channel] = 1 if level else 2
+                    levels[trigger_channel] = level
+            timeline.append((cycle, soft_bits.get(cycle, 0), events, list(levels)))
+        return timeline
+
+
+class _ChannelOutput(object):
+    """
+    Turns one channel's stream of DAC writes into output samples.
+    """
+    def __init__(self, writes, resting_voltage):
+        self._writes = writes
+        self._times = np.zeros(0, dtype='int64')
+        self._values = np.zeros(0, dtype='uint16')
+        self._value = resting_voltage  # Output before the first pending write
+        self._done = False
+
+    def fill(self, start, end):
+        # Pull writes until one takes effect after this chunk (or there are no more)
+        while not self._done and (self._times.size == 0 or self._times[-1] + 1 < end):
+            block = next(self._writes, None)
+            if block is None:
+                self._done = True
+            else:
+                self._times = np.concatenate((self._times, block[0]))
+                self._values = np.concatenate((self._values, block[1]))
+        n_in_chunk = np.searchsorted(self._times + 1, end)  # Writes that take effect before the end of the chunk
+        starts = np.concatenate(([start], self._times[:n_in_chunk] + 1))
+        values = np.concatenate(([self._value], self._values[:n_in_chunk]))
+        # Each value lasts until the next write. Writes on the same cycle give zero-length runs, so the last one wins.
+        samples = np.repeat(values, np.diff(np.append(starts, end)))
+        if n_in_chunk:
+            self._value = self._values[n_in_chunk - 1]
+            self._times = self._times[n_in_chunk:]
+            self._values = self._values[n_in_chunk:]
+        return samples
+
+
+class _ChannelSimulator(object):
+    """
+    The pulse train state machine of one output channel, transcribed from the main loop of Firmware/PulsePal_2_0_1.
+    Variable names follow the firmware. Times are cycles since the start of the rendering.
+    """
+    def __init__(self, channel, params, trigger_modes, continuous_loop, custom_trains, timeline, n_samples,
+                 block_size):
+        (self.isBiphasic, self.phase1Voltage, self.phase2Voltage, self.phase1Duration, self.interPhaseInterval,
+         self.phase2Duration, self.interPulseInterval, self.burstDuration, self.burstInterval,
+         self.pulseTrainDuration, self.pulseTrainDelay, link1, link2, self.customTrainID, self.customTrainTarget,
+         self.customTrainLoop, self.restingVoltage) = params
+        self.triggerAddress = (link1, link2)
+        self.triggerMode = trigger_modes
+        self.continuousLoopMode = continuous_loop
+        # UsesBursts is derived as when a full program (op 73) is loaded
+        self.usesBursts = not (self.burstDuration == 0 or self.burstInterval == 0)
+        if self.customTrainTarget == 1:
+            self.usesBursts = True
+        if self.customTrainID > 0 and self.customTrainTarget == 0:
+            self.usesBursts = False
+        # CustomTrainID 0 indexes train 2, as the firmware does where it does not check the ID
+        times, voltages = custom_trains[self.customTrainID - 1]
+        self.customTrainNpulses = len(times)
+        # The firmware reads up to 2 entries past the end of a train, which hold 0 on a freshly booted device
+        self.customPulseTimes = times.tolist() + [0, 0]
+        self.customVoltages = voltages.tolist() + [0, 0]
+        self.channel = channel
+        self.timeline = timeline
+        self.nSamples = n_samples
+        self.blockSize = block_size
+        self.preStimulusStatus = 0
+        self.stimulusStatus = 0
+        self.pulseStatus = 0
+        self.burstStatus = 0
+        self.prePulseTrainTimestamp = 0
+        self.pulseTrainTimestamp = 0
+        self.nextPulseTransitionTime = 0
+        self.nextBurstTransitionTime = 0
+        self.pulseTrainEndTime = 0
+        self.customPulseTimeIndex = 0
+        self.softTriggered = 0
+        self.dacValue = self.restingVoltage
+        self._time = 0
+        self._writeTimes = []
+        self._writeValues = []
+
+    def writes(self):
+        """
+        Runs the state machine and yields blocks of DAC writes as (times, values) arrays. A write at time n sets
+        the output from cycle n+1. Stops when later writes could not change the rendered samples.
+        """
+        last_cycle = self.nSamples - 1  # The last cycle whose writes are rendered
+        timeline = [entry for entry in self.timeline if self._isRelevant(entry)]
+        next_entry = 0
+        history = _History()
+        while True:
+            next_external = timeline[next_entry][0] if next_entry < len(timeline) else _NO_EVENT
+            time = min(self._nextTransitionTime(), next_external)
+            if time >= last_cycle:
+                break
+            if time == next_external:
+                if self._writeTimes:
+                    yield self._takeWrites(history)
+                history.clear()  # Output before an external event does not repeat after it
+                _, soft_bits, line_events, levels = timeline[next_entry]
+                next_entry += 1
+                self.softTriggered |= (soft_bits >> self.channel) & 1
+            else:
+                line_events, levels = _NO_LINE_EVENTS
+            self._time = time
+            self._handleTriggers(line_events, levels)  # Also starts a held soft trigger, once the channel is idle
+            self._update()
+            if len(self._writeTimes) >= self.blockSize:
+                yield self._takeWrites(history)
+            following_external = timeline[next_entry][0] if next_entry < len(timeline) else _NO_EVENT
+            for block in self._repeat(history, min(following_external, last_cycle)):
+                yield block
+        yield self._takeWrites(history)
+
+    def _isRelevant(self, entry):
+        _, soft_bits, line_events, _ = entry
+        return bool((soft_bits >> self.channel) & 1 or any(self.triggerAddress[y] and line_events[y] for y in range(2)))
+
+    def _write(self, value):
+        self.dacValue = value
+        self._writeTimes.append(self._time)
+        self._writeValues.append(value)
+
+    def _takeWrites(self, history):
+        block = (np.array(self._writeTimes, dtype='int64'), np.array(self._writeValues, dtype='uint16'))
+        history.append(block)
+        self._writeTimes = []
+        self._writeValues = []
+        return block
+
+    def _nextTransitionTime(self):
+        """
+        Returns the next time a check in the state machine can succeed. The firmware compares times for equality
+        once per cycle, so a transition time that has already passed never occurs.
+        """
+        candidates = []
+        if self.preStimulusStatus:
+            candidates.append(self.prePulseTrainTimestamp + self.pulseTrainDelay)
+        if self.stimulusStatus:
+            if self.burstStatus:
+                candidates.append(self.nextPulseTransitionTime)
+            if self.usesBursts:
+                candidates.append(self.nextBurstTransitionTime)
+            candidates.append(self.pulseTrainEndTime)
+        elif self.softTriggered and not self.preStimulusStatus:
+            candidates.append(self._time + 1)  # A soft trigger held while the channel was playing
+        candidates = [candidate for candidate in candidates if candidate > self._time]
+        return min(candidates) if candidates else _NO_EVENT
+
+    def _kill(self):
+        self.customPulseTimeIndex = 0
+        self.preStimulusStatus = 0
+        self.stimulusStatus = 0
+        self.pulseStatus = 0
+        self.burstStatus = 0
+        self._write(self.restingVoltage)
+
+    def _handleTriggers(self, line_events, levels):
+        if self.stimulusStatus or self.preStimulusStatus:
+            kill = False
+            for y in range(2):
+                if self.triggerAddress[y]:
+                    if self.triggerMode[y] == 1 and line_events[y] == 1:  # Toggle mode
+                        kill = True
+                    if self.triggerMode[y] == 2 and line_events[y] == 2:  # Pulse gated mode
+                        if self.triggerMode[1 - y] == 2 and self.triggerAddress[1 - y]:
+                            if not levels[1 - y]:
+                                kill = True
+                        else:
+                            kill = True
+            if kill:
+                self._kill()
+        else:
+            if (self.triggerAddress[0] and line_events[0] == 1) or self.softTriggered:
+                self._trigger()
+                self.softTriggered = 0
+            if self.triggerAddress[1] and line_events[1] == 1:
+                self._trigger()
+
+    def _trigger(self):
+        self.preStimulusStatus = 1
+        self.burstStatus = 1
+        self.prePulseTrainTimestamp = self._time
+        self.pulseStatus = 0
+
+    def _customPulseInterval(self):
+        # Difference of two unsigned longs, so the read past the end of a train (0) wraps to a large interval
+        index = self.customPulseTimeIndex
+        return (self.customPulseTimes[index + 1] - self.customPulseTimes[index]) % _UINT32
+
+    def _mirroredCustomVoltage(self):
+        # Phase 2 of a biphasic custom pulse is phase 1 mirrored about 0V, in a uint16
+        return (65536 - self.customVoltages[self.customPulseTimeIndex]) % 65536
+
+    def _update(self):
+        time = self._time
+        n_pulses = self.customTrainNpulses
+        is_custom = self.customTrainID > 0
+        if self.preStimulusStatus:
+            if time == self.prePulseTrainTimestamp + self.pulseTrainDelay:
+                self.preStimulusStatus = 0
+                self.stimulusStatus = 1
+                self.pulseStatus = 0
+                self.pulseTrainTimestamp = time
+                self.pulseTrainEndTime = time + self.pulseTrainDuration
+                if self.customTrainTarget == 1:
+                    self.nextBurstTransitionTime = time + self.customPulseTimes[0]
+                    self.burstStatus = 0
+                else:
+                    self.nextBurstTransitionTime = time + self.burstDuration
+                if not is_custom:
+                    self.nextPulseTransitionTime = time
+                    self._write(self.phase1Voltage)
+                else:
+                    self.nextPulseTransitionTime = time + self.customPulseTimes[0]
+                    self.customPulseTimeIndex = 0
+        if not self.stimulusStatus:
+            return
+        if self.burstStatus:
+            if self.pulseStatus == 0:  # Inter-pulse interval
+                if not is_custom or self.customTrainTarget == 1:
+                    if time == self.nextPulseTransitionTime:
+                        self.nextPulseTransitionTime = time + self.phase1Duration
+                        # Does not start a pulse it cannot finish before the burst ends
+                        if not (self.usesBursts and self.nextPulseTransitionTime >= self.nextBurstTransitionTime):
+                            self.pulseStatus = 1
+                            if is_custom and self.customTrainTarget == 1:
+                                self._write(self.customVoltages[self.customPulseTimeIndex])
+                            else:
+                                self._write(self.phase1Voltage)
+                elif time == self.nextPulseTransitionTime:
+                    skip_next_interval = False
+                    if self.customTrainLoop and self.customPulseTimeIndex == n_pulses:
+                        self.customPulseTimeIndex = 0
+                        self.pulseTrainTimestamp = time
+                    if self.customPulseTimeIndex < n_pulses:
+                        if self._customPulseInterval() > self.phase1Duration:
+                            self.nextPulseTransitionTime = time + self.phase1Duration
+                        else:
+                            self.nextPulseTransitionTime = (self.pulseTrainTimestamp +
+                                                            self.customPulseTimes[self.customPulseTimeIndex + 1])
+                            skip_next_interval = True
+                    if not skip_next_interval:
+                        self.pulseStatus = 1
+                    self._write(self.customVoltages[self.customPulseTimeIndex])
+                    if not self.isBiphasic:
+                        self.customPulseTimeIndex += 1
+                    if self.customPulseTimeIndex > n_pulses:
+                        self.customPulseTimeIndex = 0
+                        if not self.customTrainLoop:
+                            self._kill()
+            elif self.pulseStatus == 1:  # Phase 1
+                if time == self.nextPulseTransitionTime:
+                    if not self.isBiphasic:
+                        if not is_custom:
+                            self.nextPulseTransitionTime = time + self.interPulseInterval
+                            self.pulseStatus = 0
+                            self._write(self.restingVoltage)
+                        else:
+                            if self.customTrainTarget == 0:
+                                self.nextPulseTransitionTime = (self.pulseTrainTimestamp +
+                                                                self.customPulseTimes[self.customPulseTimeIndex])
+                            else:
+                                self.nextPulseTransitionTime = time + self.interPulseInterval
+                            if self.customPulseTimeIndex == n_pulses:
+                                if self.customTrainLoop:
+                                    self.customPulseTimeIndex = 0
+                                    self.pulseTrainTimestamp = time
+                                    self._write(self.customVoltages[0])
+                                    self.pulseStatus = 1 if self._customPulseInterval() > self.phase1Duration else 0
+                                    self.nextPulseTransitionTime = self.pulseTrainTimestamp + self.phase1Duration
+                                    self.customPulseTimeIndex += 1
+                                else:
+                                    self._kill()
+                            else:
+                                self.pulseStatus = 0
+                                self._write(self.restingVoltage)
+                    elif self.interPhaseInterval == 0:
+                        self.nextPulseTransitionTime = time + self.phase2Duration
+                        self.pulseStatus = 3
+                        if not is_custom:
+                            self._write(self.phase2Voltage)
+                        else:
+                            self._write(self._mirroredCustomVoltage())
+                            if self.customTrainTarget == 0:
+                                self.customPulseTimeIndex += 1
+                    else:
+                        self.nextPulseTransitionTime = time + self.interPhaseInterval
+                        self.pulseStatus = 2
+                        self._write(self.restingVoltage)
+            elif self.pulseStatus == 2:  # Inter-phase interval
+                if time == self.nextPulseTransitionTime:
+                    self.nextPulseTransitionTime = time + self.phase2Duration
+                    self.pulseStatus = 3
+                    if not is_custom:
+                        self._write(self.phase2Voltage)
+                    else:
+                        self._write(self._mirroredCustomVoltage())
+                        if self.customTrainTarget == 0:
+                            self.customPulseTimeIndex += 1
+            elif self.pulseStatus == 3:  # Phase 2
+                if time == self.nextPulseTransitionTime:
+                    if is_custom and self.customTrainTarget == 0:
+                        self.nextPulseTransitionTime = (self.pulseTrainTimestamp +
+                                                        self.customPulseTimes[self.customPulseTimeIndex])
+                        if self.customPulseTimeIndex == n_pulses:
+                            self._kill()
+                    else:
+                        self.nextPulseTransitionTime = time + self.interPulseInterval
+                    if is_custom or self.interPulseInterval != 0:
+                        self.pulseStatus = 0
+                        self._write(self.restingVoltage)
+                    else:  # Back-to-back biphasic pulses
+                        self.pulseStatus = 1
+                        self.nextPulseTransitionTime = (self.nextPulseTransitionTime - self.interPulseInterval +
+                                                        self.phase1Duration)
+                        self._write(self.phase1Voltage)
+        if self.usesBursts and time == self.nextBurstTransitionTime:
+            if self.burstStatus:  # Burst ends
+                if not is_custom:
+                    self.nextPulseTransitionTime = time + self.burstInterval
+                    self.nextBurstTransitionTime = time + self.burstInterval
+                elif self.customTrainTarget == 1:
+                    self.customPulseTimeIndex += 1
+                    if self.customPulseTimeIndex == n_pulses:
+                        self._kill()
+                    self.nextPulseTransitionTime = (self.pulseTrainTimestamp +
+                                                    self.customPulseTimes[self.customPulseTimeIndex])
+                    self.nextBurstTransitionTime = self.nextPulseTransitionTime
+                self.burstStatus = 0
+                self._write(self.restingVoltage)
+            else:  # Burst starts
+                self.nextBurstTransitionTime = time + self.burstDuration
+                self.nextPulseTransitionTime = time + self.phase1Duration
+                self.pulseStatus = 1
+                if is_custom and self.customTrainTarget == 1:
+                    if self.customPulseTimeIndex < n_pulses:
+                        self._write(self.customVoltages[self.customPulseTimeIndex])
+                else:
+                    self._write(self.phase1Voltage)
+                self.burstStatus = 1
+        if time == self.pulseTrainEndTime and self.stimulusStatus:
+            if (is_custom and self.customTrainLoop) or not is_custom:
+                if not self.continuousLoopMode:
+                    self._kill()
+
+    def _stateKey(self, include_burst_time):
+        """
+        Returns the state that determines the channel's future output, with times relative to now. If two cycles
+        have the same key, the output between them repeats until an excluded time (or an external event) is reached.
+        """
+        time = self._time
+        return (self.preStimulusStatus, self.stimulusStatus, self.pulseStatus, self.burstStatus,
+                self.customPulseTimeIndex, self.softTriggered, self.dacValue,
+                self.prePulseTrainTimestamp + self.pulseTrainDelay - time if self.preStimulusStatus else None,
+                self.nextPulseTransitionTime - time if self.stimulusStatus else None,
+                self.pulseTrainTimestamp - time if self.stimulusStatus and self.customTrainID > 0 else None,
+                self.nextBurstTransitionTime - time if include_burst_time and self.usesBursts else None)
+
+    def _repeat(self, history, limit):
+        """
+        If the state after the current cycle repeats the state after an earlier cycle, replicates the writes between
+        them as many times as possible before the next time that is not part of the repeat, and yields them in blocks.
+
+        Two keys are tracked: one including the time of the next burst transition (for repeating bursts), and one
+        without it (for repeating pulses within a burst, which is only valid until the burst ends). The train end
+        time is never part of the pattern, so a repeat stops before it.
+        """
+        time = self._time
+        n_writes = history.size + len(self._writeTimes)
+        for include_burst_time in (True, False):
+            key = self._stateKey(include_burst_time)
+            fixed_times = (self.pulseTrainEndTime, None if include_burst_time else self.nextBurstTransitionTime)
+            previous = history.keys[include_burst_time].get(key)
+            history.keys[include_burst_time][key] = (time, n_writes, fixed_times)
+            if previous is None or previous[2] != fixed_times:
+                continue
+            period = time - previous[0]
+            end = limit
+            if self.stimulusStatus and self.pulseTrainEndTime > time:
+                end = min(end, self.pulseTrainEndTime)
+            if not include_burst_time and self.usesBursts and self.stimulusStatus:
+                if self.nextBurstTransitionTime <= time:
+                    continue
+                # A pulse started in a repeat must also not reach the burst end (see _update)
+                end = min(end, self.nextBurstTransitionTime - self.phase1Duration)
+            n_repeats = (end - 1 - time)//period
+            if n_repeats < 1:
+                continue
+            if self._writeTimes:
+                yield self._takeWrites(history)
+            times, values = history.slice(previous[1], n_writes)
+            for block in _replicate(times, values, period, n_repeats, self.blockSize):
+                yield block
+            shift = n_repeats*period
+            self._time += shift
+            self.prePulseTrainTimestamp += shift
+            self.pulseTrainTimestamp += shift
+            self.nextPulseTransitionTime += shift
+            if include_burst_time:
+                self.nextBurstTransitionTime += shift
+            history.clear()
+            return
+        if history.size + len(self._writeTimes) > self.blockSize*4 or len(history.keys[True]) > self.blockSize*4:
+            if self._writeTimes:
+                yield self._takeWrites(history)
+            history.clear()  # Bounds memory for output that does not repeat
+
+
+class _History(object):
+    """
+    The DAC writes of a channel since the last external event, and the state keys seen in that time.
+    """
+    def __init__(self):
+        self.blocks = []
+        self.size = 0
+        self.keys = {True: {}, False: {}}
+
+    def append(self, block):
+        self.blocks.append(block)
+        self.size += block[0].size
+
+    def slice(self, start, end):
+        times = np.concatenate([block[0] for block in self.blocks])
+        values = np.concatenate([block[1] for block in self.blocks])
+        return times[start:end], values[start:end]
+
+    def clear(self):
+        self.blocks = []
+        self.size = 0
+        self.keys = {True: {}, False: {}}
+
+
+def _replicate(times, values, period, n_repeats, block_size):
+    """
+    Yields the writes (times, values) repeated n_repeats times at intervals of period, in blocks of about block_size.
+    """
+    repeats_per_block = max(1, block_size//max(times.size, 1))
+    for first in range(1, n_repeats + 1, repeats_per_block):
+        offsets = np.arange(first, min(first + repeats_per_block, n_repeats + 1), dtype='int64')*period
+        yield (times[np.newaxis, :] + offsets[:, np.newaxis]).ravel(), np.tile(values, offsets.size)
@@ -0,0 +1,161 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Encoder and decoder for Pulse Pal 2's microSD settings files, and for the replies of the settings file ops.
+# A settings file holds one program (the parameters of op 73), not custom trains. Its layout (179 bytes):
+#   For each output channel: 8 time params (uint32, cycles of 50us, in param code order 4-11), isBiphasic (uint8),
+#   phase1Voltage, phase2Voltage and restingVoltage (uint16 DAC codes), customTrainID, customTrainTarget and
+#   customTrainLoop (uint8)
+#   For each trigger channel: triggerMode (uint8), then its link to each output channel (4 x uint8)
+#   A final byte of 252, which marks a valid file
+# Op 85 returns the current file without its final byte. A successful load (op 90) returns the loaded program in
+# op 73 order instead.
+# Programs are given as (params, trigger_modes) in device units, as in PulsePalObject._programImage(): params has
+# one row per output channel and one column per parameter code (column 0 = code 1).
+#
+# Example:
+#   file_bytes = encodeSettingsFile(params, trigger_modes)  # e.g. to copy to the card as 'session1.pps'
+#   params, trigger_modes = decodeSettingsFile(file_bytes)
+
+import numpy as np
+
+SETTINGS_FILE_SIZE = 179
+SETTINGS_FILE_TERMINATOR = 252  # The last byte of a valid settings file
+LOAD_REPLY_SIZE = 178  # Bytes returned by a successful load
+MAX_FILE_NAME_LENGTH = 99  # The firmware copies file names to a 100 byte C string
+
+_SETTINGS_FILE_DTYPE = np.dtype([('channels', [('times', '<u4', 8), ('isBiphasic', 'u1'), ('voltages', '<u2', 3),
+                                               ('customTrain', 'u1', 3)], 4),
+                                 ('triggers', [('mode', 'u1'), ('links', 'u1', 4)], 2),
+                                 ('terminator', 'u1')])
+_LOAD_REPLY_DTYPE = np.dtype([('times', '<u4', (4, 8)), ('voltages', '<u2', (4, 3)), ('byteParams', 'u1', (4, 4)),
+                              ('links', 'u1', (2, 4)), ('triggerModes', 'u1', 2)])
+_TIME_COLUMNS = slice(3, 11)  # Columns of params holding time params (codes 4-11)
+_VOLTAGE_COLUMNS = [1, 2, 16]  # Columns holding voltage params (codes 2, 3 and 17)
+_CUSTOM_TRAIN_COLUMNS = slice(13, 16)  # customTrainID, customTrainTarget, customTrainLoop (codes 14-16)
+_LINK_COLUMNS = [11, 12]  # linkTriggerChannel1 and linkTriggerChannel2 (codes 12-13)
+
+
+def encodeSettingsFile(params, trigger_modes):
+    """
+    Encodes a program as a settings file.
+
+    Args:
+        params (array-like): Output channel parameters in device units, shape (4, 17) (see above)
+        trigger_modes (array-like): The trigger mode of each trigger channel
+
+    Returns:
+        bytes: The settings file (SETTINGS_FILE_SIZE bytes)
+    """
+    params = np.asarray(params)
+    settings = np.zeros((), _SETTINGS_FILE_DTYPE)
+    channels = settings['channels']
+    channels['times'] = params[:, _TIME_COLUMNS]
+    channels['isBiphasic'] = params[:, 0]
+    channels['voltages'] = params[:, _VOLTAGE_COLUMNS]
+    channels['customTrain'] = params[:, _CUSTOM_TRAIN_COLUMNS]
+    settings['triggers']['mode'] = trigger_modes
+    settings['triggers']['links'] = params[:, _LINK_COLUMNS].T
+    settings['terminator'] = SETTINGS_FILE_TERMINATOR
+    return settings.tobytes()
+
+
+def decodeSettingsFile(file_bytes):
+    """
+    Decodes a settings file, or the reply to op 85 (the file without its final byte).
+
+    Args:
+        file_bytes (bytes-like): The settings file
+
+    Returns:
+        tuple: (params, trigger_modes) as int64 arrays
+
+    Raises:
+        ValueError: If file_bytes is not a valid settings file.
+    """
+    file_bytes = bytes(file_bytes)
+    if len(file_bytes) == SETTINGS_FILE_SIZE - 1:
+        file_bytes += bytes([SETTINGS_FILE_TERMINATOR])
+    if len(file_bytes) != SETTINGS_FILE_SIZE or file_bytes[-1] != SETTINGS_FILE_TERMINATOR:
+        raise ValueError('Error: not a valid Pulse Pal settings file (' + str(len(file_bytes)) + ' bytes).')
+    settings = np.frombuffer(file_bytes, _SETTINGS_FILE_DTYPE)[0]
+    params = np.empty((4, 17), dtype='int64')
+    params[:, _TIME_COLUMNS] = settings['channels']['times']
+    params[:, 0] = settings['channels']['isBiphasic']
+    params[:, _VOLTAGE_COLUMNS] = settings['channels']['voltages']
+    params[:, _CUSTOM_TRAIN_COLUMNS] = settings['channels']['customTrain']
+    params[:, _LINK_COLUMNS] = settings['triggers']['links'].T
+    return params, settings['triggers']['mode'].astype('int64')
+
+
+def decodeLoadReply(reply_bytes):
+    """
+    Decodes the program returned by a successful load (op 90), which is in op 73 order.
+
+    Returns:
+        tuple: (params, trigger_modes) as int64 arrays
+    """
+    reply = np.frombuffer(bytes(reply_bytes), _LOAD_REPLY_DTYPE)[0]
+    params = np.empty((4, 17), dtype='int64')
+    params[:, _TIME_COLUMNS] = reply['times']
+    params[:, _VOLTAGE_COLUMNS] = reply['voltages']
+    params[:, [0, 13, 14, 15]] = reply['byteParams']  # isBiphasic, customTrainID, customTrainTarget, customTrainLoop
+    params[:, _LINK_COLUMNS] = reply['links'].T
+    return params, reply['triggerModes'].astype('int64')
+
+
+def isValidProgram(params, trigger_modes):
+    """
+    Returns True if the single byte params of a decoded program are in range. A file of other data (or an empty
+    card's reply) decodes without error, but usually fails this check.
+    """
+    return not (params[:, [0, 11, 12, 13, 14, 15]].max() > 2 or params[:, [0, 11, 12, 14, 15]].max() > 1 or
+                np.max(trigger_modes) > 2)
+
+
+def firmwareDefaults():
+    """
+    Returns the program the firmware loads when a settings file is invalid (LoadDefaultParameters() in the firmware),
+    as (params, trigger_modes).
+    """
+    params = np.zeros((4, 17), dtype='int64')
+    params[:, _TIME_COLUMNS] = [2, 2, 2, 20, 0, 0, 20000, 0]
+    params[:, _VOLTAGE_COLUMNS] = [49152, 16384, 32768]  # +5V, -5V, 0V
+    params[:, 11] = 1  # Trigger channel 1 is linked to all outputs
+    return params, np.zeros(2, dtype='int64')
+
+
+def checkFileName(file_name):
+    """
+    Returns a settings file name encoded for the firmware.
+
+    Raises:
+        ValueError: If the name is not ASCII, has no extension (e.g. 'session1.pps'), or is longer than
+                    MAX_FILE_NAME_LENGTH.
+    """
+    try:
+        name_bytes = file_name.encode('ascii')
+    except (AttributeError, UnicodeEncodeError):
+        raise ValueError('Error: the settings file name must be an ASCII string.') from None
+    if '.' not in file_name:
+        raise ValueError('Error: the settings file name must have an extension, e.g. session1.pps')
+    if not 1 <= len(name_bytes) <= MAX_FILE_NAME_LENGTH:
+        raise ValueError('Error: settings file names can be at most ' + str(MAX_FILE_NAME_LENGTH) + ' characters.')
+    return name_bytes
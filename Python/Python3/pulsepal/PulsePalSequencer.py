@@ -0,0 +1,287 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalSequencer runs a schedule of trials with no conversion or encoding while it runs. Each trial sets some
+# parameters, optionally uploads custom trains, and optionally soft-triggers output channels. The whole schedule is
+# compiled when the sequencer is created: parameters are validated, converted and encoded as the messages
+# syncAllParams() would send (only the parameters that differ from the previous trial, after a full program for the
+# first trial), and each trial's messages are joined into one block of bytes. Running a trial writes its block and
+# reads its acknowledgements.
+# Trials are advanced by calling advance() (e.g. from a hardware event callback), or by run(), which calls a wait
+# function before each trial. A trial's setup can also be sent ahead of time with arm(), so that only the 3 byte
+# trigger is sent when the trial starts. The host time of each send is logged.
+# The sequencer writes to the port directly. Use it with a PulsePalObject, not a ThreadedPulsePalObject or
+# AsyncPulsePalObject, and do not send other commands while a schedule runs.
+#
+# Example:
+#   trials = [Trial(params={'phase1Voltage': {1: voltage}}, trigger=(1, 0, 0, 0)) for voltage in (1, 2, 5, 10)]
+#   sequencer = PulsePalSequencer(myPulsePal, trials)  # Compiles the schedule
+#   sequencer.run(wait=lambda trial: time.sleep(0.5))
+#   print([entry.sendTime for entry in sequencer.log])
+
+from .PulsePal import PulsePalError
+import collections
+import time
+
+Trial = collections.namedtuple('Trial', ['params', 'customTrains', 'trigger'], defaults=(None, None, None))
+Trial.__doc__ = """
+One trial of a schedule.
+    params (dict): Parameters to set, as {param name: {channel: value}}, e.g. {'phase1Voltage': {1: 5, 2: 2.5}}.
+                   Trigger modes are set as {'triggerMode': {channel: mode}}. Other parameters keep their value from
+                   the previous trial.
+    customTrains (dict): Custom trains to upload before the trial, as {ID: (pulse_times, pulse_voltages)} (see
+                         PulsePalObject.sendCustomPulseTrain())
+    trigger (tuple): The output channels to soft-trigger, as (channel1, channel2, channel3, channel4) with 1 to
+                     trigger a channel and 0 if not. None for no soft-trigger (e.g. if the trial is triggered by a
+                     trigger channel).
+"""
+
+TrialLog = collections.namedtuple('TrialLog', ['trial', 'armTime', 'sendTime', 'ackTime', 'nBytes'])
+TrialLog.__doc__ = """
+The host-side timing of one trial. Times are time.perf_counter() values, in seconds.
+    trial (int): The trial's index in the schedule
+    armTime (float): When the trial's setup was written by arm(). None if it was written with the trigger.
+    sendTime (float): When the write that started the trial (its trigger, or its setup if it has no trigger)
+                      returned
+    ackTime (float): When the acknowledgements of the trial's setup were received. None if it had none.
+    nBytes (int): Bytes written for the trial
+"""
+
+_CompiledTrial = collections.namedtuple('_CompiledTrial', ['setup', 'nAcks', 'trigger', 'state'])
+
+
+class PulsePalSequencer(object):
+    def __init__(self, pulse_pal, trials):
+        """
+        Compiles a schedule of trials for a Pulse Pal. Compiling does not send anything, and leaves the Pulse Pal's
+        parameter fields unchanged.
+
+        Args:
+            pulse_pal (PulsePalObject): A connected Pulse Pal
+            trials (list of Trial): The schedule. Parameters not set by the first trial are taken from the Pulse Pal's
+                                    parameter fields.
+
+        Raises:
+            PulsePalError: If a trial is invalid (the error names the trial), or if called inside a transaction.
+        """
+        if pulse_pal._transactionQueue is not None:
+            raise PulsePalError('Error: a schedule cannot be compiled inside a transaction.')
+        self.pulsePal = pulse_pal
+        self.log = []  # A TrialLog for each trial sent, in order
+        self._hooks = []
+        self._compiled = _compileTrials(pulse_pal, list(trials))
+        self._nextTrial = 0
+        self._armed = None  # (arm time, bytes written) if the next trial's setup was sent by arm()
+
+    def __len__(self):
+        return len(self._compiled)
+
+    @property
+    def nextTrial(self):
+        """ The index of the next trial to run. Equal to len(self) when the schedule is done. """
+        return self._nextTrial
+
+    def trialBytes(self, trial):
+        """
+        Returns the precomputed bytes of a trial: (setup, trigger). setup holds its parameter and custom train
+        messages, and trigger its soft-trigger message (empty if it has none).
+        """
+        compiled = self._compiled[trial]
+        return compiled.setup, compiled.trigger
+
+    def addHook(self, hook):
+        """
+        Adds a function called with the TrialLog of each trial after it is sent.
+        """
+        self._hooks.append(hook)
+
+    def removeHook(self, hook):
+        self._hooks.remove(hook)
+
+    def arm(self):
+        """
+        Sends the next trial's setup (parameters and custom trains) and waits for its acknowledgements, so that
+        advance() only sends its trigger. Note: parameters apply as soon as they are received, including on channels
+        still playing the previous trial. Does nothing if the trial is already armed.
+
+        Returns:
+            int: The index of the armed trial
+
+        Raises:
+            PulsePalError: If the schedule is done, or the device does not acknowledge the setup.
+        """
+        compiled = self._compiledNext()
+        if self._armed is None and compiled.setup:
+            arm_time = time.perf_counter()
+            self._send(compiled.setup, compiled.nAcks)
+            self._armed = (arm_time, len(compiled.setup))
+        return self._nextTrial
+
+    def advance(self):
+        """
+        Runs the next trial: sends its precomputed bytes (its setup, unless armed, then its trigger) in one write,
+        and waits for the setup's acknowledgements.
+
+        Returns:
+            TrialLog: The trial's timing
+
+        Raises:
+            PulsePalError: If the schedule is done, or the device does not acknowledge the setup.
+        """
+        compiled = self._compiledNext()
+        if self._armed is None:
+            arm_time, n_armed_bytes = None, 0
+            message, n_acks = compiled.setup + compiled.trigger, compiled.nAcks
+        else:
+            (arm_time, n_armed_bytes), self._armed = self._armed, None
+            message, n_acks = compiled.trigger, 0
+        send_time, ack_time = self._send(message, n_acks)
+        entry = TrialLog(self._nextTrial, arm_time, send_time, ack_time, n_armed_bytes + len(message))
+        _restoreState(self.pulsePal, compiled.state)
+        self._nextTrial += 1
+        self.log.append(entry)
+        for hook in self._hooks:
+            hook(entry)
+        return entry
+
+    def run(self, wait=None, arm_early=False):
+        """
+        Runs the remaining trials.
+
+        Args:
+            wait (function): Called as wait(trial) before each trial, and returns when the trial should start (e.g.
+                             after a delay, or when a hardware event occurs). None to run trials back to back.
+            arm_early (bool): If True, each trial's setup is sent before wait() is called (see arm()), so only its
+                              trigger is sent when it starts.
+
+        Returns:
+            list of TrialLog: The timing of the trials run
+        """
+        entries = []
+        while self._nextTrial < len(self._compiled):
+            if arm_early:
+                self.arm()
+            if wait is not None:
+                wait(self._nextTrial)
+            entries.append(self.advance())
+        return entries
+
+    def reset(self):
+        """
+        Returns to the first trial and clears the log. The first trial sends a full program, so the schedule can be
+        run again from any device state.
+        """
+        self._nextTrial = 0
+        self._armed = None
+        self.log = []
+
+    def _compiledNext(self):
+        if self._nextTrial >= len(self._compiled):
+            raise PulsePalError('Error: all ' + str(len(self._compiled)) + ' trials of the schedule have been run.')
+        return self._compiled[self._nextTrial]
+
+    def _send(self, message, n_acks):
+        """
+        Writes precomputed bytes and receives their acknowledgements. Returns (send time, ack time).
+        """
+        pulse_pal = self.pulsePal
+        if n_acks > 0:
+            pulse_pal._checkSync()
+        pulse_pal.Port.write_bytes(message)
+        send_time = time.perf_counter()
+        if n_acks == 0:
+            return send_time, None
+        pulse_pal._unacknowledgedBytes = len(message)
+        error_type, reply = pulse_pal._receiveAck(n_acks, pulse_pal._ackDeadline(len(message)))
+        ack_time = time.perf_counter()
+        if error_type is not None:
+            self._armed = None
+            pulse_pal._commandFailed(error_type, 'Error: Pulse Pal did not acknowledge the setup of trial ' +
+                                     str(self._nextTrial) + ' of the schedule.')
+        pulse_pal._unacknowledgedBytes = 0
+        return send_time, ack_time
+
+
+def _compileTrials(pulse_pal, trials):
+    """
+    Encodes each trial's messages with the Pulse Pal's own methods, queued as in a transaction and acknowledged
+    without being sent, then restores the Pulse Pal's state.
+    """
+    original_state = _captureState(pulse_pal)
+    tracer, pulse_pal.tracer = pulse_pal.tracer, None  # Nothing is sent while compiling
+    pulse_pal._syncedParams = None  # The first trial sends a full program
+    compiled = []
+    try:
+        for i, trial in enumerate(trials):
+            try:
+                for param_name, values in (trial.params or {}).items():
+                    field = getattr(pulse_pal, param_name)
+                    for channel, value in values.items():
+                        field[channel] = value
+                setup = _capture(pulse_pal, pulse_pal.syncAllParams)
+                for custom_train_id, (pulse_times, pulse_voltages) in sorted((trial.customTrains or {}).items()):
+                    setup += _capture(pulse_pal, pulse_pal.sendCustomPulseTrain, custom_train_id, pulse_times,
+                                      pulse_voltages)
+                trigger = [] if trial.trigger is None else _capture(pulse_pal, pulse_pal.triggerOutputChannels,
+                                                                    *trial.trigger)
+            except (PulsePalError, AttributeError, IndexError, KeyError, TypeError, ValueError) as error:
+                raise PulsePalError('Error: trial ' + str(i) + ' of the schedule is invalid. ' + str(error)) from error
+            compiled.append(_CompiledTrial(b''.join(message for message, _ in setup), sum(n for _, n in setup),
+                                           b''.join(message for message, _ in trigger), _captureState(pulse_pal)))
+    finally:
+        pulse_pal._transactionQueue = None
+        pulse_pal.tracer = tracer
+        _restoreState(pulse_pal, original_state)
+    return compiled
+
+
+def _capture(pulse_pal, method, *args):
+    """
+    Calls a Pulse Pal method with its messages queued instead of sent, and applies their acknowledgement callbacks.
+    Returns the messages, as (message bytes, number of acknowledgement bytes) tuples.
+    """
+    pulse_pal._transactionQueue = []
+    method(*args)
+    queue, pulse_pal._transactionQueue = pulse_pal._transactionQueue, None
+    for _, _, _, on_ack in queue:
+        if on_ack is not None:
+            on_ack()
+    return [(message, n_ack_bytes) for message, n_ack_bytes, _, _ in queue]
+
+
+def _captureState(pulse_pal):
+    """
+    Returns a copy of a Pulse Pal's parameter fields and sync records
+    """
+    fields = (pulse_pal._outputParams.copy(), pulse_pal._triggerParams.copy())
+    synced = None
+    if pulse_pal._syncedParams is not None:
+        synced = (pulse_pal._syncedParams.copy(), pulse_pal._syncedTriggerModes.copy())
+    return fields, synced, dict(pulse_pal._customTrainMessages)
+
+
+def _restoreState(pulse_pal, state):
+    fields, synced, custom_train_messages = state
+    pulse_pal._outputParams[:], pulse_pal._triggerParams[:] = fields
+    if synced is None:
+        pulse_pal._syncedParams = pulse_pal._syncedTriggerModes = None
+    else:
+        pulse_pal._syncedParams, pulse_pal._syncedTriggerModes = synced[0].copy(), synced[1].copy()
+    pulse_pal._customTrainMessages = dict(custom_train_messages)
@@ -0,0 +1,499 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalServer holds one Pulse Pal connection in a long-running process, and shares it with many clients over a
+# Unix socket or TCP. PulsePalProxy is a client with the PulsePalObject API, so scripts connect without repeating
+# the handshake and full parameter sync, and disconnect without ending the device's session.
+#
+# Start a server:
+#   python PulsePalServer.py COM3 /tmp/pulsepal.sock        (or tcp://0.0.0.0:7150 for TCP)
+# Connect a client:
+#   myPulsePal = PulsePalProxy('/tmp/pulsepal.sock')
+#   myPulsePal.programOutputChannelParam('phase1Voltage', 1, 5)
+#   myPulsePal.triggerOutputChannels(1, 0, 0, 0)
+#
+# Scheduling: one thread owns the device. Abort requests are served first. Parameter updates waiting from any
+# client are applied together, and sent with one syncAllParams() (which sends only the changed parameters, as
+# single-parameter writes or one full program). Other requests (triggers, uploads) are served one per client in
+# turn, so one client cannot delay the others' triggers. Each client's own requests are served in order.
+#
+# Wire protocol: each message is a uint32 header length, a uint32 payload length, a JSON header, and a payload of
+# numeric arrays as little-endian float64. Requests are {"method", "args"}; array arguments are replaced by
+# {"array": [offset, length]} into the payload. Replies are {"result"} or {"error", "errorType"}.
+
+from .PulsePal import PulsePalObject, PulsePalError, WaveformUpload, _raiseViolations
+from .PulsePalValidation import validateParam
+import argparse
+import collections
+import json
+import numbers
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import numpy as np
+
+DEFAULT_ADDRESS = 'tcp://127.0.0.1:7150'
+_LENGTHS = struct.Struct('<II')
+_PARAM_METHODS = ('programOutputChannelParam', 'programTriggerChannelParam')
+_DEVICE_METHODS = _PARAM_METHODS + ('syncAllParams', 'sendCustomPulseTrain', 'sendCustomWaveform', 'setFixedVoltage',
+                                    'setContinuousLoop', 'triggerOutputChannels', 'abortPulseTrains')
+_SERVER_METHODS = ('connect', 'getParams', 'setParams')
+
+
+class PulsePalServer(object):
+    def __init__(self, port_name, address=DEFAULT_ADDRESS):
+        """
+        Connects to a Pulse Pal, and prepares to serve it at an address. Call serve_forever() to start serving.
+
+        Args:
+            port_name: The device's USB serial port, or any port accepted by PulsePalObject
+            address (str): 'tcp://host:port' for TCP, or a file path for a Unix socket
+
+        Raises:
+            PulsePalError: If a Unix socket path exists and is not a socket (e.g. a mistyped path to a data file).
+        """
+        if not address.startswith('tcp://'):
+            _removeStaleSocket(address)
+        self.pulsePal = PulsePalObject(port_name)
+        self.address = address
+        self._scheduler = _Scheduler()
+        self._deviceThread = threading.Thread(target=self._serveDevice, name='PulsePal device', daemon=True)
+        self._deviceThread.start()
+        handler = type('Handler', (_ClientHandler,), {'pulsePalServer': self})
+        if address.startswith('tcp://'):
+            host, _, port = address[len('tcp://'):].rpartition(':')
+            self._socketServer = _ThreadingTCPServer((host, int(port)), handler)
+        else:
+            self._socketServer = _ThreadingUnixServer(address, handler)
+
+    def serve_forever(self):
+        """
+        Serves clients until shutdown() is called (from another thread).
+        """
+        self._socketServer.serve_forever()
+
+    def shutdown(self):
+        """
+        Stops serving, and ends the device's session.
+        """
+        self._socketServer.shutdown()
+        self._socketServer.server_close()
+        self._scheduler.submit(None, _Request('stop', ()))
+        self._deviceThread.join()
+        if not self.address.startswith('tcp://') and os.path.exists(self.address):
+            os.remove(self.address)
+        self.pulsePal.disconnect()
+
+    def handle(self, client_id, method, args):
+        """
+        Serves one request from a client, and returns its result. Called by the client's connection thread.
+        """
+        if method not in _DEVICE_METHODS + _SERVER_METHODS:
+            raise PulsePalError('Error: ' + str(method) + ' is not a method served by PulsePalServer.')
+        request = _Request(method, args)
+        self._scheduler.submit(client_id, request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _serveDevice(self):
+        """
+        The device thread. Serves requests in the order chosen by the scheduler.
+        """
+        while True:
+            requests = self._scheduler.next()
+            if requests[0].method == 'stop':
+                return
+            if requests[0].method in _PARAM_METHODS:
+                self._applyParams(requests)
+                continue
+            request = requests[0]
+            try:
+                request.result = self._serveRequest(request.method, request.args)
+            except Exception as error:
+                request.error = error
+            request.done.set()
+
+    def _serveRequest(self, method, args):
+        pulse_pal = self.pulsePal
+        if method == 'connect':
+            return {'firmwareVersion': pulse_pal.firmware_version, 'model': pulse_pal._model,
+                    'outputParameterNames': pulse_pal.outputParameterNames,
+                    'triggerParameterNames': pulse_pal.triggerParameterNames,
+                    'params': self._serveRequest('getParams', ())}
+        if method == 'getParams':
+            return {name: getattr(pulse_pal, name)[1:] for name in _paramNames(pulse_pal)}
+        if method == 'setParams':  # Sets all parameters (e.g. from a client's syncAllParams()), then syncs
+            snapshot = _snapshotParams(pulse_pal)
+            try:
+                for name, values in args[0].items():
+                    if name not in _paramNames(pulse_pal):
+                        raise PulsePalError('Error: ' + str(name) + ' is not a Pulse Pal parameter.')
+                    getattr(pulse_pal, name)[1:] = values
+                pulse_pal.syncAllParams(*args[1:])
+            except Exception:
+                _restoreParams(pulse_pal, snapshot)  # Other clients' syncs must not send the rejected values
+                raise
+            return None
+        return getattr(pulse_pal, method)(*args)
+
+    def _applyParams(self, requests):
+        """
+        Applies parameter updates from any number of clients to the parameter fields, and sends them to the device
+        with one sync. Each update is validated before it is applied, so an invalid update only fails its own request.
+        If the sync fails, the fields are restored and every applied request fails.
+        """
+        pulse_pal = self.pulsePal
+        snapshot = _snapshotParams(pulse_pal)
+        applied = []
+        for request in requests:
+            param_name, channel, value = request.args
+            names = pulse_pal.outputParameterNames if request.method == _PARAM_METHODS[0] else \
+                pulse_pal.triggerParameterNames
+            first_code, n_channels = (1, 4) if request.method == _PARAM_METHODS[0] else (128, 2)
+            try:
+                if not isinstance(param_name, str):
+                    if param_name not in range(first_code, first_code + len(names)):
+                        raise PulsePalError('Error: ' + str(param_name) + ' is not a Pulse Pal parameter code.')
+                    param_name = names[param_name - first_code]
+                if param_name not in names:
+                    raise PulsePalError('Error: ' + str(param_name) + ' is not a Pulse Pal parameter.')
+                if channel not in range(1, n_channels + 1):
+                    raise PulsePalError('Error: ' + str(channel) + ' is not a valid channel for ' + param_name + '.')
+                _raiseViolations(validateParam(names.index(param_name) + first_code, channel, value,
+                                               pulse_pal._dac_bitMax, pulse_pal.CYCLE_FREQUENCY))
+                getattr(pulse_pal, param_name)[channel] = value
+            except (PulsePalError, IndexError, TypeError) as error:
+                request.error = error
+                request.done.set()
+            else:
+                applied.append(request)
+        try:
+            pulse_pal.syncAllParams()
+        except Exception as error:
+            _restoreParams(pulse_pal, snapshot)
+            for request in applied:
+                request.error = error
+        for request in applied:
+            request.done.set()
+
+
+class PulsePalProxy(object):
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        """
+        Connects to a PulsePalServer. The proxy has the PulsePalObject API. Parameter fields (e.g. phase1Voltage)
+        are local copies, read from the server when the proxy connects. As with PulsePalObject, changes to the
+        fields are sent by syncAllParams(), which sets every parameter on the server to this proxy's values.
+
+        Args:
+            address (str): The server's address: 'tcp://host:port', or a Unix socket path
+            timeout (float): Seconds to wait for a reply. None to wait indefinitely.
+
+        Raises:
+            PulsePalError: If the server cannot be reached.
+        """
+        if address.startswith('tcp://'):
+            host, _, port = address[len('tcp://'):].rpartition(':')
+            self._socket = socket.create_connection((host, int(port)), timeout)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            self._socket.connect(address)
+        self._lock = threading.Lock()
+        connection = self._call('connect')
+        self.firmware_version = connection['firmwareVersion']
+        self._model = connection['model']
+        self.outputParameterNames = connection['outputParameterNames']
+        self.triggerParameterNames = connection['triggerParameterNames']
+        self._setFields(connection['params'])
+
+    def set2DefaultParams(self):
+        """ See PulsePalObject.set2DefaultParams(). Only the local fields are changed, until syncAllParams(). """
+        PulsePalObject.set2DefaultParams(self)
+
+    def syncAllParams(self, force_full=False):
+        """ Sets all parameters on the server to this proxy's fields. See PulsePalObject.syncAllParams() """
+        self._call('setParams', {name: getattr(self, name)[1:] for name in _paramNames(self)}, force_full)
+
+    def programOutputChannelParam(self, param_name, channel, value):
+        """ See PulsePalObject.programOutputChannelParam() """
+        self._call('programOutputChannelParam', param_name, channel, value)
+        if not isinstance(param_name, str):
+            param_name = self.outputParameterNames[param_name - 1]
+        getattr(self, param_name)[channel] = value
+
+    def programTriggerChannelParam(self, param_name, channel, value):
+        """ See PulsePalObject.programTriggerChannelParam() """
+        self._call('programTriggerChannelParam', param_name, channel, value)
+        if not isinstance(param_name, str):
+            param_name = self.triggerParameterNames[param_name - 128]
+        getattr(self, param_name)[channel] = value
+
+    def sendCustomPulseTrain(self, custom_train_id, pulse_times, pulse_voltages):
+        """ See PulsePalObject.sendCustomPulseTrain() """
+        self._call('sendCustomPulseTrain', custom_train_id, np.asarray(pulse_times, dtype='float64'),
+                   np.asarray(pulse_voltages, dtype='float64'))
+
+    def sendCustomWaveform(self, custom_train_id, pulse_width, pulse_voltages, compact=False):
+        """ See PulsePalObject.sendCustomWaveform() """
+        return WaveformUpload(*self._call('sendCustomWaveform', custom_train_id, pulse_width,
+                                          np.asarray(pulse_voltages, dtype='float64'), compact))
+
+    def setFixedVoltage(self, channel, voltage):
+        """ See PulsePalObject.setFixedVoltage() """
+        self._call('setFixedVoltage', channel, voltage)
+
+    def setContinuousLoop(self, channel, state):
+        """ See PulsePalObject.setContinuousLoop() """
+        self._call('setContinuousLoop', channel, state)
+
+    def triggerOutputChannels(self, channel1, channel2, channel3, channel4):
+        """ See PulsePalObject.triggerOutputChannels() """
+        self._call('triggerOutputChannels', channel1, channel2, channel3, channel4)
+
+    def abortPulseTrains(self):
+        """ See PulsePalObject.abortPulseTrains() """
+        self._call('abortPulseTrains')
+
+    def refreshParams(self):
+        """
+        Replaces this proxy's parameter fields with the server's (e.g. after another client changed them).
+        """
+        self._setFields(self._call('getParams'))
+
+    def close(self):
+        """
+        Closes the connection to the server. The server's session with the device continues.
+        """
+        self._socket.close()
+
+    def _setFields(self, params):
+        for name, values in params.items():
+            setattr(self, name, [float('nan')] + values)
+
+    def _call(self, method, *args):
+        """
+        Sends a request to the server and returns its result.
+
+        Raises:
+            PulsePalError: If the request fails on the server (other exception types are re-raised as PulsePalError
+                           with the original type in the message), or if the connection to the server is lost.
+        """
+        with self._lock:
+            try:
+                _sendMessage(self._socket, {'method': method, 'args': args})
+                reply = _receiveMessage(self._socket)
+            except (OSError, EOFError) as error:
+                raise PulsePalError('Error: lost connection to the Pulse Pal server (' + str(error) + ').')
+        if 'error' in reply:
+            if reply['errorType'] == 'PulsePalError':
+                raise PulsePalError(reply['error'])
+            raise PulsePalError(reply['errorType'] + ': ' + reply['error'])
+        return reply['result']
+
+    def __del__(self):
+        if hasattr(self, '_socket'):
+            self._socket.close()
+
+
+class _Request(object):
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Scheduler(object):
+    """
+    Orders requests from clients for the device thread. Aborts first, then waiting parameter updates (all together),
+    then one request per client in turn. Each client's requests are served in the order they were submitted.
+    """
+    def __init__(self):
+        self._queues = collections.OrderedDict()  # Client ID: deque of its waiting requests, in turn order
+        self._aborts = collections.deque()
+        self._condition = threading.Condition()
+
+    def submit(self, client_id, request):
+        with self._condition:
+            if request.method in ('abortPulseTrains', 'stop'):
+                self._aborts.append(request)
+            else:
+                self._queues.setdefault(client_id, collections.deque()).append(request)
+            self._condition.notify()
+
+    def next(self):
+        """
+        Waits for requests, and returns the next to serve: a list of parameter updates to apply together,
+        or a list with one other request.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._aborts or self._queues)
+            if self._aborts:
+                return [self._aborts.popleft()]
+            param_updates = []
+            for client_id, queue in list(self._queues.items()):
+                while queue and queue[0].method in _PARAM_METHODS:
+                    param_updates.append(queue.popleft())
+                if not queue:
+                    del self._queues[client_id]
+            if param_updates:
+                return param_updates
+            client_id, queue = next(iter(self._queues.items()))
+            request = queue.popleft()
+            del self._queues[client_id]
+            if queue:
+                self._queues[client_id] = queue  # The client's next request waits for the other clients' turns
+            return [request]
+
+
+class _ClientHandler(socketserver.BaseRequestHandler):
+    pulsePalServer = None
+
+    def handle(self):
+        client_id = id(self)
+        while True:
+            try:
+                request = _receiveMessage(self.request)
+            except (OSError, EOFError):
+                return  # The client disconnected
+            try:
+                reply = {'result': self.pulsePalServer.handle(client_id, request['method'], request['args'])}
+            except Exception as error:
+                reply = {'error': str(error), 'errorType': type(error).__name__}
+            try:
+                _sendMessage(self.request, reply)
+            except OSError:
+                return
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def _snapshotParams(pulse_pal):
+    """
+    Returns a copy of a Pulse Pal's parameter fields (see _restoreParams())
+    """
+    return pulse_pal._outputParams.copy(), pulse_pal._triggerParams.copy()
+
+
+def _restoreParams(pulse_pal, snapshot):
+    pulse_pal._outputParams[:], pulse_pal._triggerParams[:] = snapshot
+
+
+def _removeStaleSocket(address):
+    """
+    Removes a socket file left at a Unix socket path by a server that did not shut down. Any other file is kept.
+    """
+    try:
+        mode = os.lstat(address).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise PulsePalError('Error: ' + address + ' exists and is not a socket. PulsePalServer will not replace it.')
+    os.remove(address)
+
+
+def _paramNames(pulse_pal):
+    return list(pulse_pal.outputParameterNames) + list(pulse_pal.triggerParameterNames)
+
+
+def _sendMessage(sock, header):
+    """
+    Sends a message. Numeric arrays in header['args'] are sent in the payload, as float64.
+    """
+    payload = []
+    payload_length = 0
+    if 'args' in header:
+        args = []
+        for arg in header['args']:
+            if isinstance(arg, np.ndarray):
+                data = arg.astype('<f8', copy=False).tobytes()
+                args.append({'array': [payload_length, arg.size]})
+                payload.append(data)
+                payload_length += len(data)
+            else:
+                args.append(arg)
+        header = dict(header, args=args)
+    header_bytes = json.dumps(header, default=_jsonDefault).encode()
+    sock.sendall(b''.join([_LENGTHS.pack(len(header_bytes), payload_length), header_bytes] + payload))
+
+
+def _receiveMessage(sock):
+    header_length, payload_length = _LENGTHS.unpack(_receiveExact(sock, _LENGTHS.size))
+    header = json.loads(_receiveExact(sock, header_length))
+    payload = _receiveExact(sock, payload_length)
+    if 'args' in header:
+        header['args'] = [np.frombuffer(payload, '<f8', arg['array'][1], arg['array'][0])
+                          if isinstance(arg, dict) and 'array' in arg else arg for arg in header['args']]
+    return header
+
+
+def _receiveExact(sock, n_bytes):
+    message_bytes = bytearray()
+    while len(message_bytes) < n_bytes:
+        data = sock.recv(n_bytes - len(message_bytes))
+        if not data:
+            raise EOFError('connection closed')
+        message_bytes += data
+    return bytes(message_bytes)
+
+
+def _jsonDefault(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, numbers.Number):  # e.g. Decimal
+        return float(value)
+    raise TypeError(type(value).__name__ + ' cannot be sent to a Pulse Pal server.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shares one Pulse Pal with many clients.')
+    parser.add_argument('port', help='The Pulse Pal USB serial port (e.g. COM3 or /dev/ttyACM0)')
+    parser.add_argument('address', nargs='?', default=DEFAULT_ADDRESS,
+                        help='tcp://host:port, or a Unix socket path (default: ' + DEFAULT_ADDRESS + ')')
+    args = parser.parse_args(argv)
+    server = PulsePalServer(args.port, args.address)
+    print('Serving Pulse Pal (firmware v' + str(server.pulsePal.firmware_version) + ') at ' + args.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()  # Removes the socket file and ends the device's session
+
+
+if __name__ == '__main__':
+    main()
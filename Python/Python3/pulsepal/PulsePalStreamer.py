@@ -0,0 +1,176 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalStreamer plays waveforms longer than a custom train (5000 samples on Pulse Pal 2, 1000 on Pulse Pal 1)
+# on one output channel. The waveform is split into segments, which alternate between the two custom train slots:
+# while one segment plays, the next is uploaded to the other slot. When a segment ends, the channel is retargeted
+# to the other slot and soft-triggered, with one USB write.
+#
+# The device does not report when a segment ends, so boundaries are timed on the host from the acknowledgement
+# of each retarget. The firmware also pauses playback while it receives a message (serial commands are read in
+# the 20kHz update interrupt), so each upload stretches the segment that is playing. The player adds the measured
+# upload time to the segment's expected end, and reports the estimated gap at each boundary and the fraction of
+# playback time spent paused. Use the report to choose a sample rate and segment length the link can sustain.
+#
+# Example:
+#   streamer = PulsePalStreamer(myPulsePal, 1, 0.0001)  # Output channel 1, 10kHz samples
+#   report = streamer.play(np.load('recording.npy', mmap_mode='r'))  # Returns when playback ends
+#   print(report.maxGap, report.jitter, report.stallFraction)
+
+from .PulsePal import PulsePalError
+import collections
+import time
+import numpy as np
+
+StreamReport = collections.namedtuple('StreamReport', ['nSegments', 'gaps', 'meanGap', 'maxGap', 'jitter',
+                                                       'uploadTimes', 'stallFraction'])
+StreamReport.__doc__ = """
+The timing of a streamed waveform, estimated from host timestamps. Units = seconds.
+    nSegments (int): Segments played
+    gaps (ndarray): Estimated time at the resting voltage at each boundary between segments
+    meanGap (float): Mean of gaps
+    maxGap (float): Largest gap
+    jitter (float): Standard deviation of gaps
+    uploadTimes (ndarray): Time to upload each segment (from the start of the write to its acknowledgement)
+    stallFraction (float): Upload time during playback, as a fraction of the waveform's duration. Playback is
+                           paused while the device receives an upload, so this is the share of extra time the
+                           waveform took to play. A link sustains a sample rate if this is close to 0.
+"""
+
+
+class PulsePalStreamer(object):
+    GUARD_TIME = 0.001  # Seconds to wait after a segment's expected end before retargeting the channel
+    SPIN_TIME = 0.002  # Seconds before a deadline at which the player stops sleeping and polls the clock
+
+    def __init__(self, pulse_pal, channel, pulse_width, segment_length=None, compact=False):
+        """
+        Initializes a streaming player for one output channel.
+
+        Args:
+            pulse_pal (PulsePalObject): A connected Pulse Pal. Its custom trains 1 and 2 are used by the player.
+            channel (int): The output channel to play on (1-4)
+            pulse_width (float): The duration of each sample. Units = seconds.
+            segment_length (int): Samples per segment. Defaults to the largest custom train the device holds.
+            compact (bool): If True, segments are sent with run-length compaction (see sendCustomWaveform()).
+
+        Raises:
+            PulsePalError: If segment_length is larger than the device's custom train size.
+        """
+        max_length = 5000 if pulse_pal._model == 2 else 1000
+        if segment_length is None:
+            segment_length = max_length
+        if not 1 <= segment_length <= max_length:
+            raise PulsePalError('Error: segment_length must be 1-' + str(max_length) + ' samples on this device.')
+        self.pulsePal = pulse_pal
+        self.channel = channel
+        self.pulseWidth = pulse_width
+        self.segmentLength = segment_length
+        self.compact = compact
+
+    def play(self, waveform):
+        """
+        Plays a waveform, and returns when playback has ended.
+        The channel's isBiphasic, pulseTrainDelay, customTrainTarget, customTrainLoop, customTrainID and
+        phase1Duration parameters are programmed for playback, and are not restored.
+
+        Args:
+            waveform (array-like, ndarray or str): The voltage of each sample. Units = volts. Arrays are read one
+                                                   segment at a time, so a memory-mapped array can be larger than
+                                                   memory. A str is opened as a memory-mapped .npy file.
+
+        Returns:
+            StreamReport: Estimated gaps between segments, and upload times.
+
+        Raises:
+            PulsePalError: If the device does not acknowledge a command.
+        """
+        if isinstance(waveform, str):
+            waveform = np.load(waveform, mmap_mode='r')
+        n_samples = len(waveform)
+        starts = range(0, n_samples, self.segmentLength)
+        pulse_pal = self.pulsePal
+        channel = self.channel
+        with pulse_pal.transaction():
+            for param_name in ('isBiphasic', 'customTrainTarget', 'customTrainLoop'):
+                pulse_pal.programOutputChannelParam(param_name, channel, 0)
+            pulse_pal.programOutputChannelParam('customTrainID', channel, 1)
+            # The firmware only updates a channel's burst mode when a parameter with code < 14 is set, so this is last
+            pulse_pal.programOutputChannelParam('pulseTrainDelay', channel, 0)
+        upload_times = []
+        gaps = []
+        phase1_duration = self._upload(1, waveform, 0, upload_times)
+        start_time = self._start(1, phase1_duration)
+        for segment, first in enumerate(starts):
+            duration = min(self.segmentLength, n_samples - first)*self.pulseWidth
+            expected_end = start_time + duration
+            if segment + 1 < len(starts):
+                slot = (segment + 1) % 2 + 1  # Segments alternate between custom trains 1 and 2
+                next_phase1_duration = self._upload(slot, waveform, starts[segment + 1], upload_times)
+                expected_end += upload_times[-1]  # Playback was paused while the device received the upload
+                _waitUntil(expected_end + self.GUARD_TIME, self.SPIN_TIME)
+                changed_duration = None if next_phase1_duration == phase1_duration else next_phase1_duration
+                start_time = self._start(slot, changed_duration)
+                gaps.append(start_time - expected_end)
+                phase1_duration = next_phase1_duration
+            else:
+                _waitUntil(expected_end, self.SPIN_TIME)
+        gaps = np.array(gaps)
+        upload_times = np.array(upload_times)
+        total_duration = n_samples*self.pulseWidth
+        return StreamReport(len(starts), gaps, gaps.mean() if gaps.size else 0.0, gaps.max() if gaps.size else 0.0,
+                            gaps.std() if gaps.size else 0.0, upload_times,
+                            upload_times[1:].sum()/total_duration if total_duration else 0.0)
+
+    def _upload(self, slot, waveform, first, upload_times):
+        """
+        Uploads one segment to a custom train slot, records the upload time, and returns the phase1Duration that
+        plays it.
+        """
+        segment = np.asarray(waveform[first:first + self.segmentLength], dtype='float64')
+        upload_start = time.perf_counter()
+        upload = self.pulsePal.sendCustomWaveform(slot, self.pulseWidth, segment, self.compact)
+        upload_times.append(time.perf_counter() - upload_start)
+        return upload.phase1Duration
+
+    def _start(self, slot, phase1_duration):
+        """
+        Retargets the channel to a custom train slot and soft-triggers it, in one write. Returns the time the
+        retarget was acknowledged, which is used as the segment's start time.
+        """
+        pulse_pal = self.pulsePal
+        trigger = [0, 0, 0, 0]
+        trigger[self.channel - 1] = 1
+        with pulse_pal.transaction():
+            pulse_pal.programOutputChannelParam('customTrainID', self.channel, slot)
+            if phase1_duration is not None:
+                pulse_pal.programOutputChannelParam('phase1Duration', self.channel, phase1_duration)
+            pulse_pal.triggerOutputChannels(*trigger)
+        return time.perf_counter()
+
+
+def _waitUntil(deadline, spin_time):
+    """
+    Sleeps until shortly before a deadline (time.perf_counter()), then polls the clock until it passes.
+    """
+    remaining = deadline - time.perf_counter()
+    if remaining > spin_time:
+        time.sleep(remaining - spin_time)
+    while time.perf_counter() < deadline:
+        pass
@@ -0,0 +1,278 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# ThreadedPulsePalObject is a thread-safe Pulse Pal client. A dedicated I/O thread owns the USB serial port and sends
+# commands from any thread one at a time, so their bytes never interleave on the wire. Commands wait in a priority
+# queue: aborts are sent first, then soft triggers, then all other commands (e.g. parameter and waveform uploads).
+# Each command returns a completion handle (a concurrent.futures.Future) that the caller can wait on.
+
+from .PulsePal import PulsePalObject
+from concurrent.futures import Future
+import contextlib
+import itertools
+import queue
+import threading
+import weakref
+
+ABORT_PRIORITY = 0
+TRIGGER_PRIORITY = 1
+DEFAULT_PRIORITY = 2
+
+
+class ThreadedPulsePalObject(PulsePalObject):
+    def __init__(self, port_name):
+        """
+        Initializes a new instance of the ThreadedPulsePalObject, connects to the device and starts the I/O thread.
+
+        Example:
+            myPulsePal = ThreadedPulsePalObject('COM3')
+            upload = myPulsePal.sendCustomWaveform(1, 0.0001, voltages)  # Returns immediately
+            myPulsePal.abortPulseTrains()  # Sent before the upload if the upload has not started yet
+            upload.result()  # Waits for the upload to be acknowledged. Raises PulsePalError if it was not.
+            myPulsePal.close()
+
+        Call close() to end the session. The I/O thread does not keep the object alive, so deleting the object also
+        closes it, but Python does not guarantee that objects are deleted before the interpreter exits.
+
+        Args:
+            port_name (str): The name of the USB serial port to which the Pulse Pal is connected (e.g. COM3 on Windows)
+        """
+        self._ioThread = None
+        self._stateLock = threading.RLock()  # Guards parameter fields and the sync record while commands are encoded
+        self._jobs = queue.PriorityQueue()
+        self._jobCount = itertools.count()  # Keeps commands of equal priority in the order they were issued
+        self._transactionFuture = None
+        super().__init__(port_name)  # Connects without the I/O thread
+        self._ioThread = threading.Thread(target=_ioLoop, args=(weakref.ref(self), self._jobs), name='PulsePal I/O',
+                                          daemon=True)
+        self._ioThread.start()
+
+    def syncAllParams(self, force_full=False):
+        """ Thread-safe version of PulsePalObject.syncAllParams(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.syncAllParams, force_full)
+
+    def applyProgram(self, program):
+        """ Thread-safe version of PulsePalObject.applyProgram(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.applyProgram, program)
+
+    def programOutputChannelParam(self, param_name, channel, value):
+        """ Thread-safe version of PulsePalObject.programOutputChannelParam(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.programOutputChannelParam, param_name, channel, value)
+
+    def programTriggerChannelParam(self, param_name, channel, value):
+        """ Thread-safe version of PulsePalObject.programTriggerChannelParam(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.programTriggerChannelParam, param_name, channel, value)
+
+    def setFixedVoltage(self, channel, voltage):
+        """ Thread-safe version of PulsePalObject.setFixedVoltage(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.setFixedVoltage, channel, voltage)
+
+    def sendCustomPulseTrain(self, custom_train_id, pulse_times, pulse_voltages):
+        """ Thread-safe version of PulsePalObject.sendCustomPulseTrain(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.sendCustomPulseTrain, custom_train_id, pulse_times,
+                            pulse_voltages)
+
+    def sendCustomWaveform(self, custom_train_id, pulse_width, pulse_voltages, compact=False):
+        """
+        Thread-safe version of PulsePalObject.sendCustomWaveform(). Returns a completion handle, whose result is the
+        WaveformUpload once the device acknowledges the upload (None if sent inside a transaction).
+        """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.sendCustomWaveform, custom_train_id, pulse_width,
+                            pulse_voltages, compact)
+
+    def setContinuousLoop(self, channel, state):
+        """ Thread-safe version of PulsePalObject.setContinuousLoop(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.setContinuousLoop, channel, state)
+
+    def triggerOutputChannels(self, channel1, channel2, channel3, channel4):
+        """
+        Thread-safe version of PulsePalObject.triggerOutputChannels(). Returns a completion handle.
+        The trigger is sent ahead of queued uploads, so it may fire before parameters queued earlier are applied.
+        """
+        return self._submit(TRIGGER_PRIORITY, PulsePalObject.triggerOutputChannels, channel1, channel2, channel3,
+                            channel4)
+
+    def abortPulseTrains(self):
+        """ Thread-safe version of PulsePalObject.abortPulseTrains(), sent ahead of all queued commands. """
+        return self._submit(ABORT_PRIORITY, PulsePalObject.abortPulseTrains)
+
+    def saveSettingsFile(self, file_name):
+        """ Thread-safe version of PulsePalObject.saveSettingsFile(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.saveSettingsFile, file_name)
+
+    def deleteSettingsFile(self, file_name):
+        """ Thread-safe version of PulsePalObject.deleteSettingsFile(). Returns a completion handle. """
+        return self._submit(DEFAULT_PRIORITY, PulsePalObject.deleteSettingsFile, file_name)
+
+    def loadSettingsFile(self, file_name):
+        """
+        Thread-safe version of PulsePalObject.loadSettingsFile(), run on the I/O thread after the commands already
+        queued. Returns a completion handle.
+        """
+        return self._call(PulsePalObject.loadSettingsFile, file_name)
+
+    def readSettingsFile(self):
+        """
+        Thread-safe version of PulsePalObject.readSettingsFile(), run on the I/O thread after the commands already
+        queued. Returns a completion handle, whose result is the settings.
+        """
+        return self._call(PulsePalObject.readSettingsFile)
+
+    def resync(self):
+        """
+        Thread-safe version of PulsePalObject.resync(), run on the I/O thread after the commands already queued.
+        Returns a completion handle.
+        """
+        return self._call(PulsePalObject.resync)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Thread-safe version of PulsePalObject.transaction(). Commands issued inside the block are sent together when
+        the block exits, and the block waits for their acknowledgements. Other threads wait to issue commands until the
+        block exits. Commands issued inside the block return the transaction's completion handle.
+
+        Raises:
+            PulsePalError: If a command is not acknowledged. The error reports which command failed.
+        """
+        with self._stateLock:
+            if self._transactionQueue is not None:
+                yield
+                return
+            self._transactionQueue = []
+            self._transactionFuture = Future()
+            try:
+                yield
+                commands = self._transactionQueue
+                future = self._transactionFuture
+            finally:
+                self._transactionQueue = None
+                self._transactionFuture = None
+            self._enqueue(DEFAULT_PRIORITY, commands, future)
+        future.result()
+
+    def close(self):
+        """
+        Sends the commands already queued, stops the I/O thread and ends the session with the device.
+        """
+        if self._ioThread is not None:
+            # Stops the thread after the queue
+            self._jobs.put((DEFAULT_PRIORITY + 1, next(self._jobCount), None, None, None))
+            if threading.current_thread() is not self._ioThread:  # The object may be deleted on the I/O thread
+                self._ioThread.join()
+            self._ioThread = None
+            PulsePalObject.disconnect(self)
+
+    def _submit(self, priority, method, *args):
+        """
+        Encodes a command's messages on the calling thread, and queues them for the I/O thread.
+        Before the I/O thread starts (i.e. while connecting), the command is sent directly.
+
+        Returns:
+            Future: The command's completion handle. Once the device acknowledges the command, its result is the
+            method's return value (None inside a transaction). If a message is not acknowledged, waiting on the
+            handle raises PulsePalError.
+        """
+        if self._ioThread is None:
+            return method(self, *args)
+        with self._stateLock:
+            if self._transactionQueue is not None:
+                method(self, *args)
+                return self._transactionFuture
+            self._transactionQueue = []
+            try:
+                result = method(self, *args)
+                commands = self._transactionQueue
+            finally:
+                self._transactionQueue = None
+        future = Future()
+        self._enqueue(priority, commands, future, result)
+        return future
+
+    def _call(self, method, *args):
+        """
+        Runs a method that reads from the port on the I/O thread, after the commands already queued, under the state
+        lock. Before the I/O thread starts, or on the I/O thread, the method is run directly.
+
+        Returns:
+            Future: The method's completion handle. Its result is the method's return value.
+        """
+        if self._ioThread is None or threading.current_thread() is self._ioThread:
+            with self._stateLock:
+                return method(self, *args)
+        future = Future()
+        self._jobs.put((DEFAULT_PRIORITY, next(self._jobCount), lambda: self._call(method, *args), future, None))
+        return future
+
+    def _enqueue(self, priority, commands, future, result=None):
+        # Acknowledgement callbacks update parameter fields, so they run under the state lock on the I/O thread
+        commands = [(message, n_ack_bytes, command, None if on_ack is None else self._locked(on_ack))
+                    for message, n_ack_bytes, command, on_ack in commands]
+        self._jobs.put((priority, next(self._jobCount), commands, future, result))
+
+    def _commandFailed(self, error_type, message):
+        with self._stateLock:  # Runs on the I/O thread, and updates the sync record
+            PulsePalObject._commandFailed(self, error_type, message)
+
+    def _locked(self, function):
+        def locked_function():
+            with self._stateLock:
+                function()
+        return locked_function
+
+    def _runJob(self, commands, future, result):
+        """
+        Runs one job on the I/O thread and completes its handle (see _ioLoop()).
+        A job's commands may be a function to call on the I/O thread instead (see _call()). Otherwise the handle's
+        result is the job's result, the return value of the command that queued them (see _submit()).
+        """
+        if not future.set_running_or_notify_cancel():
+            return  # The caller cancelled the command before it was sent
+        try:
+            if callable(commands):
+                result = commands()
+            else:
+                self._sendQueue(commands)
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:  # The device or interpreter may already be gone; errors can't be raised from here
+            pass
+
+
+def _ioLoop(pulse_pal_ref, jobs):
+    """
+    The I/O thread of a ThreadedPulsePalObject. Runs queued jobs in priority order, until a job with no handle.
+    The object is held by a weak reference while the thread waits, so that deleting the object closes it.
+    """
+    while True:
+        _, _, commands, future, result = jobs.get()
+        if future is None:
+            return
+        pulse_pal = pulse_pal_ref()
+        if pulse_pal is None:
+            return
+        pulse_pal._runJob(commands, future, result)
+        del pulse_pal, commands, future, result  # Deleting the last reference closes the object on this thread
@@ -0,0 +1,381 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Wire-level tracing for PulsePalObject. While tracing, each message sent to the device is recorded with its op code,
+# bytes out and in, and three times: encoding (from the API call until the message is ready, including unit
+# conversion and validation), writing (handing the bytes to the OS), and the acknowledgement round-trip (from the end
+# of the write until the ack is read). Latency histograms are kept per API method, and the port's transport is
+# wrapped to count all bytes on the link. Records can be passed to hooks as they are made, and saved to a binary
+# trace file that readTrace() and replayTrace() read back for offline analysis.
+# Tracing is off by default. When off, the only cost is one attribute check per command.
+#
+# Example:
+#   tracer = myPulsePal.startTrace('session.trace')
+#   tracer.addHook(lambda record: record.ackTime > 0.005 and print('Slow ack:', record))
+#   ... run the session ...
+#   myPulsePal.stopTrace()
+#   for method, stats in myPulsePal.stats().items():
+#       print(method, stats.count, stats.p50, stats.p99)
+#   offline = replayTrace('session.trace')  # The same statistics, rebuilt from the file
+# Soft-trigger timing is recorded separately, by a PulsePalTriggerTimer: each soft-trigger is timestamped
+# (time.perf_counter(), a monotonic clock) just before and just after its write, into preallocated arrays, so that the
+# latency and jitter of triggers can be measured over a session without tracing every command.
+#   timer = myPulsePal.startTriggerTiming()
+#   ... run the session ...
+#   print(myPulsePal.stopTriggerTiming().stats())
+
+from .ArCOM import TracingTransport
+import bisect
+import collections
+import struct
+import threading
+import time
+import numpy as np
+
+CommandRecord = collections.namedtuple('CommandRecord', ['startTime', 'method', 'opCode', 'status', 'bytesOut',
+                                                         'bytesIn', 'encodeTime', 'writeTime', 'ackTime'])
+CommandRecord.__doc__ = """
+One message sent to the device. Times are in seconds.
+    startTime (float): When the API call that sent the message started (time.time())
+    method (str): The API method, e.g. 'programOutputChannelParam'
+    opCode (int): The message's op code
+    status (str): 'ok', 'timeout' (no acknowledgement before the deadline) or 'nack' (an unexpected reply)
+    bytesOut (int): Bytes in the message
+    bytesIn (int): Bytes received in reply
+    encodeTime (float): From the API call (or the previous message of the same call) until the message was ready
+    writeTime (float): Time to write the message. Messages sent together in a transaction share one write, and each
+                       reports its time.
+    ackTime (float): From the end of the write until the acknowledgement was read. 0 for messages with no reply.
+"""
+
+MethodStats = collections.namedtuple('MethodStats', ['count', 'errors', 'bytesOut', 'bytesIn', 'meanEncodeTime',
+                                                     'meanWriteTime', 'meanAckTime', 'meanLatency', 'p50', 'p90',
+                                                     'p99', 'maxLatency', 'histogram'])
+MethodStats.__doc__ = """
+Statistics of the messages sent by one API method. Times are in seconds. Latency = encodeTime + writeTime + ackTime.
+    count (int): Messages sent
+    errors (int): Messages that were not acknowledged
+    bytesOut (int): Bytes sent
+    bytesIn (int): Bytes received in reply
+    meanEncodeTime, meanWriteTime, meanAckTime, meanLatency (float): Means over the messages
+    p50, p90, p99 (float): Latency percentiles, read from the histogram (the upper edge of the percentile's bin)
+    maxLatency (float): The largest latency
+    histogram (ndarray): Messages in each latency bin. Bin i counts latencies from LATENCY_BIN_EDGES[i-1] to
+                         LATENCY_BIN_EDGES[i]. The first and last bins count latencies outside the edges.
+"""
+
+LinkStats = collections.namedtuple('LinkStats', ['bytesWritten', 'bytesRead', 'nWrites', 'nReads', 'writeTime',
+                                                 'readTime', 'writeThroughput'])
+LinkStats.__doc__ = """
+All traffic on the port while tracing, including handshakes and resynchronization.
+    bytesWritten, bytesRead (int): Bytes written and read
+    nWrites, nReads (int): Writes and reads
+    writeTime (float): Seconds spent in writes
+    readTime (float): Seconds spent in reads, including waiting for replies
+    writeThroughput (float): bytesWritten/writeTime. Units = bytes/second.
+"""
+
+TriggerTimingStats = collections.namedtuple('TriggerTimingStats', ['count', 'meanLatency', 'jitter', 'minLatency',
+                                                                   'p50', 'p90', 'p99', 'maxLatency', 'meanInterval',
+                                                                   'intervalJitter', 'histogram'])
+TriggerTimingStats.__doc__ = """
+Statistics of the soft-triggers recorded by a PulsePalTriggerTimer. Times are in seconds. Latency is the time from
+just before a trigger's write to just after it returned.
+    count (int): Triggers recorded
+    meanLatency (float): The mean latency
+    jitter (float): The standard deviation of the latency
+    minLatency, maxLatency (float): The smallest and largest latency
+    p50, p90, p99 (float): Latency percentiles (exact, computed from every trigger)
+    meanInterval (float): The mean time between the starts of consecutive triggers. NaN if fewer than 2 triggers.
+    intervalJitter (float): The standard deviation of the time between consecutive triggers
+    histogram (ndarray): Triggers in each latency bin, with the bins of MethodStats.histogram (see LATENCY_BIN_EDGES)
+"""
+
+LATENCY_BIN_EDGES = np.logspace(-6, 1, 71)  # 1us to 10s, 10 bins per decade
+
+_TRACE_MAGIC = b'PULSEPALTRACE\x00\x00\x01'  # Trace file header, ending with the format version
+_RECORD_STRUCT = struct.Struct('<d32sBBIIddd')  # One CommandRecord in a trace file
+_RECORD_DTYPE = np.dtype([('startTime', '<f8'), ('method', 'S32'), ('opCode', 'u1'), ('status', 'u1'),
+                          ('bytesOut', '<u4'), ('bytesIn', '<u4'), ('encodeTime', '<f8'), ('writeTime', '<f8'),
+                          ('ackTime', '<f8')])
+_STATUSES = ('ok', 'timeout', 'nack')
+_BIN_EDGES = LATENCY_BIN_EDGES.tolist()  # bisect is faster on a list
+_TRIGGER_SAMPLE_DTYPE = np.dtype([('startTime', 'float64'), ('endTime', 'float64'), ('channels', 'uint8')])
+
+
+class PulsePalTracer(object):
+    def __init__(self, trace_path=None, hooks=()):
+        """
+        Initializes a tracer. Use PulsePalObject.startTrace() to trace a device.
+
+        Args:
+            trace_path (str): A binary trace file to write each record to. None for no file.
+            hooks (list): Functions called with each CommandRecord (see addHook())
+        """
+        self.tracePath = trace_path
+        self.transport = None  # The TracingTransport counting link traffic, while attached to a port
+        self._hooks = list(hooks)
+        self._lock = threading.Lock()  # Records may come from an I/O thread while stats() is called
+        self._methods = {}  # Accumulated statistics for each method (see _accumulate())
+        self._queued = {}  # (start time, encode time) of messages queued in a transaction, by id(message)
+        self._clockOffset = time.time() - time.perf_counter()
+        self._traceFile = None
+        if trace_path is not None:
+            self._traceFile = open(trace_path, 'wb')
+            self._traceFile.write(_TRACE_MAGIC)
+
+    def attach(self, port):
+        """
+        Wraps an ArCom port's transport to count link traffic (see linkStats())
+        """
+        self.transport = TracingTransport(port.transport)
+        port.transport = self.transport
+
+    def detach(self, port):
+        """
+        Restores the transport of a port passed to attach()
+        """
+        if self.transport is not None and port is not None and port.transport is self.transport:
+            port.transport = self.transport.transport
+
+    def addHook(self, hook):
+        """
+        Adds a function called with each CommandRecord as it is made, on the thread that sent the message (the I/O
+        thread for ThreadedPulsePalObject). Hooks should return quickly, since the next command waits for them.
+        """
+        self._hooks.append(hook)
+
+    def removeHook(self, hook):
+        self._hooks.remove(hook)
+
+    def stats(self):
+        """
+        Returns the statistics of each API method traced so far, as {method name: MethodStats}
+        """
+        with self._lock:
+            return {method: _methodStats(accumulator) for method, accumulator in self._methods.items()}
+
+    def linkStats(self):
+        """
+        Returns the traffic on the port while the tracer was attached, as LinkStats. None if it was not attached.
+        """
+        transport = self.transport
+        if transport is None:
+            return None
+        return LinkStats(transport.bytes_written, transport.bytes_read, transport.n_writes, transport.n_reads,
+                         transport.write_time, transport.read_time,
+                         transport.bytes_written/transport.write_time if transport.write_time else 0.0)
+
+    def reset(self):
+        """
+        Clears the statistics. The trace file is not affected.
+        """
+        with self._lock:
+            self._methods.clear()
+
+    def close(self):
+        """
+        Closes the trace file. Statistics remain available.
+        """
+        if self._traceFile is not None:
+            self._traceFile.close()
+            self._traceFile = None
+
+    def record(self, record):
+        """
+        Adds a CommandRecord to the statistics and the trace file, and passes it to the hooks.
+        """
+        latency = record.encodeTime + record.writeTime + record.ackTime
+        with self._lock:
+            accumulator = self._methods.get(record.method)
+            if accumulator is None:
+                accumulator = self._methods[record.method] = [0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0,
+                                                              np.zeros(len(_BIN_EDGES) + 1, dtype='int64')]
+            _accumulate(accumulator, record, latency)
+            if self._traceFile is not None:
+                self._traceFile.write(_RECORD_STRUCT.pack(record.startTime, record.method.encode()[:32], record.opCode,
+                                                          _STATUSES.index(record.status), record.bytesOut,
+                                                          record.bytesIn, record.encodeTime, record.writeTime,
+                                                          record.ackTime))
+        for hook in self._hooks:
+            hook(record)
+
+    def messageQueued(self, message, start_time, encode_time):
+        """
+        Keeps the timing of a message queued in a transaction, until it is sent (see messageSent())
+        """
+        with self._lock:
+            self._queued[id(message)] = (start_time, encode_time)
+
+    def messageSent(self, method, message, start_time, encode_time, write_time, ack_time, bytes_in, status='ok'):
+        """
+        Records a message sent by PulsePalObject. start_time is time.perf_counter(). If start_time is None, the
+        timing kept by messageQueued() is used.
+        """
+        if start_time is None:
+            with self._lock:
+                start_time, encode_time = self._queued.pop(id(message), (time.perf_counter(), 0.0))
+        self.record(CommandRecord(start_time + self._clockOffset, method, message[1] if len(message) > 1 else 0,
+                                  status, len(message), bytes_in, encode_time, write_time, ack_time))
+
+    def __del__(self):
+        self.close()
+
+
+class PulsePalTriggerTimer(object):
+    def __init__(self, capacity=65536):
+        """
+        Initializes a trigger timer. Use PulsePalObject.startTriggerTiming() to time a device's soft-triggers.
+
+        Args:
+            capacity (int): Triggers the timer has room for before its arrays are enlarged (doubled)
+        """
+        self.count = 0  # Triggers recorded
+        self._startTimes = np.empty(capacity)
+        self._endTimes = np.empty(capacity)
+        self._channels = np.empty(capacity, dtype='uint8')
+
+    def record(self, start_time, end_time, channels):
+        """
+        Records one trigger: the time.perf_counter() values before and after its write, and its channel bits
+        """
+        i = self.count
+        if i == len(self._channels):
+            self._grow()
+        self._startTimes[i] = start_time
+        self._endTimes[i] = end_time
+        self._channels[i] = channels
+        self.count = i + 1
+
+    def samples(self):
+        """
+        Returns a copy of the recorded triggers, as a structured array with fields startTime and endTime
+        (time.perf_counter() values, in seconds) and channels (bit n-1 set if output channel n was triggered)
+        """
+        n = self.count
+        samples = np.empty(n, dtype=_TRIGGER_SAMPLE_DTYPE)
+        samples['startTime'] = self._startTimes[:n]
+        samples['endTime'] = self._endTimes[:n]
+        samples['channels'] = self._channels[:n]
+        return samples
+
+    def latencies(self):
+        """
+        Returns the latency of each recorded trigger, in seconds
+        """
+        return self._endTimes[:self.count] - self._startTimes[:self.count]
+
+    def stats(self):
+        """
+        Returns the latency and jitter of the recorded triggers, as TriggerTimingStats. None if none were recorded.
+        """
+        if self.count == 0:
+            return None
+        latencies = self.latencies()
+        intervals = np.diff(self._startTimes[:self.count])
+        p50, p90, p99 = np.percentile(latencies, (50, 90, 99)).tolist()
+        histogram = np.bincount(np.searchsorted(LATENCY_BIN_EDGES, latencies, side='right'),
+                                minlength=len(LATENCY_BIN_EDGES) + 1)
+        return TriggerTimingStats(self.count, float(latencies.mean()), float(latencies.std()), float(latencies.min()),
+                                  p50, p90, p99, float(latencies.max()),
+                                  float(intervals.mean()) if len(intervals) else float('nan'),
+                                  float(intervals.std()) if len(intervals) else float('nan'), histogram)
+
+    def reset(self):
+        """
+        Clears the recorded triggers. The arrays are kept.
+        """
+        self.count = 0
+
+    def _grow(self):
+        capacity = 2*len(self._channels) or 1
+        for name in ('_startTimes', '_endTimes', '_channels'):
+            values = getattr(self, name)
+            enlarged = np.empty(capacity, dtype=values.dtype)
+            enlarged[:len(values)] = values
+            setattr(self, name, enlarged)
+
+
+def readTrace(trace_path):
+    """
+    Reads a trace file written by PulsePalTracer.
+
+    Args:
+        trace_path (str): The trace file
+
+    Returns:
+        list: The CommandRecords in the file, in the order they were recorded
+
+    Raises:
+        ValueError: If the file is not a Pulse Pal trace file.
+    """
+    with open(trace_path, 'rb') as trace_file:
+        if trace_file.read(len(_TRACE_MAGIC)) != _TRACE_MAGIC:
+            raise ValueError('Error: ' + str(trace_path) + ' is not a Pulse Pal trace file.')
+        records = np.fromfile(trace_file, dtype=_RECORD_DTYPE)
+    return [CommandRecord(float(record['startTime']), record['method'].decode(), int(record['opCode']),
+                          _STATUSES[record['status']], int(record['bytesOut']), int(record['bytesIn']),
+                          float(record['encodeTime']), float(record['writeTime']), float(record['ackTime']))
+            for record in records]
+
+
+def replayTrace(trace_path, hooks=()):
+    """
+    Replays a trace file into a new tracer, e.g. to compute its statistics offline.
+
+    Args:
+        trace_path (str): The trace file
+        hooks (list): Functions called with each CommandRecord, in the order they were recorded
+
+    Returns:
+        PulsePalTracer: A tracer with the file's statistics (see PulsePalTracer.stats())
+    """
+    tracer = PulsePalTracer(hooks=hooks)
+    for record in readTrace(trace_path):
+        tracer.record(record)
+    return tracer
+
+
+def _accumulate(accumulator, record, latency):
+    """
+    Adds a record to a method's accumulator:
+    [count, errors, bytesOut, bytesIn, encode time, write time, ack time, latency, max latency, histogram]
+    """
+    accumulator[0] += 1
+    accumulator[1] += record.status != 'ok'
+    accumulator[2] += record.bytesOut
+    accumulator[3] += record.bytesIn
+    accumulator[4] += record.encodeTime
+    accumulator[5] += record.writeTime
+    accumulator[6] += record.ackTime
+    accumulator[7] += latency
+    accumulator[8] = max(accumulator[8], latency)
+    accumulator[9][bisect.bisect_right(_BIN_EDGES, latency)] += 1
+
+
+def _methodStats(accumulator):
+    count, errors, bytes_out, bytes_in, encode_time, write_time, ack_time, latency, max_latency, histogram = \
+        accumulator
+    cumulative = np.cumsum(histogram)
+    upper_edges = np.append(LATENCY_BIN_EDGES, np.inf)
+    percentiles = [min(upper_edges[np.searchsorted(cumulative, fraction*count)], max_latency)
+                   for fraction in (0.5, 0.9, 0.99)]
+    return MethodStats(count, errors, bytes_out, bytes_in, encode_time/count, write_time/count, ack_time/count,
+                       latency/count, *percentiles, max_latency, histogram.copy())
@@ -0,0 +1,396 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Vectorized pre-flight validation of Pulse Pal programs. Parameters and custom trains are checked in user units
+# (seconds and volts) before they are converted and sent, and every violation is returned at once. Out of range
+# values would otherwise wrap around in the device's integer formats, or leave the device waiting for bytes
+# (e.g. a custom train longer than the device's buffer).
+# Times are checked after conversion: a time that does not convert exactly to a whole number of 50us cycles
+# (after the 4 decimal place quantization of PulsePalConversion) is a violation, with the value that would be sent.
+#
+# Example:
+#   violations = validateCustomTrain(1, [0, 0.001, 0.001], [5, 12, 0], 65535)
+#   for violation in violations:
+#       print(violation.location, violation.param, violation.message)
+
+from .PulsePalConversion import CYCLE_FREQUENCY, seconds2Cycles, volts2Bits
+import collections
+import math
+import numpy as np
+
+Violation = collections.namedtuple('Violation', ['location', 'param', 'indices', 'values', 'message'])
+Violation.__doc__ = """
+A parameter or custom train value that cannot be sent to the device as given.
+    location (str): e.g. 'output channel 2', 'trigger channel 1' or 'custom train 1'
+    param (str): The parameter name, or 'pulseTimes', 'pulseVoltages' or 'nPulses' for a custom train
+    indices (ndarray or None): For custom trains, the index of each invalid pulse. None for parameters.
+    values: The invalid value (parameters), or the invalid values (custom trains)
+    message (str): What is wrong with the value(s)
+"""
+
+OUTPUT_PARAMETER_NAMES = ('isBiphasic', 'phase1Voltage', 'phase2Voltage', 'phase1Duration', 'interPhaseInterval',
+                          'phase2Duration', 'interPulseInterval', 'burstDuration', 'interBurstInterval',
+                          'pulseTrainDuration', 'pulseTrainDelay', 'linkTriggerChannel1', 'linkTriggerChannel2',
+                          'customTrainID', 'customTrainTarget', 'customTrainLoop', 'restingVoltage')
+TRIGGER_MODE_CODE = 128
+_VOLTAGE_COLUMNS = [1, 2, 16]  # Columns of a parameter array holding voltage params (codes 2, 3 and 17)
+_TIME_COLUMNS = slice(3, 11)  # Columns holding time params (codes 4-11)
+_BYTE_MAX = np.array([1] + [np.inf]*10 + [1, 1, 2, 1, 1, np.inf])  # Maximum of each single byte param (codes 1, 12-16)
+_IS_BYTE = np.isfinite(_BYTE_MAX)
+_TRIGGER_MODE_MAX = 2  # 0 = normal, 1 = toggle, 2 = pulse gated
+_TIME_TOLERANCE = 1e-9  # Seconds. Larger differences between a time and its converted value are violations.
+
+# Violation codes. An invalid value is reported once, with the code of the first check it fails.
+_NOT_FINITE, _NOT_BYTE, _VOLTAGE_RANGE, _TIME_RANGE, _INEXACT_TIME, _INEXACT_VOLTAGE, _NO_BURST, _NOT_INCREASING = \
+    range(1, 9)
+_REPORTED = -1  # Marks custom train values already reported (values that are not numbers), so no check reports them
+
+
+def maxPulses(dac_bitmax):
+    """
+    Returns the number of pulses a custom train can hold (1000 on Pulse Pal 1, 5000 on Pulse Pal 2).
+
+    Args:
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+    """
+    if int(dac_bitmax) < 256:
+        return 1000
+    return 5000
+
+
+def validateParams(fields, trigger_modes, dac_bitmax, cycle_frequency=CYCLE_FREQUENCY, voltage_tolerance=None):
+    """
+    Validates a full program: the parameters of all output channels and the trigger modes.
+    Besides the range of each value, this checks that channels with custom trains targeting burst onsets have a
+    non-zero burstDuration.
+
+    Args:
+        fields (array-like of float): Output channel parameters with shape (4, 17): one row per channel, one column
+                                      per parameter code (column 0 = code 1, see OUTPUT_PARAMETER_NAMES).
+                                      Units: Voltage (if volts), Seconds (if time), Integer (if item)
+        trigger_modes (array-like of int): The mode of each trigger channel (0-2)
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+        cycle_frequency (int): The device refresh rate. Units = Hz.
+        voltage_tolerance (float): If given, voltages the DAC cannot produce to within this tolerance are reported.
+                                   Units = volts.
+
+    Returns:
+        list of Violation: Every violation found, in channel order. Empty if the program is valid.
+    """
+    fields = np.asarray(fields, dtype='float64')
+    finite = np.isfinite(fields)
+    values = np.where(finite, fields, 0)
+    codes = np.zeros(fields.shape, dtype='int8')
+    codes[_IS_BYTE & _badIntegers(values, _BYTE_MAX)] = _NOT_BYTE
+    codes[:, _VOLTAGE_COLUMNS], produced = _voltageCodes(values[:, _VOLTAGE_COLUMNS], dac_bitmax, voltage_tolerance)
+    codes[:, _TIME_COLUMNS], cycles = _timeCodes(values[:, _TIME_COLUMNS], cycle_frequency)
+    # Custom trains that target burst onsets are played as bursts, which never start if burstDuration is 0
+    no_burst = (values[:, 13] > 0) & (values[:, 14] == 1) & (cycles[:, 7 - _TIME_COLUMNS.start] == 0)
+    codes[no_burst & (codes[:, 7] == 0) & (codes[:, 13] == 0) & (codes[:, 14] == 0), 7] = _NO_BURST
+    codes[~finite] = _NOT_FINITE
+    violations = []
+    for channel, column in zip(*np.nonzero(codes)):
+        code = codes[channel, column]
+        message = _message(code, cycle_frequency, voltage_tolerance, _BYTE_MAX[column])
+        if code == _INEXACT_TIME:
+            message += ': it would be sent as ' + str(cycles[channel, column - _TIME_COLUMNS.start]/cycle_frequency) + 's'
+        elif code == _INEXACT_VOLTAGE:
+            message += ': it is produced as ' + str(round(produced[channel, _VOLTAGE_COLUMNS.index(column)], 6)) + 'V'
+        violations.append(Violation('output channel ' + str(channel + 1), OUTPUT_PARAMETER_NAMES[column], None,
+                                    fields[channel, column].item(), message))
+    trigger_modes = np.asarray(trigger_modes, dtype='float64')
+    for channel in np.flatnonzero(~np.isfinite(trigger_modes) | _badIntegers(trigger_modes, _TRIGGER_MODE_MAX)):
+        violations.append(Violation('trigger channel ' + str(channel + 1), 'triggerMode', None,
+                                    trigger_modes[channel].item(),
+                                    _message(_NOT_BYTE, cycle_frequency, voltage_tolerance, _TRIGGER_MODE_MAX)))
+    return violations
+
+
+def validateParam(param_code, channel, value, dac_bitmax, cycle_frequency=CYCLE_FREQUENCY, voltage_tolerance=None):
+    """
+    Validates a single parameter, as set by programOutputChannelParam() or programTriggerChannelParam().
+    Checks that depend on other parameters are left to validateParams(), since parameters can be set in any order.
+
+    Args:
+        param_code (int): The parameter code (1-17 for output channel params, 128 for trigger mode)
+        channel (int): The output channel (1-4) or trigger channel (1-2)
+        value: The value to set. Units: Voltage (if volts), Seconds (if time), Integer (if item)
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+        cycle_frequency (int): The device refresh rate. Units = Hz.
+        voltage_tolerance (float): See validateParams()
+
+    Returns:
+        list of Violation: The violations found (at most one). Empty if the parameter is valid.
+    """
+    if param_code == TRIGGER_MODE_CODE:
+        location, param, n_channels = 'trigger channel ', 'triggerMode', 2
+    elif param_code in range(1, len(OUTPUT_PARAMETER_NAMES) + 1):
+        location, param, n_channels = 'output channel ', OUTPUT_PARAMETER_NAMES[param_code - 1], 4
+    else:
+        return [Violation('output channel ' + str(channel), str(param_code), None, value,
+                          'is not a parameter code (1-17, or 128 for triggerMode)')]
+    location += str(channel)
+    if channel not in range(1, n_channels + 1):
+        return [Violation(location, param, None, value, 'is not on a valid channel (1-' + str(n_channels) + ')')]
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return [Violation(location, param, None, value, 'must be a number')]
+    # Single values are checked without numpy, since this runs before each single-parameter write
+    column = param_code - 1
+    maximum = _TRIGGER_MODE_MAX if param_code == TRIGGER_MODE_CODE else _BYTE_MAX[column]
+    detail = ''
+    if not math.isfinite(number):
+        code = _NOT_FINITE
+    elif param_code == TRIGGER_MODE_CODE or _IS_BYTE[column]:
+        code = _NOT_BYTE if number != math.floor(number) or not 0 <= number <= maximum else 0
+    elif column in _VOLTAGE_COLUMNS:
+        codes, produced = _voltageCodes(np.array([number]), dac_bitmax, voltage_tolerance) \
+            if voltage_tolerance is not None else (None, None)
+        if abs(number) > 10:
+            code = _VOLTAGE_RANGE
+        elif codes is not None and codes[0] == _INEXACT_VOLTAGE:
+            code, detail = _INEXACT_VOLTAGE, ': it is produced as ' + str(round(produced[0], 6)) + 'V'
+        else:
+            code = 0
+    else:
+        code, cycles = _scalarTimeCode(number, cycle_frequency)
+        if code == _INEXACT_TIME:
+            detail = ': it would be sent as ' + str(cycles/cycle_frequency) + 's'
+    if code:
+        return [Violation(location, param, None, value,
+                          _message(code, cycle_frequency, voltage_tolerance, maximum) + detail)]
+    return []
+
+
+def validateCustomTrain(custom_train_id, pulse_times, pulse_voltages, dac_bitmax, cycle_frequency=CYCLE_FREQUENCY,
+                        voltage_tolerance=None):
+    """
+    Validates a custom pulse train, as sent by sendCustomPulseTrain().
+
+    Args:
+        custom_train_id (int): The ID of the custom train (1-2)
+        pulse_times (array-like of float): The time of each pulse. Units = seconds.
+                                           Times must increase, and stay distinct after conversion to cycles.
+        pulse_voltages (array-like of float): The voltage of each pulse. Units = volts.
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+        cycle_frequency (int): The device refresh rate. Units = Hz.
+        voltage_tolerance (float): See validateParams()
+
+    Returns:
+        list of Violation: Every violation found. Invalid pulses are grouped into one Violation per problem.
+                           Empty if the custom train is valid.
+    """
+    location = 'custom train ' + str(custom_train_id)
+    violations = _checkTrainSize(location, custom_train_id, pulse_voltages, dac_bitmax)
+    pulse_times, not_numbers = _floatArray(location, 'pulseTimes', pulse_times, violations)
+    if pulse_times.size != np.size(pulse_voltages):
+        violations.append(Violation(location, 'pulseTimes', None, pulse_times.size,
+                                    'must have one time for each of the ' + str(np.size(pulse_voltages)) + ' voltages'))
+    finite = np.isfinite(pulse_times)
+    codes, cycles = _timeCodes(np.where(finite, pulse_times, 0), cycle_frequency)
+    codes[~finite] = _NOT_FINITE
+    codes[not_numbers] = _REPORTED
+    # Each pulse must start after the last. Times that convert to the same cycle are reported as duplicates.
+    valid_index = np.flatnonzero(codes == 0)
+    codes[valid_index[1:][cycles[valid_index[1:]] <= cycles[valid_index[:-1]]]] = _NOT_INCREASING
+    violations.extend(_groupViolations(location, 'pulseTimes', pulse_times, codes, cycle_frequency,
+                                       voltage_tolerance))
+    violations.extend(_checkTrainVoltages(location, pulse_voltages, dac_bitmax, cycle_frequency, voltage_tolerance))
+    return violations
+
+
+def validateCustomWaveform(custom_train_id, pulse_width, pulse_voltages, dac_bitmax, cycle_frequency=CYCLE_FREQUENCY,
+                           voltage_tolerance=None):
+    """
+    Validates a custom waveform, as sent by sendCustomWaveform().
+
+    Args:
+        custom_train_id (int): The ID of the custom train (1-2)
+        pulse_width (float): The duration of each sample. Units = seconds.
+        pulse_voltages (array-like of float): The voltage of each sample. Units = volts.
+        dac_bitmax (int): The DAC code for +10V (255 for Pulse Pal 1, 65535 for Pulse Pal 2)
+        cycle_frequency (int): The device refresh rate. Units = Hz.
+        voltage_tolerance (float): See validateParams()
+
+    Returns:
+        list of Violation: Every violation found. Invalid samples are grouped into one Violation per problem.
+                           Empty if the waveform is valid.
+    """
+    location = 'custom train ' + str(custom_train_id)
+    violations = _checkTrainSize(location, custom_train_id, pulse_voltages, dac_bitmax)
+    try:
+        number = float(pulse_width)
+    except (TypeError, ValueError):
+        number = None
+    code, cycles = _scalarTimeCode(number, cycle_frequency) if number is not None and math.isfinite(number) else \
+        (_NOT_FINITE, 0)
+    message = None
+    if number is None:
+        message = 'must be a number'
+    elif code:
+        message = _message(code, cycle_frequency, voltage_tolerance)
+        if code == _INEXACT_TIME:
+            message += ': it would be sent as ' + str(cycles/cycle_frequency) + 's'
+    elif cycles == 0:
+        message = 'must be at least one cycle (' + str(1/cycle_frequency) + 's)'
+    elif cycles*(np.size(pulse_voltages) - 1) > np.iinfo('uint32').max:
+        message = 'is too long: the last sample would start after the longest time the device can represent'
+    if message is not None:
+        violations.append(Violation(location, 'pulseWidth', None, pulse_width, message))
+    violations.extend(_checkTrainVoltages(location, pulse_voltages, dac_bitmax, cycle_frequency, voltage_tolerance))
+    return violations
+
+
+def formatViolations(violations):
+    """
+    Formats violations as one line each, e.g. "output channel 2 phase1Voltage = 12.0: must be in range -10V to +10V"
+    """
+    lines = []
+    for violation in violations:
+        if violation.indices is None:
+            lines.append(violation.location + ' ' + violation.param + ' = ' + repr(violation.values) + ': ' +
+                         violation.message)
+        else:
+            shown = ', '.join(str(index) for index in violation.indices[:5])
+            if len(violation.indices) > 5:
+                shown += ', ... (' + str(len(violation.indices)) + ' pulses)'
+            lines.append(violation.location + ' ' + violation.param + ' [' + shown + ']: ' + violation.message)
+    return '\n'.join(lines)
+
+
+def _badIntegers(values, maximum):
+    return (values != np.floor(values)) | (values < 0) | (values > maximum)
+
+
+def _voltageCodes(values, dac_bitmax, voltage_tolerance):
+    """
+    Returns the violation code of each (finite) voltage, and the voltage the DAC produces for it (None if no
+    tolerance is given).
+    """
+    out_of_range = np.abs(values) > 10
+    codes = out_of_range.astype('int8')*_VOLTAGE_RANGE
+    if voltage_tolerance is None:
+        return codes, None
+    bits = volts2Bits(np.where(out_of_range, 0, values), dac_bitmax)
+    produced = bits.astype('int64')*(20/int(dac_bitmax)) - 10
+    codes[~out_of_range & (np.abs(produced - values) > voltage_tolerance)] = _INEXACT_VOLTAGE
+    return codes, produced
+
+
+def _timeCodes(values, cycle_frequency):
+    """
+    Returns the violation code of each (finite) time, and the cycles it converts to (0 if out of range).
+    """
+    out_of_range = (values < 0) | (values > np.iinfo('uint32').max//cycle_frequency)
+    cycles = seconds2Cycles(np.where(out_of_range, 0, values), cycle_frequency)
+    codes = out_of_range.astype('int8')*_TIME_RANGE
+    codes[~out_of_range & (np.abs(cycles/cycle_frequency - values) > _TIME_TOLERANCE)] = _INEXACT_TIME
+    return codes, cycles
+
+
+def _scalarTimeCode(number, cycle_frequency):
+    """
+    Returns the violation code of a finite time, and the cycles it converts to (as _timeCodes() does for arrays).
+    """
+    if number < 0 or number > np.iinfo('uint32').max//cycle_frequency:
+        return _TIME_RANGE, 0
+    from decimal import Decimal  # Imported on first use, so that importing this module does not load it
+    cycles = int(Decimal(number).quantize(Decimal('1.0000'))*cycle_frequency)  # As seconds2Cycles(), for one value
+    return (_INEXACT_TIME if abs(cycles/cycle_frequency - number) > _TIME_TOLERANCE else 0), cycles
+
+
+def _message(code, cycle_frequency, voltage_tolerance, maximum=None):
+    if code == _NOT_FINITE:
+        return 'must be a finite number'
+    elif code == _NOT_BYTE:
+        return 'must be an integer in range 0-' + str(int(maximum))
+    elif code == _VOLTAGE_RANGE:
+        return 'must be in range -10V to +10V'
+    elif code == _TIME_RANGE:
+        return 'must be in range 0-' + str(np.iinfo('uint32').max//cycle_frequency) + 's'
+    elif code == _INEXACT_TIME:
+        return 'is not a whole number of ' + format(1e6/cycle_frequency, 'g') + 'us cycles at 4 decimal places'
+    elif code == _INEXACT_VOLTAGE:
+        return 'cannot be produced by the DAC to within ' + str(voltage_tolerance) + 'V'
+    elif code == _NO_BURST:
+        return 'must be non-zero when a custom train targets burst onsets (customTrainTarget = 1)'
+    return 'must increase (each pulse must start at least one cycle after the last)'
+
+
+def _checkTrainSize(location, custom_train_id, pulse_voltages, dac_bitmax):
+    violations = []
+    if custom_train_id not in (1, 2):
+        violations.append(Violation(location, 'customTrainID', None, custom_train_id, 'must be 1 or 2'))
+    n_pulses = np.size(pulse_voltages)
+    if n_pulses > maxPulses(dac_bitmax):
+        violations.append(Violation(location, 'nPulses', None, n_pulses,
+                                    'must be at most ' + str(maxPulses(dac_bitmax)) + ' on this device'))
+    return violations
+
+
+def _checkTrainVoltages(location, pulse_voltages, dac_bitmax, cycle_frequency, voltage_tolerance):
+    violations = []
+    pulse_voltages, not_numbers = _floatArray(location, 'pulseVoltages', pulse_voltages, violations)
+    finite = np.isfinite(pulse_voltages)
+    codes = _voltageCodes(np.where(finite, pulse_voltages, 0), dac_bitmax, voltage_tolerance)[0]
+    codes[~finite] = _NOT_FINITE
+    codes[not_numbers] = _REPORTED
+    violations.extend(_groupViolations(location, 'pulseVoltages', pulse_voltages, codes, cycle_frequency,
+                                       voltage_tolerance))
+    return violations
+
+
+def _floatArray(location, param, values, violations):
+    """
+    Converts a custom train's values to a flat float64 array. Values that are not numbers are NaN in the array, and
+    are reported in one Violation appended to violations.
+
+    Returns:
+        tuple: (array, not_numbers). not_numbers is a bool array marking the values that are not numbers.
+    """
+    try:
+        array = np.asarray(values, dtype='float64').reshape(-1)
+        return array, np.zeros(array.size, dtype=bool)
+    except (TypeError, ValueError):
+        pass
+    items = np.asarray(values, dtype=object).reshape(-1)
+    array = np.full(items.size, np.nan)
+    not_numbers = np.zeros(items.size, dtype=bool)
+    for index, item in enumerate(items):  # Only reached when a value is not a number
+        try:
+            array[index] = float(item)
+        except (TypeError, ValueError):
+            not_numbers[index] = True
+    indices = np.flatnonzero(not_numbers)
+    violations.append(Violation(location, param, indices, items[indices], 'must be numbers'))
+    return array, not_numbers
+
+
+def _groupViolations(location, param, values, codes, cycle_frequency, voltage_tolerance):
+    """
+    Returns one Violation for each violation code in a custom train, listing the pulses it applies to.
+    """
+    violations = []
+    for code in np.unique(codes[codes > 0]):
+        indices = np.flatnonzero(codes == code)
+        violations.append(Violation(location, param, indices, values[indices],
+                                    _message(code, cycle_frequency, voltage_tolerance)))
+    return violations
@@ -0,0 +1,290 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PulsePalWaveformLibrary uploads custom waveforms kept as .npy files (one array of voltages per file, in volts),
+# converting each one to device units only once. Sources are memory-mapped when used, not loaded up front.
+# Converted uploads are stored in an on-disk cache, keyed by a hash of the source's contents and the conversion
+# settings (model, pulse width, compaction), so renamed or copied files share an entry and edited files are
+# converted again. In front of it, an in-memory LRU cache holds ready-to-send upload messages, so a repeat upload
+# only costs the serial transfer. prepare() converts many waveforms at once in a process pool, e.g. before a session.
+# The library writes to the port directly. Use it with a PulsePalObject, not a ThreadedPulsePalObject or
+# AsyncPulsePalObject.
+#
+# Example:
+#   library = PulsePalWaveformLibrary('stimuli')  # A folder of .npy files
+#   library.prepare(library.names(), pulse_width=0.0001)  # Optional: converts every waveform in parallel
+#   upload = library.upload(myPulsePal, 1, 'chirp', pulse_width=0.0001)  # Sent from the cache
+#   myPulsePal.programOutputChannelParam('phase1Duration', 1, upload.phase1Duration)
+
+from .PulsePal import PulsePalObject, WaveformUpload, _compileFrames, _encodeCustomWaveform, _raiseViolations
+from .PulsePalValidation import validateCustomWaveform
+import collections
+import concurrent.futures
+import hashlib
+import os
+import struct
+import numpy as np
+
+CacheStats = collections.namedtuple('CacheStats', ['memoryHits', 'diskHits', 'conversions', 'memoryBytes',
+                                                   'memoryEntries'])
+CacheStats.__doc__ = """
+Cache activity of a PulsePalWaveformLibrary since it was created.
+    memoryHits (int): Uploads sent from the in-memory cache
+    diskHits (int): Uploads read from the on-disk cache
+    conversions (int): Waveforms converted (by upload() or prepare())
+    memoryBytes (int): Bytes of upload messages in the in-memory cache
+    memoryEntries (int): Upload messages in the in-memory cache
+"""
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pulsepal_waveform_cache')
+_CACHE_VERSION = b'1'  # Part of every cache key. Change it when the format of cache entries changes.
+_ENTRY_HEADER = struct.Struct('<QQddQ')  # A disk cache entry's WaveformUpload, followed by the upload message
+
+
+class PulsePalWaveformLibrary(object):
+    def __init__(self, directory, cache_dir=DEFAULT_CACHE_DIR, memory_budget=64*1024*1024, workers=None):
+        """
+        Opens a folder of waveforms. Nothing is read until a waveform is used.
+
+        Args:
+            directory (str): The folder holding the waveforms, as .npy files. A waveform's name is its path relative to
+                             the folder, without the extension (e.g. 'chirp' or 'session1/ramp').
+            cache_dir (str): The folder of the on-disk cache. None for no disk cache (prepare() is then unavailable).
+            memory_budget (int): Bytes of upload messages to keep in memory. The least recently used are dropped first.
+            workers (int): Processes used by prepare(). None for one per CPU.
+        """
+        self.directory = directory
+        self.cacheDir = cache_dir
+        self.memoryBudget = memory_budget
+        self.workers = workers
+        self._frames = collections.OrderedDict()  # Cache key -> (message for custom train 1, WaveformUpload), LRU last
+        self._memoryBytes = 0
+        self._sourceHashes = {}  # Source path -> (size, mtime, content hash), so unchanged sources are hashed once
+        self._stats = [0, 0, 0]  # memoryHits, diskHits, conversions
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def names(self):
+        """
+        Returns the names of the waveforms in the folder, sorted
+        """
+        names = []
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                if file_name.endswith('.npy'):
+                    path = os.path.relpath(os.path.join(root, file_name), self.directory)
+                    names.append(path[:-len('.npy')].replace(os.sep, '/'))
+        return sorted(names)
+
+    def source(self, name):
+        """
+        Returns a waveform's voltages, memory-mapped from its file (read-only). Units = volts.
+        """
+        return np.load(self._sourcePath(name), mmap_mode='r')
+
+    def upload(self, pulse_pal, custom_train_id, name, pulse_width, compact=False):
+        """
+        Sends a waveform to a custom train slot, converting it only if it is not cached (see
+        PulsePalObject.sendCustomWaveform()).
+
+        Args:
+            pulse_pal (PulsePalObject): The Pulse Pal to send the waveform to
+            custom_train_id (int): The custom train to send it to (1-2)
+            name (str): The waveform's name (see names())
+            pulse_width (float): The width of each sample. Units = seconds.
+            compact (bool): If True, runs of identical samples are merged (see PulsePalObject.sendCustomWaveform())
+
+        Returns:
+            WaveformUpload: The number of pulses sent, the phase1Duration to play them, and the bytes saved.
+
+        Raises:
+            PulsePalValidationError: If the waveform is invalid. Nothing is sent.
+            PulsePalError: If the device does not acknowledge the upload.
+        """
+        _raiseViolations(validateCustomWaveform(custom_train_id, pulse_width, [], pulse_pal._dac_bitMax,
+                                                PulsePalObject.CYCLE_FREQUENCY))
+        message, upload = self._upload(name, pulse_pal._model, pulse_width, compact)
+        if custom_train_id != 1:
+            message = message[:1] + bytes([custom_train_id + 74]) + message[2:]  # Op 76 for custom train 2
+        pulse_pal._transmitCustomTrain(custom_train_id, message, ('WaveformLibrary.upload', (custom_train_id, name)))
+        return upload
+
+    def prepare(self, names, pulse_width, model=2, compact=False):
+        """
+        Converts waveforms that are not in the disk cache, in parallel in a process pool, and stores them in the cache.
+
+        Args:
+            names (list of str): The waveforms to convert (see names())
+            pulse_width (float): The width of each sample, as it will be passed to upload(). Units = seconds.
+            model (int): The Pulse Pal model the waveforms will be sent to (1 or 2)
+            compact (bool): As it will be passed to upload()
+
+        Returns:
+            int: The number of waveforms converted
+
+        Raises:
+            PulsePalValidationError: If waveforms are invalid. It lists the violations of every invalid waveform.
+                                     Valid waveforms are still converted and cached.
+        """
+        if self.cacheDir is None:
+            raise ValueError('Error: prepare() stores converted waveforms in the disk cache, but cache_dir is None.')
+        jobs = {}
+        for name in names:
+            key = self._cacheKey(name, model, pulse_width, compact)
+            if key not in self._frames and not os.path.exists(self._cachePath(key)):
+                jobs[key] = (name, self._sourcePath(name), model, pulse_width, compact, self._cachePath(key))
+        violations = []
+        if jobs:
+            with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+                for job_violations in pool.map(_prepareWaveform, jobs.values()):
+                    violations.extend(job_violations)
+        self._stats[2] += len(jobs)
+        _raiseViolations(violations)
+        return len(jobs)
+
+    def stats(self):
+        """
+        Returns the cache activity so far, as CacheStats
+        """
+        return CacheStats(*self._stats, self._memoryBytes, len(self._frames))
+
+    def clearMemory(self):
+        """
+        Empties the in-memory cache. The disk cache is not affected.
+        """
+        self._frames.clear()
+        self._memoryBytes = 0
+
+    def _upload(self, name, model, pulse_width, compact):
+        """
+        Returns a waveform's upload message (for custom train 1) and WaveformUpload, from the in-memory cache, the
+        disk cache, or by converting it.
+        """
+        key = self._cacheKey(name, model, pulse_width, compact)
+        entry = self._frames.get(key)
+        if entry is not None:
+            self._frames.move_to_end(key)
+            self._stats[0] += 1
+            return entry
+        cache_path = None if self.cacheDir is None else self._cachePath(key)
+        entry = None if cache_path is None else _readCacheEntry(cache_path)
+        if entry is not None:
+            self._stats[1] += 1
+        else:
+            entry, violations = _convertWaveform(name, self._sourcePath(name), model, pulse_width, compact)
+            _raiseViolations(violations)
+            self._stats[2] += 1
+            if cache_path is not None:
+                _writeCacheEntry(cache_path, entry)
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        """
+        Adds an entry to the in-memory cache, dropping the least recently used entries to stay within memoryBudget
+        """
+        size = len(entry[0])
+        if size > self.memoryBudget:
+            return
+        self._frames[key] = entry
+        self._memoryBytes += size
+        while self._memoryBytes > self.memoryBudget:
+            _, (message, _) = self._frames.popitem(last=False)
+            self._memoryBytes -= len(message)
+
+    def _cacheKey(self, name, model, pulse_width, compact):
+        """
+        Returns the cache key of a waveform converted with the given settings: a hash of the source's contents and the
+        settings. Sources are only hashed again if their size or modification time changed.
+        """
+        path = self._sourcePath(name)
+        status = os.stat(path)
+        known = self._sourceHashes.get(path)
+        if known is None or known[:2] != (status.st_size, status.st_mtime_ns):
+            source = np.load(path, mmap_mode='r')
+            content_hash = hashlib.sha256(str((source.dtype.str, source.shape)).encode())
+            content_hash.update(np.ascontiguousarray(source))
+            known = self._sourceHashes[path] = (status.st_size, status.st_mtime_ns, content_hash.hexdigest())
+        settings = repr((model, float(pulse_width), bool(compact))).encode()
+        return hashlib.sha256(_CACHE_VERSION + b'|' + known[2].encode() + b'|' + settings).hexdigest()
+
+    def _cachePath(self, key):
+        return os.path.join(self.cacheDir, key + '.pulsepal')
+
+    def _sourcePath(self, name):
+        return os.path.join(self.directory, *name.split('/')) + '.npy'
+
+
+def _prepareWaveform(job):
+    """
+    Converts a waveform and stores it in the disk cache. Runs in prepare()'s worker processes, so only the violations
+    are returned to the main process.
+
+    Args:
+        job (tuple): (name, source path, model, pulse width, compact, cache path)
+
+    Returns:
+        list of Violation: The waveform's violations (see _convertWaveform()). Empty if it was converted.
+    """
+    name, source_path, model, pulse_width, compact, cache_path = job
+    entry, violations = _convertWaveform(name, source_path, model, pulse_width, compact)
+    if entry is not None:
+        _writeCacheEntry(cache_path, entry)
+    return violations
+
+
+def _convertWaveform(name, source_path, model, pulse_width, compact):
+    """
+    Converts a waveform to an upload message for custom train 1.
+
+    Returns:
+        tuple: ((message, WaveformUpload), violations). The entry is None if the waveform is invalid. Violations
+               are located by the waveform's name.
+    """
+    dac_bitmax = PulsePalObject.DAC_BITMAX_MODEL_1 if model == 1 else PulsePalObject.DAC_BITMAX_MODEL_2
+    voltages = np.load(source_path, mmap_mode='r')
+    violations = validateCustomWaveform(1, pulse_width, voltages, dac_bitmax, PulsePalObject.CYCLE_FREQUENCY)
+    if violations:
+        return None, [violation._replace(location='waveform ' + name) for violation in violations]
+    message, upload = _encodeCustomWaveform(_compileFrames(model), 1, pulse_width, voltages, dac_bitmax,
+                                            PulsePalObject.CYCLE_FREQUENCY, compact)
+    return (bytes(message), upload), []
+
+
+def _writeCacheEntry(path, entry):
+    message, upload = entry
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as cache_file:
+        cache_file.write(_ENTRY_HEADER.pack(*upload) + message)
+    os.replace(temp_path, path)  # Replaced in one step, so other processes never read a partial entry
+
+
+def _readCacheEntry(path):
+    """
+    Returns a disk cache entry as (message, WaveformUpload), or None if there is no valid entry
+    """
+    try:
+        with open(path, 'rb') as cache_file:
+            entry = cache_file.read()
+    except OSError:
+        return None
+    if len(entry) < _ENTRY_HEADER.size:
+        return None
+    return entry[_ENTRY_HEADER.size:], WaveformUpload(*_ENTRY_HEADER.unpack_from(entry))
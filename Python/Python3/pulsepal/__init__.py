@@ -0,0 +1,54 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The Pulse Pal Python 3 API. Each module is imported on first use, so that importing the package (e.g. for the
+# pulsepal command's soft-triggers) does not load NumPy or the modules a script does not use.
+#
+# Example:
+#   from pulsepal import PulsePalObject
+#   myPulsePal = PulsePalObject('COM3')
+#   myPulsePal.programOutputChannelParam('phase1Voltage', 1, 5)
+#
+# Other classes are imported from their modules, e.g. from pulsepal.PulsePalProgram import PulsePalProgram. (Those
+# that share their module's name are not importable from the package itself, since the module would replace them.)
+# Python/Python3 also holds a module with each module's name, for scripts that import them from that folder.
+
+import importlib
+
+_EXPORTS = {  # Name: module of the name, for the names importable from the package
+    'PulsePalObject': 'PulsePal', 'PulsePalError': 'PulsePal', 'PulsePalValidationError': 'PulsePal',
+    'PulsePalTimeoutError': 'PulsePal', 'PulsePalNackError': 'PulsePal', 'PulsePalDesyncError': 'PulsePal',
+    'WaveformUpload': 'PulsePal', 'AsyncPulsePalObject': 'PulsePalAsync', 'ThreadedPulsePalObject': 'PulsePalThreaded',
+    'PulsePalProxy': 'PulsePalServer', 'EmulatedSerial': 'PulsePalEmulator',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+    value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+    globals()[name] = value  # Later lookups do not call __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,236 @@
+"""
+----------------------------------------------------------------------------
+
+This file is part of the Sanworks PulsePal repository
+Copyright (C) Sanworks LLC, Rochester, New York, USA
+
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3.
+
+This program is distributed  WITHOUT ANY WARRANTY and without even the
+implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Tests of PulsePalObject against the emulated device (PulsePalEmulator), on Pulse Pal 1 (firmware 5) and
+# Pulse Pal 2 (firmware 21). Each test asserts on the state the emulator received, in device units.
+# The expected device units are computed with PulsePalObject's Decimal conversions (_volts2Bits, _seconds2Cycles),
+# which the vectorized conversions in PulsePalConversion replace.
+#
+# Usage (from Python/Python3):
+#   python -m pytest
+
+import numpy as np
+import pytest
+from pulsepal.PulsePal import PulsePalError, PulsePalObject
+from pulsepal.PulsePalConversion import seconds2Cycles, volts2Bits
+from pulsepal.PulsePalEmulator import OUTPUT_PARAM_NAMES, EmulatedSerial, PulsePalEmulator
+
+FIRMWARE_VERSIONS = (5, 21)  # Pulse Pal 1, Pulse Pal 2
+
+
+class CountingSerial(EmulatedSerial):
+    """
+    An EmulatedSerial that counts the writes it receives.
+    """
+    def __init__(self, emulator):
+        super().__init__(emulator)
+        self.nWrites = 0
+
+    def write(self, message_bytes):
+        self.nWrites += 1
+        return super().write(message_bytes)
+
+
+@pytest.fixture(autouse=True)
+def noStateCache(monkeypatch):
+    monkeypatch.setattr(PulsePalObject, 'STATE_CACHE_PATH', None)
+
+
+@pytest.fixture(params=FIRMWARE_VERSIONS)
+def pulsePal(request):
+    """
+    A PulsePalObject connected to an emulated device. The emulator is pulsePal.Port.serialObject.emulator.
+    """
+    pulse_pal = PulsePalObject(CountingSerial(PulsePalEmulator(request.param)))
+    yield pulse_pal
+    pulse_pal.disconnect()
+
+
+def emulatorOf(pulse_pal):
+    return pulse_pal.Port.serialObject.emulator
+
+
+def decimalParams(pulse_pal):
+    """
+    Returns the parameter fields in device units, converted one value at a time with the Decimal path.
+    """
+    params = np.zeros((4, len(OUTPUT_PARAM_NAMES)), dtype='int64')
+    for code, name in enumerate(OUTPUT_PARAM_NAMES):
+        for channel in range(1, 5):
+            value = getattr(pulse_pal, name)[channel]
+            if name.endswith('Voltage'):
+                value = pulse_pal._volts2Bits(value)
+            elif name.endswith(('Duration', 'Interval', 'Delay')):
+                value = int(pulse_pal._seconds2Cycles(value))
+            params[channel - 1, code] = value
+    return params
+
+
+def test_connect_syncs_defaults(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    assert emulator.connected
+    assert emulator.clientName == 'PYTHON'
+    assert emulator.errors == []
+    np.testing.assert_array_equal(emulator.outputParams, decimalParams(pulsePal))
+    np.testing.assert_array_equal(emulator.outputParams, pulsePal._syncedParams)
+
+
+def test_sync_all_params_sends_changed_params(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    n_ops = len(emulator.opLog)
+    pulsePal.phase1Voltage[2] = 7.3
+    pulsePal.restingVoltage[3] = -1.23456
+    pulsePal.interPulseInterval[1:5] = [0.2] * 4
+    pulsePal.triggerMode[2] = 1
+    pulsePal.syncAllParams()
+    assert emulator.opLog[n_ops:] == [74] * 7  # Single-parameter writes
+    np.testing.assert_array_equal(emulator.outputParams, decimalParams(pulsePal))
+    np.testing.assert_array_equal(emulator.triggerModes, [0, 1])
+
+
+def test_sync_all_params_sends_full_program(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    n_ops = len(emulator.opLog)
+    pulsePal.phase1Duration[1:5] = [0.0015, 0.5, 1.0005, 2]
+    pulsePal.phase2Duration[1:5] = [0.002, 0.1, 0.0001, 3]
+    pulsePal.interPhaseInterval[1:5] = [0.0001, 0.0002, 0.0003, 0.0004]
+    pulsePal.interPulseInterval[1:5] = [0.1, 0.2, 0.3, 0.4]
+    pulsePal.pulseTrainDuration[1:5] = [10, 20, 30, 3600]
+    pulsePal.pulseTrainDelay[1:5] = [0.1, 0.2, 0.3, 0.4]
+    pulsePal.phase2Voltage[1:5] = [-10, -2.5, 0.0001, 10]
+    pulsePal.isBiphasic[1:5] = [1, 1, 0, 1]
+    pulsePal.syncAllParams()
+    assert emulator.opLog[n_ops:] == [73]  # Changing most params is shorter as a full program
+    np.testing.assert_array_equal(emulator.outputParams, decimalParams(pulsePal))
+    n_ops = len(emulator.opLog)
+    pulsePal.syncAllParams()
+    assert emulator.opLog[n_ops:] == []  # Up to date
+    pulsePal.syncAllParams(force_full=True)
+    assert emulator.opLog[n_ops:] == [73]
+
+
+def test_program_output_channel_param(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    pulsePal.programOutputChannelParam('phase1Voltage', 1, 2.5)
+    pulsePal.programOutputChannelParam('phase1Duration', 2, 0.0015)
+    pulsePal.programTriggerChannelParam('triggerMode', 1, 2)
+    assert emulator.param('phase1Voltage', 1) == pulsePal._volts2Bits(2.5)
+    assert emulator.param('phase1Duration', 2) == int(pulsePal._seconds2Cycles(0.0015))
+    assert emulator.triggerModes[0] == 2
+    np.testing.assert_array_equal(emulator.outputParams, pulsePal._syncedParams)
+
+
+def test_custom_pulse_train(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    times = [0, 0.2, 0.5, 1.0005]
+    voltages = [8, 4, -3.5, -10]
+    pulsePal.sendCustomPulseTrain(2, times, voltages)
+    train_times, train_voltages = emulator.customTrains[2]
+    np.testing.assert_array_equal(train_times, [int(pulsePal._seconds2Cycles(t)) for t in times])
+    np.testing.assert_array_equal(train_voltages, [pulsePal._volts2Bits(v) for v in voltages])
+    assert len(emulator.customTrains[1][0]) == 0
+
+
+def test_custom_waveform(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    voltages = np.sin(np.arange(1000) / 10) * 10
+    pulsePal.sendCustomWaveform(1, 0.0002, voltages)
+    train_times, train_voltages = emulator.customTrains[1]
+    pulse_width = int(pulsePal._seconds2Cycles(0.0002))
+    np.testing.assert_array_equal(train_times, np.arange(1000) * pulse_width)
+    np.testing.assert_array_equal(train_voltages, [pulsePal._volts2Bits(v) for v in voltages])
+
+
+def test_transaction_sends_one_write(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    link = pulsePal.Port.serialObject
+    n_writes = link.nWrites
+    n_ops = len(emulator.opLog)
+    with pulsePal.transaction():
+        pulsePal.programOutputChannelParam('phase2Voltage', 1, 1)
+        pulsePal.sendCustomPulseTrain(1, [0, 0.001], [5, -5])
+        pulsePal.setFixedVoltage(3, 2)
+        assert link.nWrites == n_writes  # Queued, not sent
+    assert link.nWrites == n_writes + 1
+    assert emulator.opLog[n_ops:] == [74, 75, 79]
+    assert emulator.param('phase2Voltage', 1) == pulsePal._volts2Bits(1)
+    assert emulator.outputVoltages[2] == pulsePal._volts2Bits(2)
+    assert pulsePal.phase2Voltage[1] == 1
+
+
+def test_transaction_discards_commands_on_error(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    n_ops = len(emulator.opLog)
+    with pytest.raises(RuntimeError):
+        with pulsePal.transaction():
+            pulsePal.programOutputChannelParam('phase2Voltage', 1, 1)
+            raise RuntimeError
+    assert emulator.opLog[n_ops:] == []
+    assert pulsePal.phase2Voltage[1] == -5
+
+
+def test_settings_files(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    if emulator.model == 1:
+        with pytest.raises(PulsePalError):
+            pulsePal.saveSettingsFile('session1.pps')
+        return
+    pulsePal.phase1Voltage[1] = 3.3
+    pulsePal.saveSettingsFile('session1.pps')  # Syncs the change first
+    assert emulator.settingsFileName == 'session1.pps'
+    assert emulator.sdFiles['session1.pps'] == emulator.settingsFile()
+    saved = emulator.outputParams.copy()
+    assert pulsePal.readSettingsFile()['phase1Voltage'][1] == pytest.approx(3.3, abs=20 / 65535)
+
+    pulsePal.programOutputChannelParam('phase1Voltage', 1, -4)
+    pulsePal.loadSettingsFile('session1.pps')
+    np.testing.assert_array_equal(emulator.outputParams, saved)
+    np.testing.assert_array_equal(emulator.outputParams, decimalParams(pulsePal))
+    np.testing.assert_array_equal(emulator.outputParams, pulsePal._syncedParams)
+
+    pulsePal.deleteSettingsFile('session1.pps')
+    assert 'session1.pps' not in emulator.sdFiles
+    with pytest.raises(PulsePalError):
+        pulsePal.loadSettingsFile('session1.pps')  # The device loads its defaults instead
+    np.testing.assert_array_equal(emulator.outputParams, decimalParams(pulsePal))
+
+
+def test_disconnect(pulsePal):
+    emulator = emulatorOf(pulsePal)
+    pulsePal.disconnect()
+    assert not emulator.connected
+    assert emulator.opLog[-1] == 81
+
+
+@pytest.mark.parametrize('firmware_version', FIRMWARE_VERSIONS)
+def test_conversion_matches_decimal_path(firmware_version):
+    pulse_pal = PulsePalObject(EmulatedSerial(PulsePalEmulator(firmware_version)))
+    rng = np.random.default_rng(0)
+    voltages = np.concatenate([rng.uniform(-10, 10, 2000), np.round(rng.uniform(-10, 10, 1000), 4),
+                               np.arange(-100000, 100001, 97) / 10000, np.arange(-20000, 20000, 7) / 2000 + 0.00005,
+                               [-10, 0, 10, 9.99995, -9.99995, 0.00005]])
+    voltages = voltages[np.abs(voltages) <= 10]
+    times = np.concatenate([rng.uniform(0, 3600, 2000), np.round(rng.uniform(0, 10, 1000), 4),
+                            np.arange(0, 20000, 3) / 10000, np.arange(0, 20000, 7) / 10000 + 0.00005,
+                            [0, 0.0001, 0.00005, 0.00015, 1.00005, 3600]])
+    np.testing.assert_array_equal(volts2Bits(voltages, pulse_pal._dac_bitMax),
+                                  [pulse_pal._volts2Bits(v) for v in voltages])
+    np.testing.assert_array_equal(seconds2Cycles(times), [int(pulse_pal._seconds2Cycles(t)) for t in times])
+    pulse_pal.disconnect()